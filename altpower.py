@@ -13,27 +13,44 @@
     $ sudo halt
 
     ----------------------------------------------------------------
-    For photo taking using usb webcam use fswebcam which needs to be
-    installed with apt 
+    For photo taking using usb webcam, camera.py keeps the webcam open
+    with OpenCV (apt install python3-opencv), or if that is not
+    available uses fswebcam which needs to be installed with apt 
     ----------------------------------------------------------------
 
    This script starts as a service on boot (run as root).
 
-   Loop:
+   The on and off times are set by SCHEDULE, a list of windows, see schedule.py
+   which with the default schedule does:
 
-        If the hour is 10, 11, 12, 13 or 14 and no photo taken yet, then take it.
+        Wake at 9:55, and at 10:00, 11:00, 12:00, 13:00 and 14:00 take a photo,
+        then set RTC to turn Pi on for the next photo and shut down.
 
-        If the hour is one of 10, 11, 12, 13 set RTC to turn Pi on at hour plus one 
+        After the 14:00 photo, set RTC to turn Pi on at 18:00 and shut down.
 
-        If current time is between 14:00 and 17:55:
-              Set RTC to turn Pi on at 18:00
-              Shut down Pi
+        Between 18:00 and 18:10 stay on, then set RTC to turn Pi on at 9:55
+        next day and shut down.
 
-        If current time is between 18:10 and 9:50 next day:
-               Set RTC to turn Pi on at 9:55
-               Shut down Pi
+   With the SOLAR schedule the photo times follow solar noon at LATITUDE, LONGITUDE,
+   and the 10, 11, 13 and 14 photos are skipped when the sun is low, or when the
+   previous photo of the day, looked up in the frame index, was already bright enough.
 
-        Otherwise, Wait 5 seconds, continue loop
+   Each photo is taken as soon as the Pi boots, and the Pi halts straight after,
+   unless held on by an ssh session or the hold file HOLDFILE, see poweroff.py.
+   The evening window is the time to connect. The seconds from boot to halt of
+   each wake cycle are logged to TIMINGLOG.
+
+   Each photo has a deadline, and a webcam which fails is reset and tried again, see
+   camera.py, and a photo which still fails is logged and skipped. The watchdog
+   process, see watchdog.py, writes the wakealarm and halts the Pi should the cycle
+   overrun BUDGET seconds, not counting deliberate waits, so a hung webcam cannot
+   drain the battery. To try this with injected faults, see faultinject.py
+
+   With COMPENSATE, the wakealarm is set early by the time the Pi takes to boot and
+   be ready, learnt from the latency of earlier wakes, see wakelatency.py, so each
+   photo is taken on its minute without the Pi waiting idle beforehand.
+
+   To replay a year of schedules offline, and compare their on-time, see simulate.py
 
    Note, all times are obtained with timezone.utc, if using this in other
    timezones, this must be altered accordingly.
@@ -41,7 +58,8 @@
    Times take no notice of daylight savings time.
 
    Note: this script uses the Python imaging library Pillow to measure brightness of
-   the image at a specific 'grass' point on the image.
+   the image at a specific 'grass' point on the image, the measurement itself is
+   in metering.py, which should be kept alongside this script.
 
    So this requires pillow to be installed, typically with
 
@@ -51,54 +69,195 @@
  """
 
 
-import os, sys, time, subprocess, pathlib
+import os, sys, time, pathlib
 
 from datetime import datetime, timezone, timedelta
 
-from PIL import Image
+from schedule import run_cycle, next_wake, SOLAR, MINSLEEP
+
+from metering import file_stats, get_stats, exposure_score, EQUAL, TARGET, TESTX, TESTY
+
+from camera import Camera
+
+from poweroff import uptime, held, set_wakealarm, halt, HOLDPOLL
+
+from cyclelog import CycleLog
+
+from watchdog import Watchdog, RETRYWAKE
+
+from wakelatency import LatencyModel
+
+from exposuremodel import ExposureModel, MINEXPOSURE
+
+from frameindex import FrameIndex, INDEXNAME, file_sha1
+
+from storage import apply_policy, KEEPHOURS as STORAGEHOURS
+
+from transfer import record_add, MANIFESTNAME
 
 TIMEZONE = timezone.utc
 
 IMAGES = pathlib.Path("/home/bernard/git/timelapse/images")
 
+# Seconds to wait on boot before running the schedule, the evening maintenance window
+# is the time to connect, the original scripts waited 240 on every boot
+GRACE = 0
+
+# While this file exists, or an ssh session is open, the Pi is not halted, see poweroff.py
+HOLDFILE = IMAGES.parent / "hold"
+
+# Seconds of work a wake cycle may take before the watchdog halts the Pi, waiting for a
+# window to open, through the maintenance window, or while held on, is not counted
+BUDGET = 600
+
+# The state shared with the watchdog process, on tmpfs so that it can be written even
+# when the disk is full
+WATCHDOGFILE = pathlib.Path("/run/timelapse-watchdog.json")
+
+# The capture and maintenance windows, see schedule.py, schedule.DEFAULT gives fixed hourly
+# photos, SOLAR fewer wakes in winter
+SCHEDULE = SOLAR
+
+# If COMPENSATE is True, each wakealarm is set ahead of its window by the latency from
+# wakealarm to the script being ready, learnt from earlier wakes and kept in LATENCYFILE,
+# rather than by the fixed lead of the window
+COMPENSATE = True
+LATENCYFILE = IMAGES / "latency.json"
+LATENCY = LatencyModel(LATENCYFILE)
+
+# The webcam device
+DEVICE = "/dev/video0"
+
 # Image pixels the webcam is capable of
 CAMXY = "4000x3000"
 
-# Image brightness will be tested by inspecting a block of 40x40 pixels at position TESTX, TESTY
-# So these values should be chosen at a static representative point of the image. In my case this
-# is a patch of grass
- 
-TESTX = 3500
-TESTY = 2500
+# The webcam, this is opened on the first photo of a wake cycle, and closed before shutdown
+CAMERA = Camera(DEVICE, CAMXY)
+
+# Each photo taken, and each shutdown, is logged here with the seconds since boot
+TIMINGLOG = IMAGES / "timing.log"
+
+# Each photo written, changed or deleted is appended to this manifest, so the desktop can
+# copy only new photos with makevid/pull.py, see transfer.py
+MANIFEST = IMAGES / MANIFESTNAME
+
+# A JSON line for each wake cycle, with boot to halt timings, captures, temperature and
+# voltages, is appended to CYCLELOG, see cyclelog.py
+CYCLELOG = IMAGES / "cycles.jsonl"
+CYCLE = CycleLog(CYCLELOG)
+
+# Each photo is recorded in this SQLite index with its exposure and metered statistics, see frameindex.py
+INDEXFILE = IMAGES / INDEXNAME
 
+# Location of the camera, in degrees, east positive, used to calculate the sun's elevation
+LATITUDE = 51.5
+LONGITUDE = -0.1
 
-def get_range(x,y):
-    "Return a range of x,y values around the given x,y"
-    for xx in range(x-20, x+20):
-        for yy in range(y-20, y+20):
-            yield (xx,yy)
+SITE = {"latitude":LATITUDE, "longitude":LONGITUDE}
 
+# If PREDICT is True, the exposure of the first photo is predicted from the history of earlier
+# photos held in MODELFILE, otherwise it is always 10
+PREDICT = True
+MODELFILE = IMAGES / "exposure.json"
 
-def get_brightness(img, x, y):
-    """Returns a value between 0.0 and 1.0, where 1.0 is max brightness
-       This is tested around the given x, y point of the image"""
+MODEL = ExposureModel(MODELFILE, LATITUDE, LONGITUDE)
 
-    # Note standard brightness measurements weigh R,G,B differently
-    # in particular green is emphasised, but since I am simply comparing
-    # two brightness levels I have not bothered
+# A photo brighter than this is retaken with a shorter exposure, this is only
+# possible if it was taken with a predicted exposure above the minimum
+TOOBRIGHT = 0.5
 
-    # its also a bit unknown to me what effect snow would have, so I'm keeping
-    # it simple
+# If STORAGE is True, at the start of the evening maintenance window the photos of that day, and
+# the day before, are reduced as set out in storage.py, so less has to be copied off the Pi.
+# Only frames at KEEPHOURS are kept at full size, others are replaced by previews,
+# and _orig photos are deleted where the retake was better
+STORAGE = True
 
-    brightness = 0
-    maxb = 0
-    # get a range of x,y values around (x,y)
-    for p in get_range(x, y):
-        red, green, blue = img.getpixel(p)
-        brightness += red+green+blue
-        maxb += 255+255+255
-    return brightness / maxb
+# The hours of the frames kept at full size by the storage policy. makevid/bestframe.py
+# chooses the best frame of each day from the full size frames only, so to use it set this
+# to None, keeping every frame, at the cost of copying all of them off the Pi
+KEEPHOURS = STORAGEHOURS
 
+# If KEEPORIG is True, the storage policy keeps the _orig photos of the frames kept at full size,
+# within the same byte budget, which makevid/fuse.py needs to fuse each with its retake,
+# otherwise it deletes those whose retake was better
+KEEPORIG = False
+
+# If BRACKETING is True, rather than a photo at exposure 10 followed by a possible retake,
+# a photo is taken at each of the BRACKET exposures from the one camera session, each is
+# metered, and only the best is saved at full quality. Exposures should be given shortest first,
+# and the series stops early once the photos pass the brightness target and get worse.
+BRACKETING = False
+BRACKET = (10, 15, 20, 50)
+
+# Wall clock seconds allowed for a bracket, once this is used up no further exposures are started,
+# and an exposure is not started if the previous one suggests it would overrun
+BRACKET_BUDGET = 60
+
+# If True the rejected photos of a bracket are kept as 1/8 size thumbnails, named
+# image_YYYYMMDDHH_eNN_thumb.jpeg where NN is the exposure, otherwise they are dropped
+BRACKET_THUMBNAILS = True
+
+
+def log_timing(message):
+    """Appends a line to TIMINGLOG giving the time, the seconds since boot, and
+       the message, so the on-time of each wake cycle can be followed"""
+    up = uptime()
+    upstring = "unknown" if up is None else f"{up:.1f}"
+    timestring = datetime.now(tz=TIMEZONE).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        with open(TIMINGLOG, "a") as f:
+            f.write(f"{timestring} uptime {upstring} {message}\n")
+    except OSError:
+        # the log must never stop a photo being taken, or the pi shutting down
+        pass
+
+
+def index_photo(filepath, exposure, stats=None, retake=False):
+    """Records the photo in the index at INDEXFILE, if stats are not given the photo is metered,
+       and appends it to the transfer MANIFEST"""
+    try:
+        sha1 = file_sha1(filepath)
+        record_add(MANIFEST, filepath, sha1)
+        with FrameIndex(INDEXFILE) as index:
+            index.record(filepath, exposure, stats, retake, sha1)
+    except Exception as e:
+        # the index must never stop a photo being taken, or the pi shutting down
+        log_timing(f"unable to index {filepath.name}: {e}")
+
+
+def retake_exposure(exposure, b):
+    """Given the exposure of a photo and its metered brightness b, returns the
+       exposure to retake it with, or None if it does not need retaking"""
+    if b<0.15:
+        # very dark photo, retake with five times the exposure, 50 from 10
+        factor = 5
+    elif b<0.20:
+        # dark photo, retake with twice the exposure, 20 from 10
+        factor = 2
+    elif b<0.25:
+        # fairly dark photo, retake with 1.5 times the exposure, 15 from 10
+        factor = 1.5
+    elif b>TOOBRIGHT and exposure>MINEXPOSURE:
+        # a predicted exposure was too long, shorten it in proportion
+        factor = TARGET / b
+    else:
+        return
+    return max(MINEXPOSURE, round(exposure*factor))
+
+
+def satisfied(day):
+    """Returns True if the latest photo taken on the given date is neither too dark nor
+       too bright, so optional windows of the schedule can be skipped"""
+    try:
+        with FrameIndex(INDEXFILE) as index:
+            rows = index.query("SELECT brightness FROM frames WHERE kind = 'frame' AND day = ? ORDER BY hour DESC LIMIT 1",
+                               (day.strftime("%Y%m%d"),))
+    except Exception as e:
+        log_timing(f"unable to read index: {e}")
+        return False
+    if not rows or rows[0]["brightness"] is None:
+        return False
+    return 0.25 <= rows[0]["brightness"] <= TOOBRIGHT
 
 
 def takephoto(timestamp):
@@ -114,7 +273,8 @@ def takephoto(timestamp):
         # This file has already been created
         return
 
-    ## Use fswebcam to take a photo
+    ## Use the global CAMERA to take a photo, this keeps the webcam open and streaming
+    #  between photos, or if that is not possible, runs fswebcam for each one, as
     #
     #  fswebcam -r 4000x3000 --set "Auto Exposure=Manual Mode" --set "Exposure Time, Absolute=10" --no-banner -D 4 -S 12 --jpeg 95 filepath
     #
@@ -122,168 +282,234 @@ def takephoto(timestamp):
     #
     # testing on laptop: fswebcam -r 4000x3000 -d /dev/video2 --no-banner -D 2 -S 12 --jpeg 95 filepath
     #
-    # Note: my USB webcam takes pictures at 4000x3000 pixels. This value CAMXY and TESTX, TESTY would have to be adapted
-    # for other models of webcam. Also the exposure times, set in the string "Exposure Time, Absolute=10" together with the levels
+    # Note: my USB webcam takes pictures at 4000x3000 pixels. This value CAMXY and TESTX, TESTY in metering.py would have to be adapted
+    # for other models of webcam. Also the exposure times, together with the levels
     # of brightness at which the photo is re-taken would have to be adapted by trial and error.
     #
-    # Start by taking an initial photo with exposure of 10
+    # Start by taking an initial photo with the exposure predicted from earlier photos,
+    # or with exposure of 10 if there are none
     ##
 
-    subprocess.run(["fswebcam", "-r", CAMXY,
-                    "--set", "Auto Exposure=Manual Mode",
-                    "--set", "Exposure Time, Absolute=10",
-                    "--no-banner",
-                    "-D", "4", "-S", "12", "--jpeg", "95", str(filepath)])
-    time.sleep(5)
+    exposure = MODEL.predict(timestamp) if PREDICT else 10
 
-    # Open Image with Pillow, and check brightness
-    with Image.open(filepath) as img:
-        b = get_brightness(img, TESTX, TESTY)
+    seconds = CAMERA.capture(filepath, exposure)
+    log_timing(f"{filepath.name} exposure {exposure} {CAMERA.name} {seconds:.1f}s")
 
-    if b<0.15:
-        # very dark photo, retake with 50 exposure
+    # Open Image with Pillow, and check brightness, the file is decoded at reduced
+    # scale as only the small test patch is needed
+    metering = time.monotonic()
+    stats = file_stats(filepath, TESTX, TESTY)
+    CYCLE.capture(filepath.name, exposure, seconds, time.monotonic() - metering)
+    b = stats["brightness"]
+    MODEL.record(timestamp, exposure, b)
 
+    retake = retake_exposure(exposure, b)
+    if retake is None:
+        index_photo(filepath, exposure, stats)
+    else:
         # rename original file
-        os.rename(filepath, IMAGES / f"image_{timestampstring}_orig.jpeg")
+        origpath = IMAGES / f"image_{timestampstring}_orig.jpeg"
+        os.rename(filepath, origpath)
+        index_photo(origpath, exposure, stats)
 
-        # exposure 50
-        subprocess.run(["fswebcam", "-r", CAMXY,
-                        "--set", "Auto Exposure=Manual Mode",
-                        "--set", f"Exposure Time, Absolute=50",
-                        "--no-banner",
-                        "-D", "4", "-S", "12", "--jpeg", "95", str(filepath)])
+        # and retake, from the same camera session
+        seconds = CAMERA.capture(filepath, retake)
+        log_timing(f"{filepath.name} exposure {retake} {CAMERA.name} {seconds:.1f}s retake, brightness was {b:.3f}")
+        metering = time.monotonic()
+        stats = file_stats(filepath, TESTX, TESTY)
+        CYCLE.capture(filepath.name, retake, seconds, time.monotonic() - metering)
+        MODEL.record(timestamp, retake, stats["brightness"])
+        index_photo(filepath, retake, stats, retake=True)
 
-        time.sleep(5)
-
-    elif b<0.20:
-        # dark photo, retake with 20 exposure
+    MODEL.save()
 
-        # rename original file
-        os.rename(filepath, IMAGES / f"image_{timestampstring}_orig.jpeg")
 
-        # exposure 20
-        subprocess.run(["fswebcam", "-r", CAMXY,
-                        "--set", "Auto Exposure=Manual Mode",
-                        "--set", f"Exposure Time, Absolute=20",
-                        "--no-banner",
-                        "-D", "4", "-S", "12", "--jpeg", "95", str(filepath)])
+def bracketphoto(timestamp):
+    """Takes a photo at each exposure in BRACKET, and saves the best exposed one into
+       the folder given by global variable IMAGES, the timestamp is used to create the filename
+    """
 
-        time.sleep(5)
-    elif b<0.25:
-        # fairly dark photo, retake with 15 exposure
+    timestampstring = timestamp.strftime('%Y%m%d%H')
 
-        # rename original file
-        os.rename(filepath, IMAGES / f"image_{timestampstring}_orig.jpeg")
+    filepath = IMAGES / f"image_{timestampstring}.jpeg"
 
-        # exposure 15
-        subprocess.run(["fswebcam", "-r", CAMXY,
-                        "--set", "Auto Exposure=Manual Mode",
-                        "--set", f"Exposure Time, Absolute=15",
-                        "--no-banner",
-                        "-D", "4", "-S", "12", "--jpeg", "95", str(filepath)])
+    if filepath.exists():
+        # This file has already been created
+        return
 
-        time.sleep(5)
+    start = time.monotonic()
+    best = None       # (score, exposure, image) of the best photo so far
+    seconds = 0       # time taken by the last photo
+
+    for exposure in BRACKET:
+        if best is not None and time.monotonic() - start + seconds > BRACKET_BUDGET:
+            # no time for another photo
+            break
+        img, seconds = CAMERA.grab(exposure)
+        metering = time.monotonic()
+        stats = get_stats(img, [(TESTX, TESTY)], weights=EQUAL)
+        score = exposure_score(stats)
+        CYCLE.capture(filepath.name, exposure, seconds, time.monotonic() - metering)
+        MODEL.record(timestamp, exposure, stats["mean"])
+        log_timing(f"{filepath.name} exposure {exposure} {CAMERA.name} {seconds:.1f}s bracket, brightness {stats['mean']:.3f}")
+
+        if best is None or score > best[0]:
+            rejected, best = best, (score, exposure, img)
+        else:
+            rejected = (score, exposure, img)
+
+        if rejected is not None and BRACKET_THUMBNAILS:
+            thumbpath = IMAGES / f"image_{timestampstring}_e{rejected[1]}_thumb.jpeg"
+            rejected[2].reduce(8).save(thumbpath)
+            index_photo(thumbpath, rejected[1])
+
+        if best[2] is not img:
+            # exposures are increasing, and this one is worse than the best, so later ones will be too
+            break
+
+    best[2].save(filepath, quality=95)
+    index_photo(filepath, best[1])
+    MODEL.save()
+    log_timing(f"{filepath.name} exposure {best[1]} kept, bracket took {time.monotonic() - start:.1f}s")
+
+
+def capture(timestamp):
+    "Called by the schedule when a capture window opens"
+    # Take the photo, a failure is logged, and the cycle carries on to set the wakealarm
+    try:
+        if BRACKETING:
+            bracketphoto(timestamp)
+        else:
+            takephoto(timestamp)
+    except OSError as e:
+        log_timing(f"photo failed: {e}")
+        CYCLE.fault(f"{timestamp.strftime('%Y%m%d%H')}: {e}")
+        CAMERA.close()
 
 
+def maintain(timestamp):
+    "Called by the schedule when a maintenance window opens, applies the storage policy"
+    if not STORAGE:
+        return
+    start = time.monotonic()
+    try:
+        with FrameIndex(INDEXFILE) as index:
+            for day in (timestamp.date() - timedelta(days=1), timestamp.date()):
+                result = apply_policy(IMAGES, index, day, KEEPHOURS, keeporig=KEEPORIG, manifest=MANIFEST)
+                if any(result.values()):
+                    log_timing(f"storage {day}: {result['pruned']} pruned, {result['previews']} previews, "
+                               f"{result['reencoded']} re-encoded, {result['saved']} bytes saved")
+    except Exception as e:
+        # the policy must never stop the pi shutting down
+        log_timing(f"storage policy failed: {e}")
+    log_timing(f"storage policy took {time.monotonic() - start:.1f}s")
+
+
+def lead():
+    "Returns the seconds from wakealarm to ready given to the schedule, or None to use the window leads"
+    return LATENCY.lead() if COMPENSATE else None
+
+
+def fallback_wake(deadline):
+    """Returns the epoch of the next scheduled wake after the epoch deadline, plus the time to
+       halt, this is the wakealarm the watchdog sets if it has to halt the Pi"""
+    after = datetime.fromtimestamp(deadline + MINSLEEP, tz=TIMEZONE)
+    try:
+        return int(next_wake(after, SCHEDULE, SITE, latency=lead()).timestamp())
+    except ValueError:
+        return int(deadline) + RETRYWAKE
 
 
-def get_epoch():
-    """Checks the time, and if correct calls takephoto.
-       Returns epoch in seconds when the pi should next be powered up, this is
-       either at 9:55, 10:00, 11:00, 12:00, 13:00, 14:00 or 18:00 depending on which is next.
+def get_epoch(sleep=time.sleep):
+    """Runs the wake cycle given by SCHEDULE, see schedule.py, calling capture
+       when a capture window opens, and calling maintain then holding the Pi on through
+       a maintenance window.
+       Sleeps with the given sleep function until the exact time a window opens or closes,
+       rather than polling.
 
-       If the current hour is 10, 11, 12, 13 or 14, takes photo.
- 
-       If the hour is one of 10, 11, 12, 13 set RTC to turn Pi on at hour plus one 
+       Returns epoch in seconds when the pi should next be powered up, with the default
+       schedule this is either at 9:55, 11:00, 12:00, 13:00, 14:00 or 18:00 depending on which is next.
+    """
+    return run_cycle(SCHEDULE, capture, lambda: datetime.now(tz=TIMEZONE), sleep,
+                     site=SITE, satisfied=satisfied, maintain=maintain, latency=lead())
 
-       If current time is between 14:00 and 17:55:
-              Set RTC to turn Pi on at 18:00
-              Shut down Pi
 
-       If current time is between 18:10 and 9:50 next day:
-              Set RTC to turn Pi on at 9:55
-              Shut down Pi
+def record_latency():
+    "Records the seconds from the last wakealarm to now, when the script is ready to take a photo"
+    try:
+        latency = LATENCY.ready(time.time())
+        LATENCY.save()
+    except OSError as e:
+        log_timing(f"unable to save wake latency: {e}")
+        return
+    if latency is not None:
+        CYCLE.latency(latency)
+        log_timing(f"wakealarm to ready {latency:.1f}s, lead now {lead()}s")
 
-       Otherwise, Wait 5 seconds, continue loop
-    """
 
+def main():
+    "Runs the wake cycle, sets the wakealarm and halts"
 
-    while True:
+    # the watchdog halts the Pi if this overruns, deliberate waits go through watchdog.sleep
+    # which adds them to the budget
+    watchdog = Watchdog(WATCHDOGFILE, fallback_wake, BUDGET, HOLDFILE, TIMINGLOG, CYCLELOG)
+    watchdog.start()
 
-        timestamp = datetime.now(tz=TIMEZONE)
+    # wait GRACE seconds on boot, by default none
+    watchdog.sleep(GRACE)
 
-        if timestamp.hour in (10, 11, 12, 13, 14):
-            # Take the photo
-            takephoto(timestamp)
+    record_latency()
 
-        # test for current time, and return next on-time
-
-        for hr in range(10, 14):    # hr is 10, 11, 12, 13
-            if (timestamp.hour == hr and timestamp.minute < 55):
-                # Set RTC to turn Pi on at hr plus 1
-                nexttime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=hr+1, tzinfo=TIMEZONE)
-                # next hour in epoch seconds
-                epoch = int(nexttime.timestamp())
-                return epoch
-
-        if ((timestamp.hour >= 14 and timestamp.hour < 17) or
-            (timestamp.hour == 17 and timestamp.minute < 55)):
-            # Set RTC to turn Pi on at 18:00
-            evetime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=18, tzinfo=TIMEZONE)
-            # evetime in epoch seconds
-            epoch = int(evetime.timestamp())
-            return epoch
-
-        # test if current time > 18:10 or < 9:50
-        # If so, set on-time to the following 9:55
-
-        if (timestamp.hour >= 19 or timestamp.hour < 9 or
-            (timestamp.hour == 9 and timestamp.minute < 50) or
-            (timestamp.hour == 18 and timestamp.minute > 10)):
-            # Set RTC to turn Pi on at 9:55
+    holding = None
+    while True:
+        # if time is right (within a capture window of SCHEDULE) this takes photo.
+        # Returns the epoch of the next wake up time.
+        try:
+            epoch = get_epoch(watchdog.sleep)
+        except:
+            # on any failure, set epoch to 9:55 next day
+            timestamp = datetime.now(tz=TIMEZONE) + timedelta(days=1)
             nexttime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=9, minute=55, tzinfo=TIMEZONE)
-            if timestamp.hour >= 18:
-                # get next day
-                nexttime = nexttime + timedelta(days=1)
             epoch = int(nexttime.timestamp())
-            return epoch
-
-        # still on-time, wait 5 seconds and continue
-        time.sleep(5)
 
+        # stay on while held, carrying on with the schedule
+        reason = held(HOLDFILE)
+        if reason != holding:
+            log_timing(f"held on by {reason}" if reason else "hold released")
+            holding = reason
+        if reason is None:
+            break
+        CYCLE.held()
+        watchdog.sleep(HOLDPOLL)
 
+    # For testing: print a message with the epoch of the next on-time
+    # print(f"Setting wakealarm at epoch {epoch}")
+    # ontime = datetime.fromtimestamp(epoch).strftime('%Y%m%d %H:%M:%S')
+    # print(f"Which is at {ontime}")
 
-if __name__ == "__main__":
+    CAMERA.close()
 
-    # wait four minutes on boot to allow a user to boot the pi, remote connect,
-    # and if required stop the shutdown.
-    time.sleep(240)
+    # set the wakeup time into the RTC, the watchdog halts the Pi if this and halt do not
+    # happen within its margin
+    watchdog.finish(epoch)
+    set_wakealarm(epoch)
+    watchdog.written()
 
-    # After the four minutes, if time is right (10:00, 11:00, 12:00, 13:00, 14:00) this takes photo.
-    # Returns the epoch of the next wake up time.
+    # so the next boot can measure its latency from this wakealarm
+    LATENCY.armed(epoch)
     try:
-        epoch = get_epoch()
-    except:
-        # on any failure, set epoch to 9:55 next day
-        timestamp = datetime.now(tz=TIMEZONE) + timedelta(days=1)
-        nexttime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=9, minute=55, tzinfo=TIMEZONE)
-        epoch = int(nexttime.timestamp())
+        LATENCY.save()
+    except OSError:
+        pass
 
-    # For testing: print a message with the epoch of the next on-time
-    # print(f"Setting wakealarm at epoch {epoch}")
-    # ontime = datetime.fromtimestamp(epoch).strftime('%Y%m%d %H:%M:%S')
-    # print(f"Which is at {ontime}")
+    # and halt, the uptime in this log line is the boot to halt time of the cycle
+    CYCLE.write(epoch)
+    up = uptime()
+    log_timing(f"halt, wakealarm {epoch}, boot to halt {'unknown' if up is None else f'{up:.1f}'} seconds")
+    halt()
 
 
-    # set the wakeup time into the RTC
-    path = pathlib.Path("/sys/class/rtc/rtc0/wakealarm")
-    # clear current wakealarm
-    path.write_bytes("0".encode("UTF-8"))
-    # and write new time
-    path.write_bytes(str(epoch).encode("UTF-8"))
+if __name__ == "__main__":
 
-    # shutdown after one minute. This is broadcast to any connected user
-    # and gives a user the chance to stop it with
-    # sudo shutdown -c
-    subprocess.run(["shutdown", "+1"])
+    main()
     sys.exit(0)
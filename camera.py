@@ -0,0 +1,352 @@
+"""Webcam capture backends, used by altpower.py
+
+   V4L2Camera opens the webcam in-process using OpenCV and keeps it streaming,
+   so several photos at different exposures can be taken in one wake cycle
+   without re-opening the device and waiting for it to settle each time.
+
+   FswebcamCamera runs fswebcam for each photo, as was always done, and is used
+   if OpenCV is not installed or the device cannot be opened by it.
+
+   Camera chooses between these on the first capture. It runs each photo with a
+   deadline of STEP_TIMEOUT seconds, so a wedged webcam cannot hang the script,
+   and if a photo fails or overruns, resets the USB webcam and tries again, up to
+   RETRIES times, before raising OSError.
+
+   StubCamera stands in for the webcam, with an injected fault, to test this
+   without a webcam, see faultinject.py.
+
+   Both backends can grab a photo as a Pillow image rather than saving it, so a
+   series of exposures can be metered and only the best one written to disk.
+
+   For the in-process backend, OpenCV is needed, typically with
+
+   sudo apt install python3-opencv
+"""
+
+import os, time, tempfile, threading, subprocess
+
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+# The webcam device
+DEVICE = "/dev/video0"
+
+# Image pixels the webcam is capable of
+CAMXY = "4000x3000"
+
+JPEG_QUALITY = 95
+
+# Frames discarded when the stream is first opened, as fswebcam -S 12
+WARMUP_FRAMES = 12
+
+# Frames discarded after the exposure is changed, before one is kept, since
+# frames already queued by the driver were taken with the old exposure
+SETTLE_FRAMES = 4
+
+# Seconds allowed for a photo, including opening the webcam, before it is abandoned
+STEP_TIMEOUT = 60
+
+# Times a failed photo is tried again, after resetting the USB webcam
+RETRIES = 1
+
+# Seconds to wait for the device to reappear after a USB reset
+RESET_WAIT = 15
+
+
+def call_with_deadline(func, seconds, *args):
+    """Returns func(*args), run in a thread, raises TimeoutError, an OSError, if it has not
+       returned within seconds. The thread is then abandoned, it cannot be stopped, but as a
+       daemon thread it does not keep the script from ending"""
+    result = {}
+    def run():
+        try:
+            result["value"] = func(*args)
+        except BaseException as e:
+            result["error"] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    if thread.is_alive():
+        raise TimeoutError(f"{getattr(func, '__name__', 'call')} did not finish in {seconds}s")
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def reset_usb(device=DEVICE, wait=RESET_WAIT):
+    """Resets the USB webcam of the video device, by de-authorising and re-authorising it
+       in sysfs, which makes the kernel enumerate it again. Needs root.
+       Returns True if it was reset and its device has reappeared"""
+    name = os.path.basename(os.path.realpath(device))
+    interface = os.path.realpath(f"/sys/class/video4linux/{name}/device")
+    # the video device is an interface, such as 1-1:1.0, of the USB device 1-1
+    authorized = os.path.join(os.path.dirname(interface), "authorized")
+    if not os.path.exists(authorized):
+        return False
+    try:
+        with open(authorized, "w") as f:
+            f.write("0")
+        time.sleep(1)
+        with open(authorized, "w") as f:
+            f.write("1")
+    except OSError:
+        return False
+    end = time.monotonic() + wait
+    while time.monotonic() < end:
+        if os.path.exists(device):
+            # give the driver a moment to finish setting up
+            time.sleep(1)
+            return True
+        time.sleep(0.5)
+    return False
+
+
+class FswebcamCamera:
+    "Takes each photo by running fswebcam"
+
+    name = "fswebcam"
+
+    def __init__(self, device=DEVICE, resolution=CAMXY):
+        self.device = device
+        self.resolution = resolution
+
+    def capture(self, filepath, exposure):
+        "Takes a photo with the given exposure and saves it as a JPEG to filepath"
+        # exposure time is 10 to 5000, so 10 is a very short time
+        # the timeout kills fswebcam if it hangs, within the deadline set by Camera
+        try:
+            subprocess.run(["fswebcam", "-d", self.device, "-r", self.resolution,
+                            "--set", "Auto Exposure=Manual Mode",
+                            "--set", f"Exposure Time, Absolute={exposure}",
+                            "--no-banner",
+                            "-D", "4", "-S", str(WARMUP_FRAMES), "--jpeg", str(JPEG_QUALITY), str(filepath)],
+                           timeout=STEP_TIMEOUT - 5)
+        except subprocess.TimeoutExpired:
+            raise TimeoutError(f"fswebcam did not finish in {STEP_TIMEOUT - 5}s")
+
+    def grab(self, exposure):
+        "Returns a photo taken with the given exposure as a Pillow image"
+        fd, tmpname = tempfile.mkstemp(suffix=".jpeg")
+        os.close(fd)
+        try:
+            self.capture(tmpname, exposure)
+            with Image.open(tmpname) as img:
+                img.load()
+                return img
+        finally:
+            os.remove(tmpname)
+
+    def close(self):
+        pass
+
+
+class V4L2Camera:
+    "Keeps the webcam open and streaming with OpenCV, between photos"
+
+    name = "v4l2"
+
+    def __init__(self, device=DEVICE, resolution=CAMXY):
+        self.device = device
+        self.width, self.height = (int(n) for n in resolution.split("x"))
+        self.cap = None
+        self.exposure = None
+
+    def open(self):
+        "Opens the device and starts it streaming, raises OSError on failure"
+        if cv2 is None:
+            raise OSError("OpenCV is not installed")
+        cap = cv2.VideoCapture(self.device, cv2.CAP_V4L2)
+        if not cap.isOpened():
+            raise OSError(f"Unable to open {self.device}")
+        # MJPG is needed by most USB webcams to stream at full resolution
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # with the V4L2 backend, 1 is manual exposure
+        cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)
+        for n in range(WARMUP_FRAMES):
+            cap.grab()
+        ok, frame = cap.read()
+        if not ok or frame.shape[1] != self.width or frame.shape[0] != self.height:
+            cap.release()
+            raise OSError(f"{self.device} does not stream at {self.width}x{self.height}")
+        self.cap = cap
+
+    def read(self, exposure):
+        "Returns a frame, as an OpenCV BGR array, taken with the given exposure"
+        if self.cap is None:
+            self.open()
+        if exposure != self.exposure:
+            self.cap.set(cv2.CAP_PROP_EXPOSURE, exposure)
+            self.exposure = exposure
+            for n in range(SETTLE_FRAMES):
+                self.cap.grab()
+        ok, frame = self.cap.read()
+        if not ok:
+            raise OSError(f"Unable to read a frame from {self.device}")
+        return frame
+
+    def capture(self, filepath, exposure):
+        "Takes a photo with the given exposure and saves it as a JPEG to filepath"
+        frame = self.read(exposure)
+        if not cv2.imwrite(str(filepath), frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]):
+            raise OSError(f"Unable to write {filepath}")
+
+    def grab(self, exposure):
+        "Returns a photo taken with the given exposure as a Pillow image"
+        frame = self.read(exposure)
+        return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    def close(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+
+class StubCamera:
+    """Stands in for the webcam, for testing, saving a plain grey photo, with a fault injected
+
+       "none"    works
+       "fail"    raises OSError
+       "hang"    never returns
+       "nofile"  returns without saving the photo
+       "flaky"   fails on the first photo only, as a webcam which works after a reset"""
+
+    name = "stub"
+
+    FAULTS = ("none", "fail", "hang", "nofile", "flaky")
+
+    def __init__(self, fault="none", resolution=CAMXY):
+        if fault not in self.FAULTS:
+            raise ValueError(f"Unknown fault {fault}")
+        self.fault = fault
+        self.size = tuple(int(n) for n in resolution.split("x"))
+        self.photos = 0
+
+    def grab(self, exposure):
+        "Returns a photo as a Pillow image, or fails as set by fault"
+        self.photos += 1
+        if self.fault == "fail" or (self.fault == "flaky" and self.photos == 1):
+            raise OSError("stub camera failure")
+        if self.fault == "hang":
+            threading.Event().wait()
+        # brighter with longer exposures
+        return Image.new("RGB", self.size, (min(255, exposure * 6),) * 3)
+
+    def capture(self, filepath, exposure):
+        img = self.grab(exposure)
+        if self.fault != "nofile":
+            img.save(filepath, quality=JPEG_QUALITY)
+
+    def close(self):
+        pass
+
+
+def open_backend(device=DEVICE, resolution=CAMXY):
+    "Returns an open V4L2Camera if possible, otherwise a FswebcamCamera"
+    backend = V4L2Camera(device, resolution)
+    try:
+        backend.open()
+    except OSError:
+        backend = FswebcamCamera(device, resolution)
+    return backend
+
+
+class Camera:
+    """Opens the webcam on the first capture, using V4L2Camera if possible,
+       otherwise FswebcamCamera, and keeps it until closed
+
+       Each photo has STEP_TIMEOUT seconds, if it fails or overruns, the webcam is
+       abandoned and reset, and the photo tried again up to RETRIES times.
+       factory, if given, is called to create the backend, rather than open_backend."""
+
+    def __init__(self, device=DEVICE, resolution=CAMXY, factory=None):
+        self.device = device
+        self.resolution = resolution
+        self.factory = factory or (lambda: open_backend(self.device, self.resolution))
+        self.backend = None
+        self.resets = 0
+
+    @property
+    def name(self):
+        return self.backend.name if self.backend is not None else None
+
+    def _attempt(self, method, *args):
+        """Opens the backend if need be, and calls its method, within STEP_TIMEOUT
+           Only this thread sets self.backend, and only if the call was not abandoned, so a
+           thread left running past the deadline cannot replace it later, and a backend it
+           opens after the deadline is closed"""
+        lock = threading.Lock()
+        state = {"backend":self.backend, "abandoned":False}
+        def work():
+            backend = state["backend"]
+            if backend is None:
+                backend = self.factory()
+                with lock:
+                    late = state["abandoned"]
+                    if not late:
+                        state["backend"] = backend
+                if late:
+                    backend.close()
+                    return None
+            return getattr(backend, method)(*args)
+        try:
+            return call_with_deadline(work, STEP_TIMEOUT)
+        except TimeoutError:
+            with lock:
+                state["abandoned"] = True
+            raise TimeoutError(f"camera {method} did not finish in {STEP_TIMEOUT}s")
+        finally:
+            # a backend opened in time is kept, even if the call failed, for _call to abandon
+            with lock:
+                if not state["abandoned"]:
+                    self.backend = state["backend"]
+
+    def _call(self, method, *args, check=None):
+        "Calls _attempt, resetting the webcam and trying again on failure, check is called on the result"
+        for attempt in range(RETRIES + 1):
+            try:
+                result = self._attempt(method, *args)
+                if check is not None:
+                    check()
+                return result
+            except OSError as e:
+                error = e
+            # abandon the backend, which may be hung, without closing it
+            self.backend = None
+            if attempt < RETRIES:
+                self.resets += 1
+                reset_usb(self.device)
+        raise error
+
+    def capture(self, filepath, exposure):
+        """Takes a photo with the given exposure and saves it as a JPEG to filepath
+           Returns the seconds taken, raises OSError if no photo could be taken"""
+        def written():
+            if not os.path.exists(filepath) or not os.path.getsize(filepath):
+                raise OSError(f"{filepath} was not written")
+        start = time.monotonic()
+        self._call("capture", filepath, exposure, check=written)
+        return time.monotonic() - start
+
+    def grab(self, exposure):
+        """Takes a photo with the given exposure, without saving it
+           Returns (Pillow image, seconds taken), raises OSError if no photo could be taken"""
+        start = time.monotonic()
+        img = self._call("grab", exposure)
+        return img, time.monotonic() - start
+
+    def close(self):
+        "Closes the webcam, within a deadline, in case it is wedged"
+        if self.backend is not None:
+            backend, self.backend = self.backend, None
+            try:
+                call_with_deadline(backend.close, 10)
+            except OSError:
+                pass
@@ -0,0 +1,112 @@
+"""A structured log of every wake cycle, used by power.py and altpower.py
+
+   A CycleLog gathers the timings of one wake cycle in memory, and on halt appends
+   it as a single line of JSON to the log file, so the cost on the Pi is one small
+   write per wake. The file is in the images directory, and so is copied to the
+   desktop by rsync along with the photos, where
+
+   python3 makevid/powerreport.py
+
+   summarises it by month.
+
+   Each line is a JSON object with keys
+
+   boot         - the time the Pi booted, ISO format
+   start        - seconds from boot to the script starting
+   latency      - seconds from the wakealarm to the script being ready to take a photo,
+                  see wakelatency.py, or null if the Pi was not woken by the alarm
+   captures     - a list, for each photo, of its name, exposure, seconds taken by the
+                  camera, seconds metering it (if metered), and seconds from boot
+                  when it was finished
+   held         - true if the Pi was held on, see poweroff.py
+   faults       - a list of messages, for each photo which could not be taken
+   halt         - seconds from boot to halt being requested
+   wakealarm    - epoch of the next wake up
+   temperature  - cpu temperature in degrees C, at the start and at halt
+   pmic         - the voltages and currents from the Pi 5 power management chip,
+                  as read by 'vcgencmd pmic_read_adc', or null if not available
+
+   Uptime and temperature are null if they cannot be read.
+"""
+
+import re, json, subprocess
+
+from datetime import datetime, timezone, timedelta
+
+from poweroff import uptime
+
+
+THERMAL = "/sys/class/thermal/thermal_zone0/temp"
+
+# vcgencmd output lines such as '   EXT5V_V volt(24)=5.12760000V'
+PMICLINE = re.compile(r"\s*(\S+)\s+(?:volt|current)\(\d+\)=([-\d.]+)[VA]")
+
+
+def cpu_temperature():
+    "Returns the cpu temperature in degrees C, or None if unavailable"
+    try:
+        with open(THERMAL) as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def pmic_readings():
+    """Returns a dictionary of name:value of the Pi 5 PMIC voltages and currents, for
+       example 'EXT5V_V', the input voltage, or None if they cannot be read"""
+    try:
+        result = subprocess.run(["vcgencmd", "pmic_read_adc"], capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    readings = {}
+    for line in result.stdout.splitlines():
+        match = PMICLINE.match(line)
+        if match:
+            readings[match.group(1)] = float(match.group(2))
+    return readings or None
+
+
+def _round(value, places=2):
+    return None if value is None else round(value, places)
+
+
+class CycleLog:
+
+    def __init__(self, logfile):
+        self.logfile = logfile
+        up = uptime()
+        boot = None if up is None else (datetime.now(tz=timezone.utc) - timedelta(seconds=up)).isoformat(timespec="seconds")
+        self.record = {"boot":boot, "start":_round(up), "latency":None, "captures":[], "held":False, "faults":[],
+                       "temperature":[cpu_temperature()]}
+
+    def capture(self, name, exposure, seconds, metering=None):
+        "Records a photo, with the seconds taken by the camera and by metering it"
+        self.record["captures"].append({"name":name, "exposure":exposure, "seconds":_round(seconds),
+                                        "metering":_round(metering, 3), "uptime":_round(uptime())})
+
+    def latency(self, seconds):
+        "Records the seconds from the wakealarm to the script being ready"
+        self.record["latency"] = _round(seconds)
+
+    def fault(self, message):
+        "Records a photo which could not be taken"
+        self.record["faults"].append(message)
+
+    def held(self):
+        "Records that the Pi was held on"
+        self.record["held"] = True
+
+    def write(self, wakealarm):
+        """Completes the record with the time to halt, the next wake up, temperature and
+           PMIC readings, and appends it to the log file. Returns the record"""
+        self.record["halt"] = _round(uptime())
+        self.record["wakealarm"] = wakealarm
+        self.record["temperature"].append(cpu_temperature())
+        self.record["pmic"] = pmic_readings()
+        try:
+            with open(self.logfile, "a") as f:
+                f.write(json.dumps(self.record) + "\n")
+        except OSError:
+            # the log must never stop the pi shutting down
+            pass
+        return self.record
@@ -0,0 +1,100 @@
+"""Predicts the webcam exposure for a photo from the history of previous photos
+
+   Every metered photo is recorded as a sample of (day, hour, exposure, brightness,
+   sun elevation). Taking brightness as proportional to exposure, each sample gives
+   the exposure which would have hit the brightness target then. Scaling that by the
+   ratio of the sine of the sun's elevation then and now gives an estimate for now.
+
+   The prediction is the weighted geometric mean of these estimates, where recent
+   days count most, and samples from the same hour of the day count more than others.
+
+   Samples are kept in a small JSON state file, only the last MAXAGE days being kept,
+   so it loads in a few milliseconds.
+"""
+
+import os, json, math, pathlib
+
+from datetime import timezone
+
+from solar import sun_elevation
+
+from metering import TARGET
+
+
+# Samples older than this number of days are dropped
+MAXAGE = 21
+
+# The weight of a sample halves for each HALFLIFE days of age
+HALFLIFE = 3
+
+# Weight multiplier for a sample at the same hour of day as the prediction
+SAMEHOUR = 4
+
+# Predictions are limited to this range, exposure time is 10 to 5000 on my webcam
+# but anything above MAXEXPOSURE is likely to be a mistake in the model
+MINEXPOSURE = 10
+MAXEXPOSURE = 200
+
+# Exposure used when there is no history
+DEFAULT = 10
+
+# The sine of the sun's elevation is not allowed below that of this angle in degrees,
+# since at very low sun the light is mostly diffuse and the ratio becomes meaningless
+MINELEVATION = 5
+
+
+class ExposureModel:
+
+    def __init__(self, statefile, latitude, longitude):
+        self.statefile = pathlib.Path(statefile)
+        self.latitude = latitude
+        self.longitude = longitude
+        self.samples = []
+        self.load()
+
+    def load(self):
+        "Reads samples from the state file, a missing or corrupt file gives no samples"
+        try:
+            state = json.loads(self.statefile.read_text())
+            self.samples = [tuple(s) for s in state["samples"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.samples = []
+
+    def save(self):
+        "Writes the samples to the state file, replacing it atomically"
+        tmpfile = self.statefile.with_suffix(".tmp")
+        tmpfile.write_text(json.dumps({"samples": self.samples}, separators=(",", ":")))
+        os.replace(tmpfile, self.statefile)
+
+    def _elevation_factor(self, elevation):
+        return math.sin(math.radians(max(elevation, MINELEVATION)))
+
+    def record(self, timestamp, exposure, brightness):
+        "Adds a sample of a photo taken at timestamp with this exposure and metered brightness"
+        timestamp = timestamp.astimezone(timezone.utc)
+        day = timestamp.toordinal()
+        elevation = sun_elevation(timestamp, self.latitude, self.longitude)
+        self.samples.append((day, timestamp.hour, exposure, round(brightness, 4), round(elevation, 2)))
+        self.samples = [s for s in self.samples if day - s[0] < MAXAGE]
+
+    def predict(self, timestamp):
+        "Returns the exposure predicted to give the target brightness at timestamp"
+        timestamp = timestamp.astimezone(timezone.utc)
+        day = timestamp.toordinal()
+        nowfactor = self._elevation_factor(sun_elevation(timestamp, self.latitude, self.longitude))
+        totalweight = 0.0
+        total = 0.0
+        for sday, shour, exposure, brightness, elevation in self.samples:
+            age = day - sday
+            if brightness <= 0 or age < 0 or age >= MAXAGE:
+                continue
+            weight = 0.5 ** (age / HALFLIFE)
+            if shour == timestamp.hour:
+                weight *= SAMEHOUR
+            estimate = exposure * TARGET / brightness * self._elevation_factor(elevation) / nowfactor
+            total += weight * math.log(estimate)
+            totalweight += weight
+        if not totalweight:
+            return DEFAULT
+        exposure = round(math.exp(total / totalweight))
+        return max(MINEXPOSURE, min(MAXEXPOSURE, exposure))
@@ -0,0 +1,177 @@
+"""Fault injection test of the capture deadlines and the watchdog, with a stub camera
+
+   Runs a wake cycle of altpower.py for each fault mode, in a child process, with
+   everything it writes kept in a work directory: the images, logs, a file standing
+   in for the RTC wakealarm, and a halt command which only appends the time to the
+   file 'halted'.
+   A capture window is open from now, and the webcam is a camera.StubCamera, with
+   short deadlines, so each run takes seconds.
+
+   none      the camera works
+   fail      every photo raises OSError
+   hang      every photo hangs, and is abandoned at its deadline
+   nofile    the camera returns without saving the photo
+   flaky     the first photo fails, the retry after the reset works
+   stuck     the script hangs outside the camera deadlines, so the watchdog acts
+   crash     the script dies, so the watchdog acts
+   nostate   the watchdog state cannot be written, so the script halts at once
+
+   For each mode it checks that halt happened within the budget, and that a future
+   wakealarm was written, and prints who halted, the photos taken and the faults logged.
+
+   python3 faultinject.py [--modes none,hang,..] [--budget SECONDS] [--workdir DIR]
+
+   Exits with status 1 if any mode fails its checks. Nothing on the Pi itself is
+   touched, so this is safe to run there.
+"""
+
+import os, sys, json, time, shutil, pathlib, argparse, subprocess
+
+from datetime import datetime
+
+
+MODES = ("none", "fail", "hang", "nofile", "flaky", "stuck", "crash", "nostate")
+
+# Seconds for the wake cycle of each run, and for each photo
+BUDGET = 30
+STEP_TIMEOUT = 4
+
+# Seconds the watchdog keeps back, as watchdog.MARGIN
+MARGIN = 5
+
+WORKDIR = "/tmp/timelapse-faults"
+
+
+def child(mode, workdir, budget):
+    "Runs a wake cycle of altpower.py in this process, with the fault given by mode"
+    import threading
+    import camera, poweroff, watchdog
+    import altpower
+    from cyclelog import CycleLog
+    from exposuremodel import ExposureModel
+    from wakelatency import LatencyModel
+
+    images = workdir / "images"
+    images.mkdir()
+    altpower.IMAGES = images
+    altpower.TIMINGLOG = images / "timing.log"
+    altpower.MANIFEST = images / "transfer.jsonl"
+    altpower.INDEXFILE = images / "frames.db"
+    altpower.CYCLELOG = images / "cycles.jsonl"
+    altpower.CYCLE = CycleLog(altpower.CYCLELOG)
+    altpower.MODEL = ExposureModel(images / "exposure.json", altpower.LATITUDE, altpower.LONGITUDE)
+    altpower.WATCHDOGFILE = workdir / "watchdog.json"
+    altpower.LATENCY = LatencyModel(images / "latency.json")
+    altpower.BUDGET = budget
+
+    # never held on, even if run from an ssh session
+    altpower.HOLDFILE = None
+    altpower.held = lambda holdfile: None
+
+    # a capture window open from now to the end of the day
+    now = datetime.now(tz=altpower.TIMEZONE)
+    altpower.SCHEDULE = [{"name":"test", "start":now.strftime("%H:%M"), "end":"23:59", "kind":"capture"}]
+    altpower.SITE = None
+
+    poweroff.WAKEALARM = workdir / "wakealarm"
+    poweroff.HALT = [sys.executable, "-c", "import sys, time; open(sys.argv[1], 'a').write(f'{time.time()}\\n')",
+                     str(workdir / "halted")]
+    watchdog.MARGIN = MARGIN
+    camera.STEP_TIMEOUT = STEP_TIMEOUT
+    camera.RESET_WAIT = 1
+
+    # one stub, so that it counts photos across the resets
+    stub = camera.StubCamera(mode if mode in camera.StubCamera.FAULTS else "none")
+    altpower.CAMERA = camera.Camera("/dev/no-such-video", altpower.CAMXY, factory=lambda: stub)
+
+    if mode == "stuck":
+        # stands in for a driver call which never returns, and cannot be abandoned
+        altpower.takephoto = lambda timestamp: threading.Event().wait()
+    elif mode == "crash":
+        altpower.takephoto = lambda timestamp: os._exit(1)
+    elif mode == "nostate":
+        # as a full disk, the directory of the state file does not exist
+        altpower.WATCHDOGFILE = workdir / "missing" / "watchdog.json"
+
+    altpower.main()
+
+
+def read_lines(filepath):
+    try:
+        return filepath.read_text().splitlines()
+    except OSError:
+        return []
+
+
+def run_mode(mode, workdir, budget):
+    "Runs one mode in a child process, returns a dictionary of its results"
+    shutil.rmtree(workdir, ignore_errors=True)
+    workdir.mkdir(parents=True)
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, __file__, "--child", mode, "--workdir", str(workdir), "--budget", str(budget)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        stderr = proc.communicate(timeout=budget + 30)[1]
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        stderr = proc.communicate()[1]
+
+    result = {"mode":mode, "returncode":proc.returncode, "halt":None, "wakealarm":None, "by":None,
+              "photos":0, "faults":[], "stderr":stderr.strip()}
+    halts = read_lines(workdir / "halted")
+    if halts:
+        # the first halt, the watchdog halts again if the script's halt did not power off
+        result["halt"] = float(halts[0]) - start
+    try:
+        result["wakealarm"] = int((workdir / "wakealarm").read_text())
+    except (OSError, ValueError):
+        pass
+    images = workdir / "images"
+    timing = read_lines(images / "timing.log")
+    # the script logs its halt before halting
+    result["by"] = "script" if any(" halt, wakealarm " in line for line in timing) else "watchdog"
+    result["photos"] = len(list(images.glob("image_*.jpeg")))
+    for line in read_lines(images / "cycles.jsonl"):
+        result["faults"] += json.loads(line).get("faults", [])
+
+    # the halt command here does not halt, so end the watchdog, which would otherwise try again
+    try:
+        os.remove(workdir / "watchdog.json")
+    except FileNotFoundError:
+        pass
+
+    result["ok"] = result["halt"] is not None and result["halt"] <= budget and (result["wakealarm"] or 0) > time.time()
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fault injection test of the capture deadlines and watchdog")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"comma separated, from {','.join(MODES)}")
+    parser.add_argument("--budget", type=int, default=BUDGET, help="seconds for each wake cycle")
+    parser.add_argument("--workdir", default=WORKDIR)
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    workdir = pathlib.Path(args.workdir)
+
+    if args.child:
+        child(args.child, workdir, args.budget)
+        sys.exit(0)
+
+    modes = [m for m in args.modes.split(",") if m]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode}")
+
+    failed = 0
+    print(f"{'mode':8} {'ok':4} {'halt s':>6} {'by':8} {'photos':>6}  faults")
+    for mode in modes:
+        r = run_mode(mode, workdir / mode, args.budget)
+        halt = "-" if r["halt"] is None else f"{r['halt']:.1f}"
+        print(f"{mode:8} {'yes' if r['ok'] else 'NO':4} {halt:>6} {r['by']:8} {r['photos']:>6}  {'; '.join(r['faults'])}")
+        if not r["ok"]:
+            failed += 1
+            if r["stderr"]:
+                print(r["stderr"])
+    sys.exit(1 if failed else 0)
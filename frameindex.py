@@ -0,0 +1,255 @@
+"""A small SQLite index of the photos in the images directory
+
+   altpower.py records each photo as it is taken, with the exposure used and its
+   metered statistics. The index file lives in the images directory, so it is copied
+   to the desktop by rsync along with the photos, or by makevid/pull.py, which merges
+   its entries into the index there, see FrameIndex.merge, where
+
+   python3 frameindex.py [imagedir]
+
+   adds any photos not yet in it, or changed since they were indexed, metering them
+   with a reduced scale decode. The desktop tools can then select frames with a query
+   rather than listing the directory and decoding every image.
+
+   Filenames are parsed as
+
+   image_YYYYMMDDHH.jpeg               kind 'frame'
+   image_YYYYMMDDHH_orig.jpeg          kind 'orig', the first photo when a retake was needed
+   image_YYYYMMDDHH_eNN_thumb.jpeg     kind 'thumb', a rejected bracket exposure NN
+   image_YYYYMMDDHH_preview.jpeg       kind 'preview', a reduced copy kept in place of a frame, see storage.py
+
+   Requires pillow for metering, sqlite3 is part of the Python standard library
+"""
+
+import os, re, sys, json, sqlite3, hashlib, pathlib
+
+from datetime import datetime, timezone
+
+from metering import file_stats, TARGET, TESTX, TESTY
+
+
+# Name of the index file within the images directory
+INDEXNAME = "frames.db"
+
+NAMEPATTERN = re.compile(r"image_(\d{10})(?:(_orig)|_e(\d+)_thumb|(_preview))?\.jpeg$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    name TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    day TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    exposure INTEGER,
+    brightness REAL,
+    mean REAL,
+    p5 REAL,
+    p50 REAL,
+    p95 REAL,
+    clipped REAL,
+    retake INTEGER NOT NULL DEFAULT 0,
+    size INTEGER,
+    mtime REAL,
+    sha1 TEXT
+);
+CREATE INDEX IF NOT EXISTS frames_day ON frames (day, hour);
+"""
+
+
+def parse_name(name):
+    """Returns (timestamp, kind, exposure) parsed from an image filename, exposure is
+       only known from the name of a thumbnail, returns None if the name does not match"""
+    match = NAMEPATTERN.match(name)
+    if match is None:
+        return None
+    timestamp = datetime.strptime(match.group(1), "%Y%m%d%H").replace(tzinfo=timezone.utc)
+    if match.group(2):
+        return timestamp, "orig", None
+    if match.group(3):
+        return timestamp, "thumb", int(match.group(3))
+    if match.group(4):
+        return timestamp, "preview", None
+    return timestamp, "frame", None
+
+
+def file_sha1(filepath):
+    "Returns the sha1 hex digest of the file contents"
+    h = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_signature(filepath, previous=None):
+    """Returns a dictionary of the size, mtime and sha1 of the file at filepath. If previous, such
+       a dictionary recorded earlier, has the same size and modification time, its sha1 is used,
+       so a file is only read and hashed if it may have changed"""
+    stat = os.stat(filepath)
+    if (isinstance(previous, dict) and previous.get("sha1") and previous.get("size") == stat.st_size
+            and previous.get("mtime") == stat.st_mtime):
+        sha1 = previous["sha1"]
+    else:
+        sha1 = file_sha1(filepath)
+    return {"size":stat.st_size, "mtime":stat.st_mtime, "sha1":sha1}
+
+
+def unchanged(signature, previous):
+    "Returns True if previous, a dictionary recorded earlier, has the sha1 of signature, from file_signature"
+    return isinstance(previous, dict) and previous.get("sha1") == signature["sha1"]
+
+
+def load_json(filepath, default=None):
+    "Returns the contents of the JSON file filepath, or default, an empty dictionary if None, if it is missing or corrupt"
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {} if default is None else default
+
+
+def save_json(filepath, data):
+    "Writes data to the JSON file filepath, replacing any previous file atomically"
+    tmpname = str(filepath) + ".tmp"
+    with open(tmpname, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmpname, filepath)
+
+
+def row_stats(row):
+    "Returns the metered statistics of an index row, as a dictionary in the form given by metering.file_stats"
+    return {"brightness":row["brightness"], "mean":row["mean"], "clipped":row["clipped"],
+            "percentiles":{5:row["p5"], 50:row["p50"], 95:row["p95"]}}
+
+
+class FrameIndex:
+
+    def __init__(self, dbfile):
+        self.dbfile = str(dbfile)
+        self.conn = sqlite3.connect(self.dbfile)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, filepath, exposure=None, stats=None, retake=False, sha1=None):
+        """Adds or replaces the entry for the photo at filepath, stats is a dictionary
+           from metering.file_stats, if None the photo is metered here"""
+        filepath = pathlib.Path(filepath)
+        parsed = parse_name(filepath.name)
+        if parsed is None:
+            raise ValueError(f"{filepath.name} is not a timelapse image name")
+        timestamp, kind, nameexposure = parsed
+        if exposure is None:
+            exposure = nameexposure
+        if stats is None:
+            # thumbnails and previews are too small to hold the test point, so are not metered
+            stats = {} if kind in ("thumb", "preview") else file_stats(filepath, TESTX, TESTY)
+        stat = filepath.stat()
+        percentiles = stats.get("percentiles", {})
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                              (filepath.name, timestamp.isoformat(), timestamp.strftime("%Y%m%d"), timestamp.hour,
+                               kind, exposure, stats.get("brightness"), stats.get("mean"),
+                               percentiles.get(5), percentiles.get(50), percentiles.get(95), stats.get("clipped"),
+                               int(retake), stat.st_size, stat.st_mtime, sha1 or file_sha1(filepath)))
+
+    def update(self, imagedir):
+        """Adds any images in imagedir which are not indexed, or whose size or modification
+           time differ from those indexed, keeping any exposure already recorded.
+           Removes entries whose files no longer exist. Returns the number of images added"""
+        imagedir = pathlib.Path(imagedir)
+        known = {row["name"]:row for row in self.conn.execute("SELECT name, size, mtime, exposure, retake FROM frames")}
+        present = set()
+        added = 0
+        for name in sorted(os.listdir(imagedir)):
+            if parse_name(name) is None:
+                continue
+            present.add(name)
+            filepath = imagedir / name
+            stat = filepath.stat()
+            row = known.get(name)
+            if row is not None and row["size"] == stat.st_size and row["mtime"] == stat.st_mtime:
+                continue
+            try:
+                if row is None:
+                    # a retake is shown by the presence of the _orig photo
+                    retake = parse_name(name)[1] == "frame" and (imagedir / name.replace(".jpeg", "_orig.jpeg")).exists()
+                    self.record(filepath, retake=retake)
+                else:
+                    self.record(filepath, exposure=row["exposure"], retake=row["retake"])
+            except (OSError, ValueError) as e:
+                print(f"Unable to index {name}: {e}")
+                continue
+            added += 1
+        with self.conn:
+            self.conn.executemany("DELETE FROM frames WHERE name = ?", [(name,) for name in known if name not in present])
+        return added
+
+    def merge(self, dbfile, imagedir):
+        """Copies in the entries of another index, such as the one made on the Pi, for the photos in
+           imagedir whose size and modification time match those in it, so they need not be metered
+           again here, and the exposures recorded when they were taken are kept.
+           Returns the number of entries copied"""
+        imagedir = pathlib.Path(imagedir)
+        known = {row["name"]:row for row in self.conn.execute("SELECT name, size, mtime, sha1 FROM frames")}
+        other = sqlite3.connect(str(dbfile))
+        other.row_factory = sqlite3.Row
+        try:
+            rows = other.execute("SELECT * FROM frames").fetchall()
+        finally:
+            other.close()
+        merged = []
+        for row in rows:
+            try:
+                stat = (imagedir / row["name"]).stat()
+            except OSError:
+                continue
+            if row["size"] != stat.st_size or row["mtime"] != stat.st_mtime:
+                continue
+            current = known.get(row["name"])
+            if current is not None and tuple(current) == (row["name"], row["size"], row["mtime"], row["sha1"]):
+                continue
+            merged.append(tuple(row))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", merged)
+        return len(merged)
+
+    def query(self, sql, params=()):
+        "Returns a list of rows, each an sqlite3.Row, from an SQL query on the frames table"
+        return self.conn.execute(sql, params).fetchall()
+
+    def best_per_day(self, hours=None, minbrightness=None, target=TARGET):
+        """Returns a list of rows, one per day in date order, for the frame whose brightness
+           is closest to target, optionally only from the given hours, and only frames
+           brighter than minbrightness"""
+        conditions = ["kind = 'frame'", "brightness IS NOT NULL"]
+        params = [target]
+        if hours is not None:
+            conditions.append(f"hour IN ({','.join('?' * len(hours))})")
+            params.extend(hours)
+        if minbrightness is not None:
+            conditions.append("brightness > ?")
+            params.append(minbrightness)
+        sql = f"""SELECT * FROM (
+                      SELECT *, ROW_NUMBER() OVER (PARTITION BY day ORDER BY ABS(brightness - ?), hour) AS rank
+                      FROM frames WHERE {' AND '.join(conditions)})
+                  WHERE rank = 1 ORDER BY day"""
+        return self.query(sql, params)
+
+
+if __name__ == "__main__":
+
+    imagedir = pathlib.Path(sys.argv[1]) if len(sys.argv) > 1 else pathlib.Path("images")
+
+    with FrameIndex(imagedir / INDEXNAME) as index:
+        added = index.update(imagedir)
+        total = index.query("SELECT COUNT(*) FROM frames")[0][0]
+    print(f"{added} images indexed, {total} in the index")
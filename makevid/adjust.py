@@ -1,55 +1,73 @@
-
 """Gets images from /home/bernard/git/timelapse/images
    copies just the mid-day images to /home/bernard/git/timelapse/images2
    at the same time adjusting the brightness of those which are too dark.
 
-   Requires environment with pillow"""
+   The images are processed in parallel, one per cpu core, and a manifest is kept
+   in the output directory recording the hash of each source image and the
+   parameters used, so a re-run only processes new or changed images.
+
+   Usage:
+
+   python3 adjust.py [--pathin DIR] [--pathout DIR] [--workers N] [--force] [--index] [--best] [--fuse] [--preview [4|8]]
+
+   With --index, the mid-day images are selected from the frame index in pathin
+   (see frameindex.py), which is first brought up to date, rather than by listing
+   the directory.
+
+   With --best, the best photo of each day, of any hour, is chosen by bestframe.py
+   rather than the mid-day one. An output image replaced by another of the same
+   day is removed, so pathout always holds one image per day.
 
-import os, shutil
+   With --fuse, an image with an _orig photo is taken from the fusion of the pair,
+   see fuse.py, rather than from the retake alone. This is ignored with --preview.
+
+   With --preview, the images are taken from the cached 1/4 (or 1/8) size proxies of
+   pathin, see proxy.py, and written to pathout with _preview appended, from where
+   makevid.py --preview makes a preview film.
+
+   Requires environment with pillow, and metering.py from the parent directory"""
+
+import os, shutil, argparse
+
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 from PIL import Image
 
+import sharedpath
 
-def get_range(x,y):
-    "Return a range of x,y values around the given x,y"
-    for xx in range(x-20, x+20):
-        for yy in range(y-20, y+20):
-            yield (xx,yy)
+from metering import file_brightness, get_brightness, TESTX, TESTY
+from frameindex import FrameIndex, INDEXNAME, file_signature, unchanged, load_json, save_json
 
+from proxy import proxies
 
-def get_brightness(img, x, y):
-    """Returns a value between 0.0 and 1.0, where 1.0 is max brightness
-       This is tested around the given x, y point of the image"""
 
-    # Note standard brightness measurements weigh R,G,B differently
-    # in particular green is emphasised, but since I am simply comparing
-    # two brightness levels I have not bothered
+# (brightness below which, gamma applied), checked in turn, brighter images are copied unchanged
+GAMMAS = ((0.1, 0.4), (0.3, 0.6))
 
-    # its also a bit unknown to me what effect snow would have, so I'm keeping
-    # it simple
+# Everything which affects the output, if this changes, all images are processed again
+PARAMS = {"testx":TESTX, "testy":TESTY, "gammas":[list(g) for g in GAMMAS]}
 
-    brightness = 0
-    maxb = 0
-    # get a range of x,y values around (x,y)
-    for p in get_range(x, y):
-        red, green, blue = img.getpixel(p)
-        brightness += red+green+blue
-        maxb += 255+255+255
-    return brightness / maxb
+# Name of the manifest file kept in the output directory
+MANIFEST = "adjust_manifest.json"
 
+# Proxy scale used by --preview, and the suffix of its output directory
+PREVIEWSCALE = 4
+PREVIEWSUFFIX = "_preview"
+
+
+@lru_cache
+def gamma_lut(gamma):
+    """Returns a lookup table (LUT) to map old pixel values to new ones for a single band,
+       This prevents expensive per-pixel loops in Python"""
+    return [int(((i / 255.0) ** gamma) * 255) for i in range(256)]
+
+
+def apply_gamma(img, gamma):
+    """Returns a gamma corrected copy of a Pillow image
+       gamma < 1.0 brightens the image. gamma = 1.0 is unchanged."""
+    lut = gamma_lut(gamma)
 
-def adjust_brightness_gamma(image_path, gamma=0.6, output_path="gamma_corrected.jpg"):
-    """
-    Brightens midtones and shadows while protecting highlights using gamma correction.
-    gamma < 1.0 brightens the image. gamma = 1.0 is unchanged.
-    """
-    # Open image and convert to RGB
-    img = Image.open(image_path).convert("RGB")
-    
-    # Create a lookup table (LUT) to map old pixel values to new ones
-    # This prevents expensive per-pixel loops in Python
-    lut = [int(((i / 255.0) ** gamma) * 255) for i in range(256)]
-    
     # Apply the LUT to all bands (R, G, B) of the image
     # If your image has an alpha channel (RGBA), only apply to the first 3 channels
     if img.mode == "RGBA":
@@ -57,44 +75,160 @@ def adjust_brightness_gamma(image_path, gamma=0.6, output_path="gamma_corrected.
         r = r.point(lut)
         g = g.point(lut)
         b = b.point(lut)
-        bright_img = Image.merge("RGBA", (r, g, b, a))
-    else:
-        bright_img = img.point(lut * 3)
-        
-    bright_img.save(output_path)
+        return Image.merge("RGBA", (r, g, b, a))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img.point(lut * 3)
 
 
-if __name__ == "__main__":
+def adjust_brightness_gamma(image_path, gamma=0.6, output_path="gamma_corrected.jpg"):
+    """
+    Brightens midtones and shadows while protecting highlights using gamma correction.
+    gamma < 1.0 brightens the image. gamma = 1.0 is unchanged.
+    """
+    # Open image and convert to RGB
+    with Image.open(image_path) as img:
+        apply_gamma(img.convert("RGB"), gamma).save(output_path)
 
-    # point on image where brightness is measured
 
-    TESTX = 3500
-    TESTY = 2500
+def choose_gamma(b):
+    "Given the brightness of an image, returns the gamma to apply, or None if it is to be left unchanged"
+    for limit, gamma in GAMMAS:
+        if b<limit:
+            return gamma
 
-    pathin = "/home/bernard/git/timelapse/images"
-    pathout = "/home/bernard/git/timelapse/images2"
 
-    # get list of images ending with 12 just to get the mid - day shots
-    images = [img for img in os.listdir(pathin) if img.endswith("12.jpeg")]
+def process_image(infile, outfile, scale=1):
+    """Copies infile to outfile, adjusting its brightness if it is too dark
 
+       The brightness is measured from a reduced scale decode, so the full
+       image is only decoded once, and only if it needs adjusting.
+       If infile is a proxy, scale is its reduction from the original photo.
+       Returns the gamma applied, or None if the file was copied unchanged"""
+    if scale == 1:
+        b = file_brightness(infile, TESTX, TESTY)
+    else:
+        with Image.open(infile) as img:
+            b = get_brightness(img, TESTX, TESTY, scale)
+    gamma = choose_gamma(b)
+    if gamma is None:
+        shutil.copyfile(infile, outfile)
+    else:
+        adjust_brightness_gamma(infile, gamma=gamma, output_path=outfile)
+    return gamma
+
+
+def _work(job):
+    """Run in a worker process, job is (image, infile, outfile, signature, scale)
+       returns (image, manifest entry, gamma) or (image, None, error message) on failure"""
+    image, infile, outfile, signature, scale = job
+    try:
+        gamma = process_image(infile, outfile, scale)
+    except (OSError, ValueError) as e:
+        return image, None, str(e)
+    return image, dict(signature, params=PARAMS), gamma
+
+
+def needs_processing(entry, infile, outfile):
+    """Given the manifest entry for an image, returns (True, signature) if it must be processed,
+       or (False, signature) if its output is up to date, signature from frameindex.file_signature.
+       The source is only hashed if its size or modification time differ from those recorded."""
+    signature = file_signature(infile, entry)
+    if not os.path.exists(outfile) or entry is None or entry.get("params") != PARAMS:
+        return True, signature
+    return not unchanged(signature, entry), signature
+
+
+def indexed_images(pathin, hours=(12,)):
+    "Brings the frame index in pathin up to date, and returns the names of its frames taken at the given hours"
+    with FrameIndex(os.path.join(pathin, INDEXNAME)) as index:
+        index.update(pathin)
+        rows = index.query(f"SELECT name FROM frames WHERE kind = 'frame' AND hour IN ({','.join('?' * len(hours))}) ORDER BY name", hours)
+    return [row["name"] for row in rows]
+
+
+def adjust_all(pathin, pathout, workers=None, force=False, images=None, scale=1, fuse=False):
+    """Processes the mid-day images in pathin to pathout, skipping any unchanged since the last run
+       images is a list of filenames in pathin, if None, the mid-day images are listed from pathin
+       If scale is above 1, their proxies at that scale are processed instead.
+       If fuse is True, and scale is 1, images with an _orig photo are taken from the fused pair.
+       Returns the number of images processed"""
+
+    os.makedirs(pathout, exist_ok=True)
+    manifestfile = os.path.join(pathout, MANIFEST)
+    manifest = {} if force else load_json(manifestfile)
+
+    if images is None:
+        # get list of images ending with 12 just to get the mid - day shots
+        images = sorted(img for img in os.listdir(pathin) if img.endswith("12.jpeg"))
+
+    fused = {}
+    if scale > 1:
+        pathin = proxies(pathin, images, scale, workers)
+    elif fuse:
+        # imported only when needed, as fuse.py requires opencv-python
+        from fuse import fuse_all
+        fused = fuse_all(pathin, workers=workers, frames={image.replace("_orig", "") for image in images})
+
+    jobs = []
     for image in images:
-
-        infile = os.path.join(pathin, image)
+        infile = fused.get(image.replace("_orig", ""), os.path.join(pathin, image))
         outfile = os.path.join(pathout, image)
-
-        # Open Image with Pillow, and check brightness
-        with Image.open(infile) as img:
-            b = get_brightness(img, TESTX, TESTY)
-            if b<0.1:
-                adjust_brightness_gamma(infile, gamma=0.4, output_path=outfile)
-                print(f"adjusting {image} with gamma 0.4")
-            elif b<0.3:
-                adjust_brightness_gamma(infile, gamma=0.6, output_path=outfile)
-                print(f"adjusting {image} with gamma 0.6")
-            else:
-                shutil.copyfile(infile, outfile)
+        process, signature = needs_processing(manifest.get(image), infile, outfile)
+        if process:
+            jobs.append((image, infile, outfile, signature, scale))
+        else:
+            # unchanged content, but record the current size and time so it is not hashed again
+            manifest[image].update(signature)
+
+    # an image replaced by another of the same day, such as a newly chosen best frame, is removed
+    days = {image[:14] for image in images}
+    for image in [name for name in manifest if name not in images and name[:14] in days]:
+        del manifest[image]
+        if os.path.exists(os.path.join(pathout, image)):
+            os.remove(os.path.join(pathout, image))
+            print(f"removed {image}")
+
+    print(f"{len(images)} mid-day images, {len(jobs)} to process")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for count, (image, entry, gamma) in enumerate(executor.map(_work, jobs, chunksize=4), start=1):
+            if entry is None:
+                # gamma holds the error message, the image is left out of the manifest to be retried
+                print(f"failed {image}: {gamma}")
+                continue
+            manifest[image] = entry
+            if gamma is not None:
+                print(f"adjusting {image} with gamma {gamma}")
             print(image)
-            
+            # save the manifest now and then, so an interrupted run keeps its progress
+            if not count % 50:
+                save_json(manifestfile, manifest)
 
+    save_json(manifestfile, manifest)
+    return len(jobs)
 
-    
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Copy and brighten the mid-day images")
+    parser.add_argument("--pathin", default="/home/bernard/git/timelapse/images")
+    parser.add_argument("--pathout", default="/home/bernard/git/timelapse/images2")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default one per cpu")
+    parser.add_argument("--force", action="store_true", help="ignore the manifest and process every image")
+    parser.add_argument("--index", action="store_true", help="select the images from the frame index")
+    parser.add_argument("--best", action="store_true", help="select the best image of each day, see bestframe.py")
+    parser.add_argument("--fuse", action="store_true", help="fuse _orig and retake pairs, see fuse.py")
+    parser.add_argument("--preview", type=int, nargs="?", const=PREVIEWSCALE, choices=(4, 8),
+                        help="process reduced size proxies, into pathout with _preview appended")
+    args = parser.parse_args()
+
+    images = indexed_images(args.pathin) if args.index else None
+    if args.best:
+        # imported only when needed, as bestframe.py requires opencv-python
+        from bestframe import best_frames
+        images = best_frames(args.pathin, args.workers)
+    if args.preview:
+        adjust_all(args.pathin, args.pathout.rstrip("/") + PREVIEWSUFFIX, args.workers, args.force, images, args.preview)
+    else:
+        adjust_all(args.pathin, args.pathout, args.workers, args.force, images, fuse=args.fuse)
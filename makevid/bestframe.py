@@ -0,0 +1,234 @@
+"""Chooses the best photo of each day, for the film
+
+   Rather than always taking the 12 o'clock photo, every photo of a day, of any
+   hour, and the _orig photos of a retake, is a candidate, and is scored on
+
+   sharpness    - the variance of the Laplacian, relative to the variance of the
+                  image, so that it does not favour brighter exposures, and relative
+                  to the sharpest candidate of the day, rain or mist on the lens
+                  blurs the image
+   exposure     - metering.exposure_score of the test patch, how near the target
+                  brightness it is
+   clipped      - the fraction of the whole image at or above metering.CLIP
+   similarity   - the correlation of a small grayscale signature of the image with
+                  the mean signature of the photos of NEIGHBOURS days either side,
+                  a frame of fog, or of a different view, stands out in the film
+   hour         - a small penalty for each hour from PREFERHOUR, so the light is
+                  consistent when the photos are otherwise equal
+
+   The features are measured once for each photo, on a 1/SCALE reduced scale decode,
+   in parallel, one process per cpu core, and kept in a JSON cache file in the image
+   directory with the size, modification time and sha1 of each photo, so only newly
+   arrived or changed photos are measured. Choosing from the cached features takes a fraction of a second.
+
+   Only full size photos are candidates. The storage policy of altpower.py, see
+   storage.py, by default keeps one frame of each day at full size and replaces the
+   others by previews, so then there is only that one to choose. To choose among
+   every hour, set KEEPHOURS in altpower.py to None, so all frames are kept at full size.
+
+   python3 bestframe.py [--path DIR] [--workers N]
+
+   prints the photo chosen for each day, and its score. adjust.py --best and
+   film.py --best use the chosen photos rather than the 12 o'clock ones.
+
+   Requires environment with pillow, numpy and opencv-python, and metering.py and
+   frameindex.py from the parent directory
+"""
+
+import os, argparse
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import sharedpath
+
+from metering import open_reduced, get_stats, exposure_score, CLIP, EQUAL, TESTX, TESTY
+from frameindex import parse_name, file_signature, unchanged, load_json, save_json
+
+
+# Reduction of the decode on which features are measured
+SCALE = 8
+
+# Size of the grayscale signature compared between days
+SIGNATURE = (32, 24)
+
+# Days either side whose photos a candidate is compared with
+NEIGHBOURS = 3
+
+# The hour preferred, and the score lost for each hour from it
+PREFERHOUR = 12
+HOURWEIGHT = 0.02
+
+# Weights of the features in the score
+SHARPWEIGHT = 0.2
+EXPOSUREWEIGHT = 1.0
+CLIPWEIGHT = 1.0
+SIMILARWEIGHT = 0.3
+
+# Everything which affects the cached features, if this changes, all photos are measured again
+PARAMS = {"scale":SCALE, "signature":list(SIGNATURE), "testx":TESTX, "testy":TESTY, "clip":CLIP, "weights":"equal"}
+
+# Name of the cache file kept in the image directory
+CACHE = "bestframe.json"
+
+
+def candidates(path):
+    """Returns a dictionary of day 'YYYYMMDD':list of the photos in path which could be that day's frame,
+       the frames and _orig photos, previews left by storage.py are not candidates"""
+    days = defaultdict(list)
+    for name in sorted(os.listdir(path)):
+        parsed = parse_name(name)
+        if parsed is not None and parsed[1] in ("frame", "orig"):
+            days[parsed[0].strftime("%Y%m%d")].append(name)
+    return dict(sorted(days.items()))
+
+
+def measure(filename):
+    "Returns a dictionary of the quality features of the image file"
+    img, factor = open_reduced(filename, SCALE)
+    with img:
+        img = img.convert("RGB")
+    # with equal weights, as metering.TARGET is defined on them
+    stats = get_stats(img, [(TESTX, TESTY)], weights=EQUAL, scale=factor)
+    gray = np.asarray(img.convert("L"), dtype=np.float32)
+    variance = float(gray.var())
+    laplacian = float(cv2.Laplacian(gray, cv2.CV_32F).var())
+    signature = cv2.resize(gray, SIGNATURE, interpolation=cv2.INTER_AREA).ravel()
+    signature = (signature - signature.mean()) / (signature.std() or 1.0)
+    return {"sharpness":laplacian / variance if variance else 0.0,
+            "exposure":exposure_score(stats),
+            "clipped":float((gray >= CLIP).mean()),
+            "signature":[round(float(v), 3) for v in signature]}
+
+
+def _work(job):
+    """Run in a worker process, job is (name, filename, signature)
+       returns (name, features) or (name, error message) on failure"""
+    name, filename, signature = job
+    try:
+        features = measure(filename)
+    except (OSError, ValueError, cv2.error) as e:
+        return name, str(e)
+    features.update(signature)
+    return name, features
+
+
+def load_cache(cachefile):
+    "Returns the cached features, a dictionary of name:features, empty if there are none or the parameters have changed"
+    cache = load_json(cachefile)
+    if cache.get("params") != PARAMS:
+        return {}
+    return cache["frames"]
+
+
+def save_cache(cachefile, frames):
+    "Writes the cache, replacing any previous one atomically"
+    save_json(cachefile, {"params":PARAMS, "frames":frames})
+
+
+def update_features(path, names, cachefile=None, workers=None):
+    """Measures any of the photos names in path not in the cache, or changed since,
+       returns the dictionary of name:features of those which could be measured"""
+    if cachefile is None:
+        cachefile = os.path.join(path, CACHE)
+    frames = load_cache(cachefile)
+
+    jobs = []
+    touched = False
+    for name in names:
+        entry = frames.get(name)
+        signature = file_signature(os.path.join(path, name), entry)
+        if not unchanged(signature, entry):
+            jobs.append((name, os.path.join(path, name), signature))
+        elif signature["mtime"] != entry["mtime"]:
+            # same contents, record the current time so it is not hashed again
+            entry.update(signature)
+            touched = True
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for name, features in executor.map(_work, jobs, chunksize=4):
+                if isinstance(features, str):
+                    print(f"Unable to measure {name}: {features}")
+                    frames.pop(name, None)
+                else:
+                    frames[name] = features
+        print(f"{len(jobs)} photos measured")
+
+    # drop photos which have gone
+    present = set(names)
+    gone = [name for name in frames if name not in present]
+    for name in gone:
+        del frames[name]
+    if jobs or gone or touched:
+        save_cache(cachefile, frames)
+    return frames
+
+
+def similarity(signature, reference):
+    "Returns the correlation, -1.0 to 1.0, of two standardised signatures"
+    norm = np.linalg.norm(signature) * np.linalg.norm(reference)
+    return float(np.dot(signature, reference) / norm) if norm else 0.0
+
+
+def choose(days, frames):
+    """Given a dictionary of day:candidate names, and of name:features, returns a dictionary
+       of day:(name, score, components) for the best candidate of each day which has been measured"""
+    order = list(days)
+    signatures = {name:np.array(features["signature"], dtype=np.float32) for name, features in frames.items()}
+
+    # mean signature of each day, for comparison with its neighbours
+    daymeans = {}
+    for day in order:
+        sigs = [signatures[name] for name in days[day] if name in signatures]
+        if sigs:
+            daymeans[day] = np.mean(sigs, axis=0)
+
+    chosen = {}
+    for position, day in enumerate(order):
+        measured = [name for name in days[day] if name in frames]
+        if not measured:
+            continue
+        neighbours = [daymeans[d] for d in order[max(0, position - NEIGHBOURS):position + NEIGHBOURS + 1]
+                      if d != day and d in daymeans]
+        reference = np.mean(neighbours, axis=0) if neighbours else None
+        sharpest = max(frames[name]["sharpness"] for name in measured) or 1.0
+        best = None
+        for name in measured:
+            features = frames[name]
+            components = {"sharpness":features["sharpness"] / sharpest,
+                          "exposure":features["exposure"],
+                          "clipped":features["clipped"],
+                          "similarity":similarity(signatures[name], reference) if reference is not None else 0.0,
+                          "hour":abs(parse_name(name)[0].hour - PREFERHOUR)}
+            score = (SHARPWEIGHT * components["sharpness"] + EXPOSUREWEIGHT * components["exposure"]
+                     - CLIPWEIGHT * components["clipped"] + SIMILARWEIGHT * components["similarity"]
+                     - HOURWEIGHT * components["hour"])
+            if best is None or score > best[1]:
+                best = (name, score, components)
+        chosen[day] = best
+    return chosen
+
+
+def best_frames(path, workers=None, cachefile=None):
+    "Returns the names of the best photo of each day in path, in date order"
+    days = candidates(path)
+    frames = update_features(path, [name for names in days.values() for name in names], cachefile, workers)
+    return [name for name, score, components in choose(days, frames).values()]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Choose the best photo of each day")
+    parser.add_argument("--path", default="/home/bernard/git/timelapse/images")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default one per cpu")
+    args = parser.parse_args()
+
+    days = candidates(args.path)
+    frames = update_features(args.path, [name for names in days.values() for name in names], workers=args.workers)
+    for day, (name, score, c) in choose(days, frames).items():
+        print(f"{day} {name:28} {score:6.3f}  sharp {c['sharpness']:.2f} exposure {c['exposure']:.3f} "
+              f"clipped {c['clipped']:.3f} similar {c['similarity']:.2f} of {len(days[day])}")
@@ -0,0 +1,132 @@
+"""Temporal deflicker for the film
+
+   The overall brightness of consecutive days varies, which flickers in the film.
+   This measures the mean luminance of every frame once, from a 1/8 scale decode,
+   and smooths the sequence of means with a centred moving average (in log terms)
+   over WINDOW frames either side, to give a target curve. Each frame is then given
+   the gamma which moves its mean onto the curve, applied as a lookup table.
+
+   The statistics and the curve are kept in a small JSON cache file. A frame is only
+   measured again if its contents change, hashed only if its size or modification
+   time change, and since a target only
+   depends on the frames within WINDOW of it, appending new days only recalculates
+   the targets of the last WINDOW frames and of the new ones.
+
+   Requires environment with pillow, and metering.py from the parent directory
+"""
+
+import os, math
+
+from concurrent.futures import ThreadPoolExecutor
+
+import sharedpath
+
+from metering import open_reduced, histogram_stats, LUMA
+from frameindex import file_signature, unchanged, load_json, save_json
+
+
+# Frames either side of each frame included in its target
+WINDOW = 7
+
+# 1.0 moves every frame fully onto the target curve, 0.0 leaves them unchanged
+STRENGTH = 0.8
+
+# Limits on the gamma applied, so a very dark or bright day is not distorted
+MINGAMMA = 0.3
+MAXGAMMA = 1.5
+
+# Gammas are rounded to this many decimal places, so lookup tables can be shared
+GAMMAPLACES = 2
+
+PARAMS = {"window":WINDOW, "strength":STRENGTH}
+
+
+def frame_luminance(infile):
+    "Returns the mean luma, 0.0 to 1.0, of the whole image, measured from a 1/8 scale decode"
+    img, factor = open_reduced(infile, 8)
+    with img:
+        band = img.convert("RGB").convert("L", matrix=LUMA + (0,))
+        return histogram_stats(band.histogram(), ())["mean"]
+
+
+def load_cache(cachefile):
+    "Returns the cache dictionary, empty if there is none or its parameters have changed"
+    cache = load_json(cachefile, {"stats":{}, "order":[], "means":[], "targets":[]})
+    if cache.get("params") != PARAMS:
+        # the statistics are still valid, but the curve must be recalculated
+        cache["order"], cache["means"], cache["targets"] = [], [], []
+    return cache
+
+
+def save_cache(cachefile, cache):
+    "Writes the cache, replacing any previous one atomically"
+    cache["params"] = PARAMS
+    save_json(cachefile, cache)
+
+
+def update_stats(path, images, stats, workers=None):
+    """Measures any of images in path which are not in stats, or whose file has changed,
+       stats is a dictionary of image:{"size", "mtime", "sha1", "mean"} which is updated in place"""
+    todo = []
+    for image in images:
+        entry = stats.get(image)
+        signature = file_signature(os.path.join(path, image), entry)
+        if unchanged(signature, entry):
+            entry.update(signature)
+        else:
+            todo.append((image, signature))
+    if not todo:
+        return
+    # Pillow releases the GIL while decoding, so threads run in parallel
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        means = executor.map(lambda job: frame_luminance(os.path.join(path, job[0])), todo)
+        for (image, signature), mean in zip(todo, means):
+            stats[image] = dict(signature, mean=mean)
+
+
+def smooth_targets(means, start=0, targets=()):
+    """Returns the target curve for the list of means, the moving average of their logs
+       over WINDOW either side. Values of targets before index start are reused."""
+    logs = [math.log(max(m, 1/255)) for m in means]
+    result = list(targets[:start])
+    for i in range(start, len(means)):
+        window = logs[max(0, i - WINDOW):i + WINDOW + 1]
+        result.append(math.exp(sum(window) / len(window)))
+    return result
+
+
+def deflicker_gammas(path, images, cachefile=None, workers=None):
+    """Returns a dictionary of image:gamma for the list of images in path, in film order
+
+       cachefile defaults to deflicker.json in path"""
+    if cachefile is None:
+        cachefile = os.path.join(path, "deflicker.json")
+    cache = load_cache(cachefile)
+    stats = cache["stats"]
+    update_stats(path, images, stats, workers)
+
+    means = [stats[image]["mean"] for image in images]
+
+    # find the first frame at which the sequence differs from the one the cached curve was made from,
+    # targets more than WINDOW before it are unchanged
+    order, oldmeans, targets = cache["order"], cache["means"], cache["targets"]
+    limit = min(len(images), len(order), len(oldmeans), len(targets))
+    first = 0
+    while first < limit and images[first] == order[first] and means[first] == oldmeans[first]:
+        first += 1
+    start = max(0, first - WINDOW)
+    targets = smooth_targets(means, start, targets)
+
+    cache["order"], cache["means"], cache["targets"] = list(images), means, targets
+    save_cache(cachefile, cache)
+
+    gammas = {}
+    for image, mean, target in zip(images, means, targets):
+        # move part way, by STRENGTH, from the mean towards the target, in log terms
+        wanted = math.exp((1 - STRENGTH) * math.log(max(mean, 1/255)) + STRENGTH * math.log(target))
+        if 0 < mean < 1 and 0 < wanted < 1:
+            gamma = math.log(wanted) / math.log(mean)
+        else:
+            gamma = 1.0
+        gammas[image] = round(max(MINGAMMA, min(MAXGAMMA, gamma)), GAMMAPLACES)
+    return gammas
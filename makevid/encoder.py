@@ -0,0 +1,150 @@
+"""Video encoders for makevid.py and film.py
+
+   FFmpegWriter pipes raw frames straight into an ffmpeg process, which encodes them
+   with libx264 or libx265 at the given preset and CRF, optionally scaled to a given
+   height, for example 1080 or 2160, into an mp4 ready to play. So there is no large
+   intermediate AVI, and no second ffmpeg pass to convert it. As yuv420p needs an even
+   width and height, an odd size is always cut down to the even size below it.
+
+   OpenCVWriter is the OpenCV VideoWriter, as was always used, DIVX into an AVI, or
+   mp4v into an mp4, and is used if ffmpeg is not installed.
+
+   open_writer chooses between them.
+
+   ffmpeg is typically installed with
+
+   sudo apt install ffmpeg
+"""
+
+import shutil, subprocess
+
+import cv2
+
+
+# "auto" uses ffmpeg if it is installed, otherwise OpenCV, or set "ffmpeg" or "opencv"
+ENCODER = "auto"
+
+# ffmpeg codec, libx264 or libx265, with its preset and constant rate factor, lower is better quality
+CODEC = "libx264"
+PRESET = "medium"
+CRF = 20
+
+# Heights which may be given by name
+HEIGHTS = {"720p":720, "1080p":1080, "4k":2160}
+
+
+def ffmpeg_available():
+    return shutil.which("ffmpeg") is not None
+
+
+def scaled_size(size, height):
+    "Returns the (width, height) of size scaled to the given height, keeping the aspect ratio, with even width"
+    if height is None:
+        return size
+    width = round(size[0] * height / size[1] / 2) * 2
+    return width, height
+
+
+class FFmpegWriter:
+    "Encodes frames with an ffmpeg process, frames are OpenCV BGR arrays of the given size"
+
+    def __init__(self, output, fps, size, codec=CODEC, preset=PRESET, crf=CRF, height=None):
+        width, height0 = size
+        command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height0}", "-r", str(fps), "-i", "-"]
+        # yuv420p needs an even width and height
+        if height is None:
+            command += ["-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2:flags=lanczos"]
+        else:
+            command += ["-vf", f"scale=-2:{height // 2 * 2}:flags=lanczos"]
+        command += ["-c:v", codec, "-preset", preset, "-crf", str(crf), "-pix_fmt", "yuv420p"]
+        if codec == "libx265":
+            # so that Apple players recognise the stream
+            command += ["-tag:v", "hvc1"]
+        command += ["-movflags", "+faststart", output]
+        self.name = f"ffmpeg {codec} {preset} crf {crf}"
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except BrokenPipeError:
+            self.abort()
+            raise OSError(f"ffmpeg stopped with exit code {self.process.returncode}")
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait():
+            raise OSError(f"ffmpeg failed with exit code {self.process.returncode}")
+
+    def abort(self):
+        "Stops ffmpeg without finishing the video, after an error"
+        if self.process.poll() is None:
+            self.process.kill()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+class OpenCVWriter:
+    "Encodes frames with the OpenCV VideoWriter, frames are OpenCV BGR arrays of the given size"
+
+    def __init__(self, output, fps, size, height=None):
+        self.size = scaled_size(size, height)
+        fourcc = "mp4v" if output.endswith(".mp4") else "DIVX"
+        self.name = f"opencv {fourcc}"
+        self.video = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*fourcc), fps, self.size)
+        if not self.video.isOpened():
+            raise OSError(f"Unable to open {output} for writing")
+
+    def write(self, frame):
+        if frame.shape[1::-1] != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        self.video.write(frame)
+
+    def close(self):
+        self.video.release()
+
+    def abort(self):
+        self.video.release()
+
+
+def open_writer(output, fps, size, encoder=ENCODER, codec=CODEC, preset=PRESET, crf=CRF, height=None):
+    """Returns a writer for frames of size (width, height), with methods write(frame), close() and
+       abort(), to stop without finishing the video after an error, and attribute name. The video is scaled to the given height if it is not None"""
+    if encoder == "auto":
+        encoder = "ffmpeg" if ffmpeg_available() else "opencv"
+    if encoder == "ffmpeg":
+        return FFmpegWriter(output, fps, size, codec, preset, crf, height)
+    if encoder == "opencv":
+        return OpenCVWriter(output, fps, size, height)
+    raise ValueError(f"Unknown encoder {encoder}")
+
+
+def default_output(name="movie"):
+    "Returns the default output filename, an mp4 if ffmpeg is available, otherwise an AVI"
+    return f"{name}.mp4" if ffmpeg_available() else f"{name}.avi"
+
+
+def parse_height(text):
+    "Returns a height given as a number of pixels, or by one of the names in HEIGHTS"
+    return HEIGHTS[text.lower()] if text.lower() in HEIGHTS else int(text)
+
+
+def add_arguments(parser):
+    "Adds the encoder options to an argparse parser"
+    parser.add_argument("--encoder", choices=("auto", "ffmpeg", "opencv"), default=ENCODER)
+    parser.add_argument("--codec", choices=("libx264", "libx265"), default=CODEC)
+    parser.add_argument("--preset", default=PRESET, help="ffmpeg preset, such as fast, medium or slow")
+    parser.add_argument("--crf", type=int, default=CRF, help="ffmpeg constant rate factor, lower is better quality")
+    parser.add_argument("--height", type=parse_height, default=None, help="scale the video to this height, or 720p, 1080p, 4k")
+
+
+def encoding(args):
+    "Returns a dictionary of the encoder options parsed by a parser given add_arguments"
+    return {"encoder":args.encoder, "codec":args.codec, "preset":args.preset, "crf":args.crf, "height":args.height}
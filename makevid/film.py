@@ -0,0 +1,181 @@
+"""Creates the film directly from /home/bernard/git/timelapse/images in a single pass
+
+   This does the work of adjust.py followed by makevid.py without writing the
+   intermediate images2 directory. Each mid-day image is decoded once, at the
+   smallest JPEG scale at least as large as the output, metered, resized to the
+   output resolution, gamma corrected as adjust.py would, and streamed into the
+   video writer.
+
+   With --deflicker, rather than adjust.py's brightness bands, each frame is given
+   the gamma which moves it onto a smoothed brightness curve, see deflicker.py.
+
+   Optionally, with --cache DIR, each adjusted and resized frame is kept as a JPEG
+   named by a hash of its source and the parameters used, so a re-render only
+   decodes small cached frames, and only new or changed sources are processed fully.
+   The cache keeps a manifest of the size, modification time and sha1 of each source,
+   so a source is only read and hashed again if its size or modification time change.
+   Sources which have gone from the image directory are dropped from the manifest, and
+   their cached frames deleted.
+
+   With --best, the best photo of each day, of any hour, is used rather than the
+   mid-day one, see bestframe.py.
+
+   Usage:
+
+   python3 film.py [--pathin DIR] [--output FILE] [--size WxH] [--fps N] [--cache DIR] [--deflicker] [--best]
+                   [--encoder auto|ffmpeg|opencv] [--codec libx264|libx265] [--preset P] [--crf N]
+
+   The film is encoded by ffmpeg into movie.mp4 if it is installed, see encoder.py,
+   otherwise into movie.avi
+
+   Requires environment with pillow, numpy and opencv-python, and metering.py and
+   frameindex.py from the parent directory
+"""
+
+import os, json, hashlib, argparse
+
+import cv2
+import numpy as np
+
+from PIL import Image, ImageOps
+
+import sharedpath
+
+import adjust
+from adjust import apply_gamma, choose_gamma
+from makevid import frame_stream, write_video, WORKERS, PREFETCH
+from encoder import add_arguments, encoding, default_output
+from deflicker import deflicker_gammas
+
+from metering import get_brightness, TESTX, TESTY
+from frameindex import file_sha1, file_signature, load_json, save_json
+
+
+# Default output resolution, 1080p at the 4:3 aspect of the webcam,
+# a size of another aspect is filled, cropping the centre of the image
+SIZE = (1440, 1080)
+
+CACHE_QUALITY = 95
+
+# Name of the manifest of the sources kept in the cache directory
+CACHE_MANIFEST = "sources.json"
+
+
+def prune_cache(cache, pathin, sources):
+    """Drops the sources which are no longer in pathin from sources, and deletes the cached
+       frames of any source not in sources, returns the number of cached frames deleted"""
+    for name in [name for name in sources if not os.path.exists(os.path.join(pathin, name))]:
+        del sources[name]
+    removed = 0
+    for cachename in os.listdir(cache):
+        # cached frames are named as their source, with _ and the key appended
+        if cachename.endswith(".jpeg") and cachename.rsplit("_", 1)[0] + ".jpeg" not in sources:
+            os.remove(os.path.join(cache, cachename))
+            removed += 1
+    return removed
+
+
+def source_hash(infile, sources):
+    """Returns the sha1 of infile, updating sources, a dictionary of name:signature, see
+       frameindex.file_signature, so it is only hashed if its size or modification time change"""
+    name = os.path.basename(infile)
+    sources[name] = file_signature(infile, sources.get(name))
+    return sources[name]["sha1"]
+
+
+def cache_key(infile, size, gamma=None, sources=None):
+    """Returns a hex digest identifying the source contents, output size, gamma and adjust parameters
+       If sources is given, the source is only hashed if it has changed, see source_hash"""
+    sha1 = file_sha1(infile) if sources is None else source_hash(infile, sources)
+    h = hashlib.sha1(sha1.encode())
+    h.update(json.dumps({"size":list(size), "gamma":gamma, "params":adjust.PARAMS}, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+def adjusted_frame(infile, size, gamma=None):
+    """Returns the image from infile, resized to size and gamma corrected, as an OpenCV BGR array
+       If gamma is None, it is chosen from the brightness as adjust.py does"""
+    with Image.open(infile) as img:
+        fullwidth = img.width
+        # decode at the smallest DCT scale which still gives at least the output size
+        img.draft("RGB", size)
+        factor = fullwidth / img.width
+        if gamma is None:
+            gamma = choose_gamma(get_brightness(img, TESTX, TESTY, factor))
+        img = ImageOps.fit(img.convert("RGB"), size, Image.LANCZOS)
+    # correcting after resizing touches far fewer pixels
+    if gamma is not None and gamma != 1.0:
+        img = apply_gamma(img, gamma)
+    return cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+
+
+def render_film(pathin, output="movie.avi", size=SIZE, fps=10, cache=None, workers=WORKERS, prefetch=PREFETCH, deflicker=False, images=None, **encoding):
+    """Renders the mid-day images in pathin into the video file output, or the images given,
+       a list of filenames in pathin
+       If cache is a directory, adjusted frames are read from and saved to it.
+       If deflicker is True, frames are gamma corrected onto a smoothed brightness curve.
+       encoding sets the encoder, see makevid.write_video.
+       Returns the number of frames written"""
+
+    if images is None:
+        # get list of images ending with 12 just to get the mid - day shots
+        images = sorted(img for img in os.listdir(pathin) if img.endswith("12.jpeg"))
+
+    gammas = deflicker_gammas(pathin, images, workers=workers) if deflicker else {}
+
+    sources = None
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+        sources = load_json(os.path.join(cache, CACHE_MANIFEST))
+
+    def load(image):
+        infile = os.path.join(pathin, image)
+        gamma = gammas.get(image)
+        if cache is None:
+            return adjusted_frame(infile, size, gamma)
+        cachefile = os.path.join(cache, f"{image[:-5]}_{cache_key(infile, size, gamma, sources)}.jpeg")
+        frame = cv2.imread(cachefile) if os.path.exists(cachefile) else None
+        if frame is None:
+            frame = adjusted_frame(infile, size, gamma)
+            cv2.imwrite(cachefile, frame, [cv2.IMWRITE_JPEG_QUALITY, CACHE_QUALITY])
+        return frame
+
+    try:
+        count = write_video(frame_stream(images, load, workers, prefetch), output, fps, len(images), **encoding)
+    finally:
+        # kept even if the render fails, so the sources hashed so far are not hashed again
+        if sources is not None:
+            save_json(os.path.join(cache, CACHE_MANIFEST), sources)
+    if cache is not None:
+        removed = prune_cache(cache, pathin, sources)
+        save_json(os.path.join(cache, CACHE_MANIFEST), sources)
+        if removed:
+            print(f"{removed} cached frames of removed sources deleted")
+    return count
+
+
+def parse_size(text):
+    "Parses WxH into a (width, height) tuple"
+    width, height = text.lower().split("x")
+    return (int(width), int(height))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Adjust the mid-day images and create the film in one pass")
+    parser.add_argument("--pathin", default="/home/bernard/git/timelapse/images")
+    parser.add_argument("--output", default=default_output(), help="default movie.mp4, or movie.avi without ffmpeg")
+    parser.add_argument("--size", type=parse_size, default=SIZE, help="output resolution WxH, default 1440x1080")
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--cache", default=None, help="directory in which to cache adjusted frames")
+    parser.add_argument("--deflicker", action="store_true", help="smooth the brightness of consecutive frames")
+    parser.add_argument("--best", action="store_true", help="use the best image of each day, see bestframe.py")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    images = None
+    if args.best:
+        # imported only when needed, as adjust.py does
+        from bestframe import best_frames
+        images = best_frames(args.pathin)
+    render_film(args.pathin, args.output, args.size, args.fps, args.cache, deflicker=args.deflicker, images=images, **encoding(args))
@@ -0,0 +1,217 @@
+"""Exposure fusion of the _orig and retake photos taken by altpower.py
+
+   When a photo is too dark, altpower.py keeps it as image_X_orig.jpeg and takes
+   image_X.jpeg again with a longer exposure. Rather than keep only the retake and
+   brighten it with a gamma, this merges the pair into one frame, taking each part
+   of the image from the photo which exposes it best, so the sky keeps its detail
+   from the darker photo and the shadows theirs from the brighter one.
+
+   The weights are those of Mertens exposure fusion, the product of local contrast,
+   colour saturation and well-exposedness, nearness to mid grey. They are worked out
+   on a 1/SCALE reduced scale decode of each photo and smoothed, so they vary slowly
+   across the image. The full size photos are then blended in strips of STRIP rows,
+   the weights of each strip interpolated up from the small weight maps, and each
+   fused strip written over the rows of the retake it came from. Neither Pillow nor
+   OpenCV decodes a jpeg a strip at a time, so each photo is still decoded whole, a
+   worker holds the decoded pair, about 72MB for 4000x3000 photos. It is the floating
+   point work, which for a whole frame would take several hundred megabytes, which
+   is bounded by the strip.
+
+   Pairs are fused in parallel, one process per cpu core. The fused frames are kept
+   in an output directory, default images_fused alongside the images, named as the
+   retake, with a manifest of the sha1 of their sources, so a frame is only fused
+   again if a source changes.
+
+   python3 fuse.py [--pathin DIR] [--pathout DIR] [--workers N]
+
+   fuses all the pairs in pathin. adjust.py --fuse uses the fused frames in place of
+   the retakes.
+
+   The storage policy of altpower.py, see storage.py, deletes an _orig photo whose
+   retake was better, leaving nothing to fuse, so to use this set KEEPORIG in
+   altpower.py to True. A frame replaced by its preview is not fused either.
+
+   Requires environment with pillow, numpy and opencv-python, and frameindex.py from
+   the parent directory
+"""
+
+import os, argparse
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from PIL import Image
+
+import sharedpath
+
+from frameindex import parse_name, file_signature, unchanged, load_json, save_json
+
+
+# Reduction of the decode on which the weights are worked out
+SCALE = 8
+
+# Rows of the full size image blended at a time
+STRIP = 256
+
+# Standard deviation of well-exposedness about mid grey, as Mertens
+SIGMA = 0.2
+
+# Gaussian smoothing of the small weight maps, in pixels of the reduced decode
+SMOOTH = 4
+
+QUALITY = 95
+
+# Everything which affects the output, if this changes, all pairs are fused again
+# manifest is the version of the manifest format
+PARAMS = {"scale":SCALE, "sigma":SIGMA, "smooth":SMOOTH, "quality":QUALITY, "manifest":2}
+
+# Name of the manifest file kept in the output directory
+MANIFEST = "fuse_manifest.json"
+
+# Suffix of the default output directory
+FUSEDSUFFIX = "_fused"
+
+
+def pairs(path):
+    """Returns a dictionary of frame name:list of the names of its photos, retake first,
+       for each frame in path which has an _orig photo, which storage.py keeps only with keeporig"""
+    groups = defaultdict(list)
+    for name in sorted(os.listdir(path)):
+        parsed = parse_name(name)
+        if parsed is not None and parsed[1] in ("frame", "orig"):
+            groups[f"image_{parsed[0].strftime('%Y%m%d%H')}.jpeg"].append(name)
+    return {frame:sorted(names, key=lambda name: name != frame) for frame, names in groups.items()
+            if len(names) > 1 and frame in names}
+
+
+def weight_map(filename):
+    "Returns the Mertens weight map of the image, at 1/SCALE size, as float32"
+    with Image.open(filename) as img:
+        img.draft("RGB", (img.width // SCALE, img.height // SCALE))
+        small = np.asarray(img.convert("RGB"), dtype=np.float32) / 255
+    gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+    contrast = np.abs(cv2.Laplacian(gray, cv2.CV_32F))
+    saturation = small.std(axis=2)
+    exposedness = np.prod(np.exp(-((small - 0.5) ** 2) / (2 * SIGMA ** 2)), axis=2)
+    weights = contrast * saturation * exposedness + 1e-6
+    return cv2.GaussianBlur(weights, (0, 0), SMOOTH)
+
+
+def fuse(infiles, outfile):
+    """Fuses the photos infiles, all of the same size, into outfile
+       The photos are decoded whole, the fused rows replace those of the first,
+       so beside them only one strip of working arrays is held at once"""
+    weights = [weight_map(infile) for infile in infiles]
+    images = [cv2.imread(infile, cv2.IMREAD_COLOR) for infile in infiles]
+    for infile, img in zip(infiles, images):
+        if img is None:
+            raise OSError(f"Unable to read {infile}")
+        if img.shape != images[0].shape:
+            raise ValueError(f"{infile} is not the size of {infiles[0]}")
+
+    height, width = images[0].shape[:2]
+    smallheight, smallwidth = weights[0].shape
+    # the position of each full size pixel in the small weight maps
+    xs = ((np.arange(width, dtype=np.float32) + 0.5) * smallwidth / width - 0.5)
+    # each strip is blended before its rows are overwritten, and no later strip reads them
+    output = images[0]
+
+    for top in range(0, height, STRIP):
+        bottom = min(height, top + STRIP)
+        ys = ((np.arange(top, bottom, dtype=np.float32) + 0.5) * smallheight / height - 0.5)
+        mapx = np.broadcast_to(xs, (bottom - top, width)).copy()
+        mapy = np.broadcast_to(ys[:, None], (bottom - top, width)).copy()
+        total = np.zeros((bottom - top, width), dtype=np.float32)
+        blend = np.zeros((bottom - top, width, 3), dtype=np.float32)
+        for img, w in zip(images, weights):
+            strip = cv2.remap(w, mapx, mapy, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            total += strip
+            blend += img[top:bottom] * strip[:, :, None]
+        output[top:bottom] = np.clip(blend / total[:, :, None] + 0.5, 0, 255).astype(np.uint8)
+
+    if not cv2.imwrite(outfile + ".tmp.jpeg", output, [cv2.IMWRITE_JPEG_QUALITY, QUALITY]):
+        raise OSError(f"Unable to write {outfile}")
+    os.replace(outfile + ".tmp.jpeg", outfile)
+
+
+def _work(job):
+    """Run in a worker process, job is (frame, infiles, outfile, entry)
+       returns (frame, entry) or (frame, error message) on failure"""
+    frame, infiles, outfile, entry = job
+    try:
+        fuse(infiles, outfile)
+    except (OSError, ValueError, cv2.error) as e:
+        return frame, str(e)
+    return frame, entry
+
+
+def source_entry(path, names, previous):
+    """Returns the manifest entry for the sources names in path, with a dictionary of name:signature,
+       see frameindex.file_signature, sources are only hashed if their size or modification time
+       differ from the previous entry"""
+    known = previous["sources"] if previous is not None and previous.get("params") == PARAMS else {}
+    return {"sources":{name:file_signature(os.path.join(path, name), known.get(name)) for name in names},
+            "params":PARAMS}
+
+
+def same_content(entry, previous):
+    "Returns True if two manifest entries have the same sources, in the same order, and parameters"
+    if previous is None or previous.get("params") != entry["params"] or list(previous["sources"]) != list(entry["sources"]):
+        return False
+    return all(unchanged(signature, previous["sources"][name]) for name, signature in entry["sources"].items())
+
+
+def fuse_all(pathin, pathout=None, workers=None, frames=None):
+    """Fuses the pairs in pathin into pathout, skipping any unchanged since the last run
+       frames, if given, limits this to the pairs of those frame names.
+       Returns a dictionary of frame name:fused filename, for every pair fused now or before"""
+    if pathout is None:
+        pathout = pathin.rstrip("/") + FUSEDSUFFIX
+    os.makedirs(pathout, exist_ok=True)
+    manifestfile = os.path.join(pathout, MANIFEST)
+    manifest = load_json(manifestfile)
+
+    groups = pairs(pathin)
+    if frames is not None:
+        groups = {frame:names for frame, names in groups.items() if frame in frames}
+
+    jobs = []
+    for frame, names in groups.items():
+        outfile = os.path.join(pathout, frame)
+        previous = manifest.get(frame)
+        entry = source_entry(pathin, names, previous)
+        if os.path.exists(outfile) and same_content(entry, previous):
+            manifest[frame] = entry
+            continue
+        jobs.append((frame, [os.path.join(pathin, name) for name in names], outfile, entry))
+
+    print(f"{len(groups)} pairs, {len(jobs)} to fuse")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for count, (frame, entry) in enumerate(executor.map(_work, jobs), start=1):
+            if isinstance(entry, str):
+                # left out of the manifest, to be retried
+                print(f"failed {frame}: {entry}")
+                manifest.pop(frame, None)
+                continue
+            manifest[frame] = entry
+            # save the manifest now and then, so an interrupted run keeps its progress
+            if not count % 20:
+                save_json(manifestfile, manifest)
+
+    save_json(manifestfile, manifest)
+    return {frame:os.path.join(pathout, frame) for frame in groups if frame in manifest}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fuse the _orig and retake photos")
+    parser.add_argument("--pathin", default="/home/bernard/git/timelapse/images")
+    parser.add_argument("--pathout", default=None, help="default pathin with _fused appended")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default one per cpu")
+    args = parser.parse_args()
+
+    fuse_all(args.pathin, args.pathout, args.workers)
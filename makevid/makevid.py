@@ -1,46 +1,166 @@
-
 """
 Create the video, code derived from
 
 https://www.geeksforgeeks.org/python/python-create-video-using-multiple-images-using-opencv/
 
 Gets images from /home/bernard/git/timelapse/images2
-and creates movie file movie.avi
+and creates movie file movie.mp4, encoded by ffmpeg, or movie.avi if ffmpeg
+is not installed, see encoder.py
 
-Requires environment with opencv-python
+python3 makevid.py [--output FILE] [--fps N] [--deflicker] [--stabilize] [--preview]
+                   [--encoder auto|ffmpeg|opencv] [--codec libx264|libx265] [--preset P] [--crf N] [--height H]
 
-"""
+With --preview, gets the reduced size images made by adjust.py --preview from
+/home/bernard/git/timelapse/images2_preview and creates movie_preview, so the
+look of the film can be checked in seconds
 
-import os
-import cv2
+The images are decoded by a pool of threads, which keep a bounded number of
+frames decoded ahead of the video writer, in order. So memory use is fixed
+however many frames there are, and decoding uses all cpu cores.
 
+Requires environment with opencv-python
 
-def generate_video(path):
+"""
 
-    images = [img for img in os.listdir(path) if img.endswith(".jpeg")] 
+import os, sys, time, argparse
+import cv2
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from encoder import open_writer, add_arguments, encoding, default_output
+
+
+# Number of decoding threads, default one per cpu core
+WORKERS = os.cpu_count() or 1
+
+# Frames decoded ahead of the writer, this sets the peak memory use, at
+# 4000x3000 each frame is 36MB
+PREFETCH = 2 * WORKERS
+
+# Progress is printed every PROGRESS frames
+PROGRESS = 50
+
+
+def frame_stream(items, load, workers=WORKERS, prefetch=PREFETCH):
+    """Yields (item, load(item)) for each of items, in order
+
+       load is called in a pool of threads, running ahead of the consumer by
+       at most prefetch items, so no more than prefetch results are held at once.
+       OpenCV and Pillow release the GIL while decoding, so threads run in parallel."""
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append((item, executor.submit(load, item)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            item, future = pending.popleft()
+            result = future.result()
+            # top up the queue before handing over this frame
+            nextitem = next(items, None)
+            if nextitem is not None:
+                pending.append((nextitem, executor.submit(load, nextitem)))
+            yield item, result
+
+
+def write_video(frames, output="movie.avi", fps=10, total=None, **encoding):
+    """Writes frames, an iterator of (name, OpenCV BGR frame) to the video file output
+       The first frame sets the size of the video. encoding is passed to
+       encoder.open_writer, to choose the encoder and its settings.
+       Returns the number of frames written"""
+
+    start = time.monotonic()
+
+    video = None
+    count = 0
+
+    try:
+        for image, frame in frames:
+            if video is None:
+                # Set frame from the first image
+                height, width, layers = frame.shape
+                video = open_writer(output, fps, (width, height), **encoding)
+            elif frame.shape[:2] != (height, width):
+                # every frame given to the encoder must be the same size
+                frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            # Appending images to video
+            video.write(frame)
+            count += 1
+            if not count % PROGRESS:
+                print(f"{count} of {total or '?'} frames, {image}")
+    except BaseException:
+        # stop the encoder, so that an ffmpeg process is not left running
+        if video is not None:
+            video.abort()
+        raise
+
+    if video is None:
+        print("No frames to write")
+        return 0
+
+    # Finish the video file
+    video.close()
+    elapsed = time.monotonic() - start
+    print(f"Video generated successfully! {count} frames in {elapsed:.1f}s, {count/elapsed:.1f} frames per second, {video.name}")
+    return count
+
+
+def generate_video(path, output="movie.avi", fps=10, workers=WORKERS, prefetch=PREFETCH, deflicker=False, stabilize=False, **encoding):
+    """Creates the video from the images in path
+       If deflicker is True, each frame is gamma corrected onto a smoothed brightness
+       curve, see deflicker.py
+       If stabilize is True, each frame is shifted to align with the first, see stabilize.py
+       encoding sets the encoder, see write_video"""
+
+    images = [img for img in os.listdir(path) if img.endswith(".jpeg")]
     images.sort()
 
-    # Set frame from the first image
-    frame = cv2.imread(os.path.join(path, images[0]))
-    height, width, layers = frame.shape
+    if deflicker:
+        from deflicker import deflicker_gammas
+        from adjust import gamma_lut
+        gammas = deflicker_gammas(path, images)
 
-    # Video writer to create .avi file
-    video = cv2.VideoWriter("movie.avi", cv2.VideoWriter_fourcc(*'DIVX'), 10, (width, height))
+    if stabilize:
+        from stabilize import frame_shifts, apply_shift
+        shifts = frame_shifts(path, images, workers=workers)
 
-    # Appending images to video
-    for image in images:
-        video.write(cv2.imread(os.path.join(path, image)))
-        print(image)
+    def load(image):
+        frame = cv2.imread(os.path.join(path, image))
+        if frame is None:
+            raise OSError(f"Unable to read {image}")
+        if deflicker and gammas[image] != 1.0:
+            frame = cv2.LUT(frame, np.array(gamma_lut(gammas[image]), dtype=np.uint8))
+        if stabilize:
+            frame = apply_shift(frame, *shifts[image])
+        return frame
 
-    # Release the video file
-    video.release()
-    cv2.destroyAllWindows()
-    print("Video generated successfully!")
+    return write_video(frame_stream(images, load, workers, prefetch), output, fps, len(images), **encoding)
 
 
 if __name__ == "__main__":
 
-    path = "/home/bernard/git/timelapse/images2"
-
-    # Calling the function to generate the video
-    generate_video(path)
+    parser = argparse.ArgumentParser(description="Create the video from the adjusted images")
+    parser.add_argument("--path", default="/home/bernard/git/timelapse/images2")
+    parser.add_argument("--output", default=None, help="default movie.mp4, or movie.avi without ffmpeg")
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--deflicker", action="store_true", help="smooth the brightness of consecutive frames")
+    parser.add_argument("--stabilize", action="store_true", help="align the frames")
+    parser.add_argument("--preview", action="store_true", help="use the proxies processed by adjust.py --preview")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    path = args.path
+    output = args.output or default_output()
+
+    if args.preview:
+        # the proxies processed by adjust.py --preview
+        path = path.rstrip("/") + "_preview"
+        output = args.output or default_output("movie_preview")
+        if not os.path.isdir(path):
+            print(f"{path} not found, run adjust.py --preview first")
+            sys.exit(1)
+
+    generate_video(path, output, args.fps, deflicker=args.deflicker, stabilize=args.stabilize, **encoding(args))
@@ -0,0 +1,212 @@
+"""A calendar mosaic of the photos, to review a season at a glance
+
+   Each day is a tile, laid out as a calendar, a week to a row from Monday to Sunday.
+   With several --hours, each week has a row of tiles for each hour, so the light
+   through the day can be compared too. Each tile is labelled with its date and hour,
+   a day with no photo is left grey.
+
+   The tiles are made from the photos with reduced scale decoding, in a pool of
+   threads, and kept in mosaic_tiles/WxH within the image directory, with a manifest
+   of the size, modification time and sha1 of each source, so adding a day only renders
+   its tile. Where a photo has been replaced by its preview, see storage.py, the
+   preview is used.
+
+   The mosaic is written as a PNG, a strip of one row of tiles at a time, so even a
+   year of large tiles is never held in memory whole.
+
+   python3 mosaic.py [--path DIR] [--output mosaic.png] [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+                     [--hours 12 | 10,11,12,13,14] [--tile WxH] [--workers N]
+
+   Requires environment with pillow and numpy, and frameindex.py from the parent directory
+"""
+
+import os, zlib, struct, argparse
+
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from PIL import Image, ImageDraw, ImageOps
+
+import sharedpath
+
+from frameindex import parse_name, file_signature, unchanged, load_json, save_json
+
+
+TILE = (400, 300)
+
+HOURS = (12,)
+
+# Grey of a day with no photo, and of the gaps between tiles
+EMPTY = 48
+GAP = 4
+
+QUALITY = 90
+
+TILEDIR = "mosaic_tiles"
+
+# Name of the manifest file kept in the tile directory
+MANIFEST = "tiles.json"
+
+
+class PNGWriter:
+    "Writes an RGB PNG a strip of rows at a time, the image is never held whole"
+
+    def __init__(self, filename, width, height):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.file = open(filename, "wb")
+        self.compressor = zlib.compressobj(6)
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data)
+        self.file.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+    def write(self, strip):
+        "Appends a strip, a uint8 array of shape (rows, width, 3)"
+        if strip.shape[1:] != (self.width, 3):
+            raise ValueError(f"A strip must be {self.width} pixels wide")
+        # each row is preceded by its filter type, 0, none
+        rows = np.concatenate([np.zeros((strip.shape[0], 1), dtype=np.uint8), strip.reshape(strip.shape[0], -1)], axis=1)
+        data = self.compressor.compress(rows.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+        self.rows += strip.shape[0]
+
+    def close(self):
+        if self.rows != self.height:
+            self.file.close()
+            raise ValueError(f"{self.rows} rows written of {self.height}")
+        self._chunk(b"IDAT", self.compressor.flush())
+        self._chunk(b"IEND", b"")
+        self.file.close()
+
+
+def sources(path):
+    "Returns a dictionary of (date, hour):filename of the photos in path, a frame in preference to its preview"
+    found = {}
+    for name in sorted(os.listdir(path)):
+        parsed = parse_name(name)
+        if parsed is None or parsed[1] not in ("frame", "preview"):
+            continue
+        key = (parsed[0].date(), parsed[0].hour)
+        if parsed[1] == "frame" or key not in found:
+            found[key] = name
+    return found
+
+
+def make_tile(infile, outfile, size):
+    "Makes the tile of the photo infile, filling size and cropping the centre, decoded at reduced scale"
+    with Image.open(infile) as img:
+        img.draft("RGB", size)
+        tile = ImageOps.fit(img.convert("RGB"), size, Image.BILINEAR)
+    tile.save(outfile + ".tmp", "JPEG", quality=QUALITY)
+    os.replace(outfile + ".tmp", outfile)
+
+
+def update_tiles(path, names, size=TILE, workers=None):
+    """Makes the tiles of any of the photos names in path which are missing or whose source
+       has changed, returns the tile directory and the number of tiles made"""
+    tiledir = os.path.join(path, TILEDIR, f"{size[0]}x{size[1]}")
+    os.makedirs(tiledir, exist_ok=True)
+    manifestfile = os.path.join(tiledir, MANIFEST)
+    manifest = load_json(manifestfile)
+
+    jobs = []
+    for name in names:
+        entry = manifest.get(name)
+        signature = file_signature(os.path.join(path, name), entry)
+        if unchanged(signature, entry) and os.path.exists(os.path.join(tiledir, name)):
+            entry.update(signature)
+            continue
+        jobs.append((name, signature))
+
+    def work(job):
+        name, entry = job
+        try:
+            make_tile(os.path.join(path, name), os.path.join(tiledir, name), size)
+        except (OSError, ValueError) as e:
+            print(f"Unable to make the tile of {name}: {e}")
+            return name, None
+        return name, entry
+
+    if jobs:
+        # Pillow releases the GIL while decoding and encoding, so threads run in parallel
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for name, entry in executor.map(work, jobs):
+                if entry is not None:
+                    manifest[name] = entry
+    save_json(manifestfile, manifest)
+    return tiledir, len(jobs)
+
+
+def mosaic(path, output, start=None, end=None, hours=HOURS, size=TILE, workers=None):
+    """Writes the calendar mosaic of the photos in path from date start to date end inclusive,
+       by default the span of the photos, to the PNG file output. Returns the (width, height)"""
+    found = {key:name for key, name in sources(path).items() if key[1] in hours}
+    days = sorted({day for day, hour in found})
+    if not days and (start is None or end is None):
+        raise ValueError(f"No photos at hours {hours} in {path}")
+    start = start or days[0]
+    end = end or days[-1]
+    found = {key:name for key, name in found.items() if start <= key[0] <= end}
+
+    tiledir, made = update_tiles(path, sorted(found.values()), size, workers)
+    if made:
+        print(f"{made} tiles made")
+
+    # weeks from the Monday on or before start
+    first = start - timedelta(days=start.weekday())
+    weeks = (end - first).days // 7 + 1
+    tilewidth, tileheight = size
+    width = 7 * tilewidth + 8 * GAP
+    rowheight = tileheight + GAP
+    height = weeks * len(hours) * rowheight + GAP
+
+    writer = PNGWriter(output, width, height)
+    writer.write(np.full((GAP, width, 3), EMPTY, dtype=np.uint8))
+    for week in range(weeks):
+        for hour in hours:
+            strip = Image.new("RGB", (width, rowheight), (EMPTY,) * 3)
+            draw = ImageDraw.Draw(strip)
+            for weekday in range(7):
+                day = first + timedelta(days=7 * week + weekday)
+                x = GAP + weekday * (tilewidth + GAP)
+                name = found.get((day, hour))
+                if name is not None and os.path.exists(os.path.join(tiledir, name)):
+                    with Image.open(os.path.join(tiledir, name)) as tile:
+                        strip.paste(tile, (x, 0))
+                if start <= day <= end:
+                    label = f"{day.isoformat()} {hour:02d}:00"
+                    draw.text((x + 5, 4), label, fill=(0, 0, 0))
+                    draw.text((x + 4, 3), label, fill=(255, 255, 255))
+            writer.write(np.asarray(strip))
+    writer.close()
+    return width, height
+
+
+def parse_tile(text):
+    "Parses WxH into a (width, height) tuple"
+    width, height = text.lower().split("x")
+    return (int(width), int(height))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Make a calendar mosaic of the photos")
+    parser.add_argument("--path", default="/home/bernard/git/timelapse/images")
+    parser.add_argument("--output", default="mosaic.png")
+    parser.add_argument("--start", type=date.fromisoformat, default=None, help="first day, default the first photo")
+    parser.add_argument("--end", type=date.fromisoformat, default=None, help="last day, default the last photo")
+    parser.add_argument("--hours", default=",".join(str(h) for h in HOURS), help="comma separated hours, a row of tiles for each")
+    parser.add_argument("--tile", type=parse_tile, default=TILE, help="tile size WxH, default 400x300")
+    parser.add_argument("--workers", type=int, default=None, help="decoding threads, default one per cpu")
+    args = parser.parse_args()
+
+    hours = tuple(int(h) for h in args.hours.split(","))
+    width, height = mosaic(args.path, args.output, args.start, args.end, hours, args.tile, args.workers)
+    print(f"{args.output} written, {width}x{height}")
@@ -0,0 +1,94 @@
+"""Summarise the wake cycle log by month
+
+   Reads cycles.jsonl, written on the Pi by cyclelog.py and copied here with the
+   photos, and prints for each month the number of wake cycles, the on-time from
+   boot to halt, the time spent taking and metering photos, the cpu temperature
+   range and the lowest input voltage, so the power budget of each season can
+   be compared.
+
+   python3 powerreport.py [--log /home/bernard/git/timelapse/images/cycles.jsonl]
+
+   Uses only the Python standard library
+"""
+
+import json, argparse
+
+from collections import defaultdict
+
+
+# The PMIC reading of the 5V input, on a Pi 5
+INPUTVOLTS = "EXT5V_V"
+
+
+def read_log(logfile):
+    """Returns a list of cycle records from the log, lines which cannot be parsed, such as
+       one cut short by a power failure, are skipped"""
+    records = []
+    with open(logfile) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("boot") and record.get("halt") is not None:
+                records.append(record)
+    return records
+
+
+def summarise(records):
+    "Returns a dictionary of 'YYYY-MM':summary dictionary, from the cycle records"
+    months = defaultdict(list)
+    for record in records:
+        months[record["boot"][:7]].append(record)
+
+    summaries = {}
+    for month, cycles in sorted(months.items()):
+        days = {record["boot"][:10] for record in cycles}
+        ontime = sum(record["halt"] for record in cycles)
+        captures = [capture for record in cycles for capture in record.get("captures", [])]
+        camera = [capture["seconds"] for capture in captures if capture.get("seconds") is not None]
+        metering = [capture["metering"] for capture in captures if capture.get("metering") is not None]
+        starts = [record["start"] for record in cycles if record.get("start") is not None]
+        temperatures = [t for record in cycles for t in record.get("temperature", []) if t is not None]
+        volts = [record["pmic"][INPUTVOLTS] for record in cycles if (record.get("pmic") or {}).get(INPUTVOLTS) is not None]
+        summaries[month] = {
+            "days": len(days),
+            "cycles": len(cycles),
+            "held": sum(1 for record in cycles if record.get("held")),
+            "ontime": ontime,
+            "minutesperday": ontime / 60 / len(days),
+            "secondspercycle": ontime / len(cycles),
+            "start": sum(starts) / len(starts) if starts else None,
+            "photos": len(captures),
+            "faults": sum(len(record.get("faults", [])) for record in cycles),
+            "camera": sum(camera) / len(camera) if camera else None,
+            "metering": sum(metering) / len(metering) if metering else None,
+            "mintemperature": min(temperatures) if temperatures else None,
+            "maxtemperature": max(temperatures) if temperatures else None,
+            "minvolts": min(volts) if volts else None,
+        }
+    return summaries
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def report(summaries):
+    "Prints the monthly summaries as a table"
+    print(f"{'month':8} {'days':>4} {'cycles':>6} {'held':>4} {'on min/day':>10} {'s/cycle':>7} {'boot s':>6} "
+          f"{'photos':>6} {'faults':>6} {'camera s':>8} {'meter s':>7} {'temp C':>11} {'min V':>5}")
+    for month, s in summaries.items():
+        temps = "-" if s["mintemperature"] is None else f"{s['mintemperature']:.0f}-{s['maxtemperature']:.0f}"
+        print(f"{month:8} {s['days']:>4} {s['cycles']:>6} {s['held']:>4} {s['minutesperday']:>10.1f} {s['secondspercycle']:>7.0f} "
+              f"{_fmt(s['start'], '>6.1f')} {s['photos']:>6} {s['faults']:>6} {_fmt(s['camera'], '>8.1f')} {_fmt(s['metering'], '>7.3f')} "
+              f"{temps:>11} {_fmt(s['minvolts'], '>5.2f')}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Summarise the wake cycle log by month")
+    parser.add_argument("--log", default="/home/bernard/git/timelapse/images/cycles.jsonl")
+    args = parser.parse_args()
+
+    report(summarise(read_log(args.log)))
@@ -0,0 +1,120 @@
+"""Reduced size proxies of the photos, for quick preview renders of the film
+
+   For each image, proxies at 1/4 and 1/8 of its size are made once, from a single
+   reduced scale JPEG decode, and kept in proxies/4 and proxies/8 within the image
+   directory, with the same filenames. A manifest there records the sha1 of each
+   source image, so a proxy is only made again if its source changes. As with
+   adjust.py, the source is only hashed if its size or modification time differ.
+
+   A proxy of a 4000x3000 photo is 1000x750 at 1/4, and 500x375 at 1/8, so the
+   whole film pipeline runs on them in seconds, see --preview in adjust.py and
+   makevid.py.
+
+   python3 proxy.py [path]
+
+   brings the proxies of the images in path up to date.
+
+   Requires environment with pillow
+"""
+
+import os, sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import sharedpath
+
+from frameindex import file_signature, unchanged, load_json, save_json
+
+
+# Reductions made for each image, the first is decoded from the source, the others
+# are reduced from it, so each must be a multiple of the first
+SCALES = (4, 8)
+
+QUALITY = 90
+
+PROXYDIR = "proxies"
+
+# Name of the manifest file kept in the proxy directory
+MANIFEST = "proxy_manifest.json"
+
+
+def proxy_dir(path, scale):
+    "Returns the directory holding the proxies at the given scale of the images in path"
+    return os.path.join(path, PROXYDIR, str(scale))
+
+
+def make_proxies(infile, outfiles):
+    """Makes the proxies of the image infile, outfiles is a dictionary of scale:filename
+       The image is decoded once, at the smallest reduction, with reduced scale decoding"""
+    first = min(outfiles)
+    with Image.open(infile) as img:
+        size = (img.width // first, img.height // first)
+        img.draft("RGB", size)
+        img = img.convert("RGB")
+    if img.size != size:
+        # not a JPEG, or draft could not reduce it exactly
+        img = img.resize(size, Image.BOX)
+    for scale, outfile in sorted(outfiles.items()):
+        factor = scale // first
+        proxy = img if factor == 1 else img.reduce(factor)
+        proxy.save(outfile + ".tmp", "JPEG", quality=QUALITY)
+        os.replace(outfile + ".tmp", outfile)
+
+
+def update_proxies(path, images, workers=None):
+    """Makes the proxies of any of images in path which are missing, or whose source has
+       changed. Returns the number of images whose proxies were made"""
+    for scale in SCALES:
+        os.makedirs(proxy_dir(path, scale), exist_ok=True)
+    manifestfile = os.path.join(path, PROXYDIR, MANIFEST)
+    manifest = load_json(manifestfile)
+
+    jobs = []
+    for image in images:
+        infile = os.path.join(path, image)
+        outfiles = {scale:os.path.join(proxy_dir(path, scale), image) for scale in SCALES}
+        entry = manifest.get(image)
+        signature = file_signature(infile, entry)
+        if unchanged(signature, entry) and all(os.path.exists(outfile) for outfile in outfiles.values()):
+            # record the current size and time, so it is not hashed again
+            entry.update(signature)
+            continue
+        jobs.append((image, infile, outfiles, signature))
+
+    if jobs:
+        def work(job):
+            image, infile, outfiles, entry = job
+            try:
+                make_proxies(infile, outfiles)
+            except (OSError, ValueError) as e:
+                print(f"Unable to make proxies of {image}: {e}")
+                return image, None
+            return image, entry
+
+        # Pillow releases the GIL while decoding and encoding, so threads run in parallel
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for image, entry in executor.map(work, jobs):
+                if entry is not None:
+                    manifest[image] = entry
+
+    save_json(manifestfile, manifest)
+    return len(jobs)
+
+
+def proxies(path, images, scale, workers=None):
+    "Brings the proxies of images in path up to date, and returns the directory of those at scale"
+    if scale not in SCALES:
+        raise ValueError(f"Proxies are made at scales {SCALES}, not {scale}")
+    made = update_proxies(path, images, workers)
+    if made:
+        print(f"{made} images given proxies")
+    return proxy_dir(path, scale)
+
+
+if __name__ == "__main__":
+
+    path = sys.argv[1] if len(sys.argv) > 1 else "/home/bernard/git/timelapse/images"
+    images = sorted(img for img in os.listdir(path) if img.endswith(".jpeg"))
+    print(f"{update_proxies(path, images)} of {len(images)} images given proxies")
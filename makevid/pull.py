@@ -0,0 +1,234 @@
+"""Copy new photos from the Pi, using the transfer manifest written by altpower.py
+
+   Rather than rsync comparing every file in the images directory on both sides,
+   this reads the manifest (see transfer.py) from the position it reached last
+   time, and copies only the files added since. The last sequence number copied
+   and verified, and its position in the manifest, are kept in PULLSTATE in the
+   destination directory, and are only advanced once a file has been copied and
+   its sha1 checked, so an interrupted pull carries on where it stopped, and a
+   partly copied file is resumed from its .part file.
+
+   Each copied file is given the modification time it has on the Pi, recorded in the
+   manifest, so the frame index here, see frameindex.py, sees it as unchanged.
+
+   The small files SMALLFILES, the frame index and logs, are copied whole each time.
+   The Pi's frame index is copied to PIINDEX, and its entries for the photos here are
+   merged into the frame index here, rather than replacing it.
+
+   Files deleted on the Pi, such as frames replaced by previews, are only deleted
+   here if --delete is given.
+
+   python3 pull.py [--source bernard@timelapse:/home/bernard/git/timelapse/images] [--dest images] [--delete]
+
+   The source may be host:path, read with ssh, which must be able to log in without
+   a password, or a local directory, which stands in for the Pi when testing.
+
+   Uses only the Python standard library and ssh
+"""
+
+import os, sys, time, shlex, sqlite3, pathlib, argparse, subprocess
+
+from contextlib import contextmanager
+
+import sharedpath
+
+from transfer import read_entries, MANIFESTNAME
+from frameindex import FrameIndex, file_sha1, load_json, save_json, INDEXNAME
+
+
+PULLSTATE = ".pullstate.json"
+
+SMALLFILES = (INDEXNAME, "cycles.jsonl", "timing.log", "exposure.json")
+
+# The name the Pi's frame index is copied to, to be merged into the one here
+PIINDEX = "frames_pi.db"
+
+BLOCK = 1 << 20
+
+# ssh options which share one connection between the many ssh commands of a pull
+SSHOPTIONS = ["-o", "ControlMaster=auto", "-o", "ControlPath=~/.ssh/pull-%r@%h:%p", "-o", "ControlPersist=60"]
+
+
+class LocalSource:
+    "A directory on this computer, standing in for the images directory on the Pi"
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    def size(self, name):
+        "Returns the size of the file name, or None if it does not exist"
+        try:
+            return (self.path / name).stat().st_size
+        except OSError:
+            return None
+
+    @contextmanager
+    def open(self, name, offset=0):
+        "Opens the file name for binary reading from offset"
+        with open(self.path / name, "rb") as f:
+            f.seek(offset)
+            yield f
+
+
+class SSHSource:
+    "The images directory on the Pi, read with ssh"
+
+    def __init__(self, host, path):
+        self.host = host
+        self.path = path
+
+    def _remote(self, name):
+        return shlex.quote(f"{self.path.rstrip('/')}/{name}")
+
+    def size(self, name):
+        "Returns the size of the file name, or None if it does not exist"
+        result = subprocess.run(["ssh", *SSHOPTIONS, self.host, f"stat -c %s {self._remote(name)}"],
+                                capture_output=True, text=True)
+        if result.returncode:
+            return None
+        return int(result.stdout)
+
+    @contextmanager
+    def open(self, name, offset=0):
+        "Opens the file name for binary reading from offset"
+        proc = subprocess.Popen(["ssh", *SSHOPTIONS, self.host, f"tail -c +{offset + 1} {self._remote(name)}"],
+                                stdout=subprocess.PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            if proc.wait():
+                raise OSError(f"unable to read {name} from {self.host}")
+
+
+def make_source(source):
+    "Returns a source for 'host:path', or for a local directory"
+    host, sep, path = source.partition(":")
+    if sep and not os.path.exists(source) and "/" not in host:
+        return SSHSource(host, path)
+    return LocalSource(source)
+
+
+def load_state(dest):
+    return load_json(dest / PULLSTATE, {"seq":0, "offset":0})
+
+
+def save_state(dest, state):
+    save_json(dest / PULLSTATE, state)
+
+
+def copy_from(source, name, partpath, offset):
+    "Appends the file name from the source, starting at offset, to partpath, returns bytes copied"
+    copied = 0
+    with source.open(name, offset) as f, open(partpath, "ab" if offset else "wb") as out:
+        for block in iter(lambda: f.read(BLOCK), b""):
+            out.write(block)
+            copied += len(block)
+    return copied
+
+
+def set_mtime(filepath, entry):
+    "Gives filepath the modification time of a manifest entry, if it has one"
+    if "mtime_ns" in entry and filepath.stat().st_mtime_ns != entry["mtime_ns"]:
+        os.utime(filepath, ns=(time.time_ns(), entry["mtime_ns"]))
+
+
+def fetch(source, dest, entry):
+    """Copies the file of a manifest entry into dest, resuming any .part file, and checks
+       its size and sha1. Returns the bytes copied, raises OSError if it cannot be copied"""
+    name = entry["name"]
+    filepath = dest / name
+    if filepath.exists() and filepath.stat().st_size == entry["size"] and file_sha1(filepath) == entry["sha1"]:
+        # already here, perhaps copied by rsync
+        set_mtime(filepath, entry)
+        return 0
+    partpath = dest / (name + ".part")
+    offset = partpath.stat().st_size if partpath.exists() else 0
+    if offset > entry["size"]:
+        offset = 0
+    copied = copy_from(source, name, partpath, offset)
+    if partpath.stat().st_size != entry["size"] or file_sha1(partpath) != entry["sha1"]:
+        if not offset:
+            raise OSError(f"{name} does not match the manifest, it may have changed on the Pi")
+        # the partial file may have been of an earlier version, start again
+        copied += copy_from(source, name, partpath, 0)
+        if partpath.stat().st_size != entry["size"] or file_sha1(partpath) != entry["sha1"]:
+            raise OSError(f"{name} does not match the manifest, it may have changed on the Pi")
+    set_mtime(partpath, entry)
+    os.replace(partpath, filepath)
+    return copied
+
+
+def pull(source, dest, delete=False):
+    """Copies the files added to the manifest of source since the last pull into dest,
+       and the SMALLFILES. Returns a dictionary of the numbers of files copied and deleted,
+       the bytes copied, the number of index entries merged, and any error which stopped the pull"""
+    dest = pathlib.Path(dest)
+    dest.mkdir(parents=True, exist_ok=True)
+    state = load_state(dest)
+    result = {"copied":0, "deleted":0, "bytes":0, "indexed":0, "error":None}
+
+    size = source.size(MANIFESTNAME)
+    if size is None:
+        result["error"] = f"no {MANIFESTNAME} at the source"
+        return result
+    if size < state["offset"]:
+        # the manifest has been replaced, read it from the start
+        state = {"seq":0, "offset":0}
+
+    with source.open(MANIFESTNAME, state["offset"]) as f:
+        entries = [(entry, offset) for entry, offset in read_entries(f, state["offset"]) if entry["seq"] > state["seq"]]
+
+    # only the last entry for each name matters, taken in the order of those last entries,
+    # so that once one is done, every entry before it is either done or superseded
+    latest = {}
+    for entry, offset in entries:
+        latest.pop(entry["name"], None)
+        latest[entry["name"]] = (entry, offset)
+
+    for entry, offset in latest.values():
+        try:
+            if entry["action"] == "add":
+                result["bytes"] += fetch(source, dest, entry)
+                result["copied"] += 1
+            elif entry["action"] == "delete" and delete and (dest / entry["name"]).exists():
+                os.remove(dest / entry["name"])
+                result["deleted"] += 1
+        except OSError as e:
+            result["error"] = str(e)
+            break
+        save_state(dest, {"seq":entry["seq"], "offset":offset})
+
+    for name in SMALLFILES:
+        if source.size(name) is None:
+            continue
+        localname = PIINDEX if name == INDEXNAME else name
+        partpath = dest / (localname + ".part")
+        result["bytes"] += copy_from(source, name, partpath, 0)
+        os.replace(partpath, dest / localname)
+
+    if (dest / PIINDEX).exists():
+        try:
+            with FrameIndex(dest / INDEXNAME) as index:
+                result["indexed"] = index.merge(dest / PIINDEX, dest)
+        except sqlite3.Error as e:
+            result["error"] = result["error"] or f"unable to merge {PIINDEX}: {e}"
+
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Copy new photos from the Pi")
+    parser.add_argument("--source", default="bernard@timelapse:/home/bernard/git/timelapse/images")
+    parser.add_argument("--dest", default=os.path.expanduser("~/git/timelapse/images"))
+    parser.add_argument("--delete", action="store_true", help="delete files deleted on the Pi")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    result = pull(make_source(args.source), args.dest, args.delete)
+    print(f"{result['copied']} files copied, {result['deleted']} deleted, {result['bytes']} bytes, "
+          f"{result['indexed']} index entries merged, in {time.monotonic() - start:.1f}s")
+    if result["error"]:
+        print(f"Stopped: {result['error']}")
+        sys.exit(1)
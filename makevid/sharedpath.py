@@ -0,0 +1,15 @@
+"""Puts the parent directory on sys.path, so that the scripts here can import the modules
+   they share with the capture scripts, such as metering.py, frameindex.py and transfer.py
+
+   import sharedpath
+
+   before importing any of them.
+"""
+
+import sys, pathlib
+
+
+PARENT = str(pathlib.Path(__file__).resolve().parent.parent)
+
+if PARENT not in sys.path:
+    sys.path.insert(0, PARENT)
@@ -0,0 +1,129 @@
+"""Frame alignment for the film
+
+   Wind and thermal drift move the camera slightly from day to day, so the tree
+   jitters in the film. This measures the shift of each frame against a reference
+   frame, the first of the film, by phase correlation of grayscale 1/SCALE size
+   proxies (see proxy.py), and makevid.py shifts each frame back as it is streamed
+   into the video writer.
+
+   The shifts are kept in a small JSON cache file, with the size, modification time
+   and sha1 of each frame, so only new or changed frames are measured. If the reference
+   frame or the parameters change, every frame is measured again.
+
+   A shift is only trusted if the correlation peak is at least MINRESPONSE, and it
+   is no more than MAXSHIFT, otherwise the frame is left unshifted, as a frame
+   of snow or fog does not match the reference well enough to align it.
+
+   Requires environment with opencv-python and numpy
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+import sharedpath
+
+from proxy import proxies
+from frameindex import file_signature, unchanged, load_json, save_json
+
+
+# Proxy scale on which shifts are measured
+SCALE = 4
+
+# Correlation peak below which a shift is not trusted
+MINRESPONSE = 0.05
+
+# Largest shift, in pixels of the full frame, which is applied
+MAXSHIFT = 200
+
+PARAMS = {"scale":SCALE, "minresponse":MINRESPONSE, "maxshift":MAXSHIFT}
+
+
+def gray(filename):
+    "Returns the image as a float32 grayscale array, for phase correlation"
+    img = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise OSError(f"Unable to read {filename}")
+    return img.astype(np.float32)
+
+
+def measure_shift(reference, img, window):
+    """Returns (dx, dy, response), the shift of img from reference in pixels of the
+       arrays, and the height of the correlation peak, 0.0 to 1.0"""
+    (dx, dy), response = cv2.phaseCorrelate(reference, img, window)
+    return dx, dy, response
+
+
+def load_cache(cachefile):
+    "Returns the cache dictionary, with no shifts if there is none or its parameters have changed"
+    cache = load_json(cachefile, {"reference":None, "shifts":{}})
+    if cache.get("params") != PARAMS:
+        return {"reference":None, "shifts":{}}
+    return cache
+
+
+def save_cache(cachefile, cache):
+    "Writes the cache, replacing any previous one atomically"
+    cache["params"] = PARAMS
+    save_json(cachefile, cache)
+
+
+def frame_shifts(path, images, cachefile=None, workers=None):
+    """Returns a dictionary of image:(dx, dy), the shift in pixels of each of images in path,
+       in film order, from the first, which is the reference
+
+       cachefile defaults to stabilize.json in path"""
+    if not images:
+        return {}
+    if cachefile is None:
+        cachefile = os.path.join(path, "stabilize.json")
+    cache = load_cache(cachefile)
+
+    reference = images[0]
+    previous = cache["reference"] if isinstance(cache["reference"], dict) and cache["reference"].get("name") == reference else None
+    refkey = dict(file_signature(os.path.join(path, reference), previous), name=reference)
+    if not unchanged(refkey, previous):
+        cache = {"reference":refkey, "shifts":{}}
+    cache["reference"] = refkey
+    shifts = cache["shifts"]
+
+    todo = []
+    for image in images:
+        entry = shifts.get(image)
+        signature = file_signature(os.path.join(path, image), entry)
+        if unchanged(signature, entry):
+            entry.update(signature)
+        else:
+            todo.append((image, signature))
+
+    if todo:
+        proxydir = proxies(path, images, SCALE, workers)
+        ref = gray(os.path.join(proxydir, reference))
+        window = cv2.createHanningWindow(ref.shape[::-1], cv2.CV_32F)
+        for image, signature in todo:
+            img = gray(os.path.join(proxydir, image))
+            if img.shape != ref.shape:
+                img = cv2.resize(img, ref.shape[::-1], interpolation=cv2.INTER_AREA)
+            dx, dy, response = measure_shift(ref, img, window)
+            shifts[image] = dict(signature, dx=dx * SCALE, dy=dy * SCALE, response=response)
+        print(f"{len(todo)} frames aligned")
+        save_cache(cachefile, cache)
+
+    result = {}
+    for image in images:
+        entry = shifts[image]
+        if entry["response"] < MINRESPONSE or max(abs(entry["dx"]), abs(entry["dy"])) > MAXSHIFT:
+            result[image] = (0.0, 0.0)
+        else:
+            result[image] = (entry["dx"], entry["dy"])
+    return result
+
+
+def apply_shift(frame, dx, dy):
+    "Returns the OpenCV frame moved back by the shift dx, dy, the edges are filled by repeating the border"
+    if abs(dx) < 0.1 and abs(dy) < 0.1:
+        return frame
+    height, width = frame.shape[:2]
+    matrix = np.float32([[1, 0, -dx], [0, 1, -dy]])
+    return cv2.warpAffine(frame, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
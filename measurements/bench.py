@@ -0,0 +1,249 @@
+"""Benchmarks of the capture and video pipelines, on synthetic photos
+
+   Generates FRAMES synthetic 4000x3000 JPEG photos in a work directory (kept, so
+   later runs reuse them), then times each stage in a fresh process, giving the
+   seconds taken, the items per second and the peak resident memory:
+
+   brightness        metering.get_brightness after a full decode, of the fixtures
+                     and the sample photos in photos/
+   reduced           metering.file_brightness with reduced scale decoding, the same files
+   gamma             adjust.adjust_brightness_gamma of each fixture
+   adjust            the adjust.py batch, adjust_all, of all the fixtures
+   video             makevid.generate_video of the adjusted fixtures
+   takephoto         altpower.takephoto end to end, with a stub fswebcam which copies a
+                     fixture, dark for exposure 10 so a retake is needed, so everything
+                     but the webcam itself is timed
+
+   Results are printed, and saved as JSON to measurements/results, or to --output, and
+   with --compare, are compared with an earlier results file, so a change can be
+   checked for regressions.
+
+   Usage, from the top level timelapse directory:
+
+   python3 measurements/bench.py [--frames N] [--workdir DIR] [--stages a,b,..] [--output FILE] [--compare FILE]
+
+   Requires environment with pillow, numpy and opencv-python
+"""
+
+import os, sys, json, time, shutil, random, pathlib, platform, resource, argparse, subprocess
+
+from datetime import datetime, timezone, timedelta
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+# the capture scripts are in the parent directory, and the video scripts in makevid
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE.parent / "makevid"))
+
+FRAMES = 20
+WORKDIR = "/tmp/timelapse-bench"
+SIZE = (4000, 3000)
+STAGES = ("brightness", "reduced", "gamma", "adjust", "video", "takephoto")
+
+# first day of the fixtures, named as the mid-day photos image_YYYYMMDD12.jpeg
+FIRSTDAY = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+
+STUB = """#!{python}
+# stands in for fswebcam, copying a fixture to the output file, the last argument
+import sys, shutil
+exposure = 10
+for arg in sys.argv[1:]:
+    if arg.startswith("Exposure Time, Absolute="):
+        exposure = int(arg.split("=")[1])
+shutil.copyfile({dark!r} if exposure <= 10 else {normal!r}, sys.argv[-1])
+"""
+
+
+def make_fixture(filepath, level, seed):
+    """Writes a synthetic photo, a smooth random landscape of the given mean level 0 to 255,
+       with noise, so it compresses like a real photo rather than a flat colour"""
+    import numpy as np
+    import cv2
+    rng = np.random.default_rng(seed)
+    small = rng.random((SIZE[1] // 50, SIZE[0] // 50, 3)).astype(np.float32)
+    img = cv2.resize(small, SIZE, interpolation=cv2.INTER_CUBIC)
+    img = img * 120 + level - 60 + rng.normal(0, 8, (SIZE[1], SIZE[0], 3)).astype(np.float32)
+    cv2.imwrite(str(filepath), np.clip(img, 0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+
+def fixtures(workdir, frames):
+    "Makes any fixtures missing from workdir/fixtures, returns the list of their paths"
+    fixturedir = workdir / "fixtures"
+    fixturedir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(0)
+    paths = []
+    for n in range(frames):
+        filepath = fixturedir / f"image_{(FIRSTDAY + timedelta(days=n)).strftime('%Y%m%d%H')}.jpeg"
+        level = rng.uniform(20, 160)
+        if not filepath.exists():
+            make_fixture(filepath, level, n)
+        paths.append(filepath)
+    for name, level in (("dark.jpeg", 40), ("normal.jpeg", 100)):
+        if not (workdir / name).exists():
+            make_fixture(workdir / name, level, 1000 + level)
+    return paths
+
+
+def samples():
+    "Returns the sample photos in photos/"
+    return sorted(p for p in (HERE.parent / "photos").iterdir() if p.suffix.lower() in (".jpg", ".jpeg"))
+
+
+def stage_brightness(workdir, paths):
+    from PIL import Image
+    from metering import get_brightness, TESTX, TESTY
+    files = paths + samples()
+    for filepath in files:
+        with Image.open(filepath) as img:
+            # the samples may be smaller than the fixtures, so are metered at their centre
+            x, y = (TESTX, TESTY) if img.size == SIZE else (img.width // 2, img.height // 2)
+            get_brightness(img, x, y)
+    return len(files)
+
+
+def stage_reduced(workdir, paths):
+    from PIL import Image
+    from metering import file_brightness, TESTX, TESTY
+    files = paths + samples()
+    for filepath in files:
+        with Image.open(filepath) as img:
+            size = img.size
+        x, y = (TESTX, TESTY) if size == SIZE else (size[0] // 2, size[1] // 2)
+        file_brightness(filepath, x, y)
+    return len(files)
+
+
+def stage_gamma(workdir, paths):
+    from adjust import adjust_brightness_gamma
+    outdir = workdir / "gamma"
+    outdir.mkdir(exist_ok=True)
+    for filepath in paths:
+        adjust_brightness_gamma(filepath, 0.6, outdir / filepath.name)
+    return len(paths)
+
+
+def stage_adjust(workdir, paths):
+    from adjust import adjust_all
+    adjust_all(paths[0].parent, workdir / "adjusted", force=True, images=[p.name for p in paths])
+    return len(paths)
+
+
+def stage_video(workdir, paths):
+    from makevid import generate_video
+    if not (workdir / "adjusted").exists():
+        stage_adjust(workdir, paths)
+    return generate_video(str(workdir / "adjusted"), str(workdir / "movie.avi"), encoder="opencv")
+
+
+def stage_takephoto(workdir, paths):
+    bindir = workdir / "bin"
+    bindir.mkdir(exist_ok=True)
+    stub = bindir / "fswebcam"
+    stub.write_text(STUB.format(python=sys.executable, dark=str(workdir / "dark.jpeg"), normal=str(workdir / "normal.jpeg")))
+    stub.chmod(0o755)
+    os.environ["PATH"] = f"{bindir}{os.pathsep}{os.environ['PATH']}"
+
+    images = workdir / "images"
+    shutil.rmtree(images, ignore_errors=True)
+    images.mkdir()
+
+    import altpower
+    from camera import Camera
+    from cyclelog import CycleLog
+    from exposuremodel import ExposureModel
+    altpower.IMAGES = images
+    altpower.TIMINGLOG = images / "timing.log"
+    altpower.MANIFEST = images / "transfer.jsonl"
+    altpower.INDEXFILE = images / "frames.db"
+    altpower.CYCLE = CycleLog(images / "cycles.jsonl")
+    altpower.MODEL = ExposureModel(images / "exposure.json", altpower.LATITUDE, altpower.LONGITUDE)
+    # no such device, so the fswebcam backend is used, as on a Pi without OpenCV
+    altpower.CAMERA = Camera("/dev/no-such-video", altpower.CAMXY)
+    for n in range(len(paths)):
+        altpower.takephoto(FIRSTDAY + timedelta(days=n))
+    altpower.CAMERA.close()
+    return len(paths)
+
+
+def run_stage(name, workdir, frames):
+    """Runs a stage in this process, returns its result dictionary, peak memory includes
+       any worker processes"""
+    paths = fixtures(workdir, frames)
+    start = time.perf_counter()
+    items = globals()[f"stage_{name}"](workdir, paths)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {"seconds":seconds, "items":items, "per_second":items / seconds if seconds else None, "peak_rss_mb":peak / 1024}
+
+
+def run(stages, workdir, frames):
+    """Runs each stage in a fresh process, so its peak memory is its own, returns the results
+       The fixtures are made in a process of their own too, as on Linux a child process
+       starts with the peak memory of its parent"""
+    command = [sys.executable, __file__, "--workdir", str(workdir), "--frames", str(frames)]
+    subprocess.run(command + ["--stage", "fixtures"], check=True)
+    results = {}
+    for name in stages:
+        proc = subprocess.run(command + ["--stage", name], capture_output=True, text=True)
+        if proc.returncode:
+            print(f"{name} failed\n{proc.stderr}")
+            continue
+        results[name] = json.loads(proc.stdout.splitlines()[-1])
+        r = results[name]
+        print(f"{name:12} {r['seconds']:8.2f}s {r['items']:5} items {r['per_second']:8.2f}/s {r['peak_rss_mb']:8.1f} MB")
+    return results
+
+
+def compare(results, previous):
+    "Prints the change in time and memory of each stage from a previous results dictionary"
+    print()
+    print(f"{'stage':12} {'seconds':>8} {'was':>8} {'change':>7} {'MB':>8} {'was':>8}")
+    for name, r in results.items():
+        p = previous["results"].get(name)
+        if p is None:
+            continue
+        change = (r["seconds"] / r["items"]) / (p["seconds"] / p["items"]) - 1
+        print(f"{name:12} {r['seconds']:8.2f} {p['seconds']:8.2f} {change:+7.1%} {r['peak_rss_mb']:8.1f} {p['peak_rss_mb']:8.1f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the capture and video pipelines")
+    parser.add_argument("--frames", type=int, default=FRAMES)
+    parser.add_argument("--workdir", default=WORKDIR)
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated, from {','.join(STAGES)}")
+    parser.add_argument("--output", default=None, help="results file, default measurements/results/bench-DATE.json")
+    parser.add_argument("--compare", default=None, help="an earlier results file to compare with")
+    parser.add_argument("--stage", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    workdir = pathlib.Path(args.workdir)
+
+    if args.stage == "fixtures":
+        fixtures(workdir, args.frames)
+        sys.exit(0)
+
+    if args.stage:
+        # run as a child process of run(), the result is the last line of output
+        result = run_stage(args.stage, workdir, args.frames)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    stages = [s for s in args.stages.split(",") if s]
+    for name in stages:
+        if name not in STAGES:
+            parser.error(f"unknown stage {name}")
+
+    now = datetime.now(tz=timezone.utc)
+    results = run(stages, workdir, args.frames)
+    record = {"time":now.isoformat(timespec="seconds"), "frames":args.frames, "python":platform.python_version(),
+              "machine":platform.machine(), "cpus":os.cpu_count(), "results":results}
+
+    output = pathlib.Path(args.output) if args.output else HERE / "results" / f"bench-{now.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(record, indent=1))
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        compare(results, json.loads(pathlib.Path(args.compare).read_text()))
@@ -0,0 +1,98 @@
+"""Compares brightness metering with a full JPEG decode against reduced scale decoding
+
+   The images listed in comparison.txt in this directory are metered at scales
+   1 (full decode), 2, 4 and 8, and for each scale the time taken, the brightness
+   found, and its difference from the full decode and from the brightness
+   recorded in comparison.txt are printed.
+
+   Usage, from the top level timelapse directory:
+
+   python3 measurements/meterbench.py [imagedir] [extra image files ...]
+
+   imagedir defaults to images, any comparison.txt image not found there is skipped.
+   Extra image files are metered as well, with no recorded brightness to compare,
+   any too small to contain the test point is skipped.
+
+   Requires environment with pillow
+"""
+
+import sys, time, pathlib, statistics
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+# metering.py is in the parent directory
+sys.path.insert(0, str(HERE.parent))
+
+from metering import file_brightness, TESTX, TESTY
+
+SCALES = (1, 2, 4, 8)
+
+# each timing is the median of this number of runs
+REPEAT = 5
+
+
+def read_comparison(filename=HERE / "comparison.txt"):
+    "Returns a list of (imagename, recorded brightness) from the comparison table"
+    samples = []
+    for line in filename.read_text().splitlines():
+        fields = line.split()
+        if fields and fields[0].startswith("image_") and fields[0].endswith(".jpeg"):
+            samples.append((fields[0], float(fields[1])))
+    return samples
+
+
+def time_brightness(filepath, scale):
+    "Returns (median seconds, brightness) of metering the file at the given scale"
+    times = []
+    for n in range(REPEAT):
+        start = time.perf_counter()
+        b = file_brightness(filepath, TESTX, TESTY, scale)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), b
+
+
+def bench(samples):
+    """samples is a list of (filepath, recorded brightness or None)
+       prints a line per file and scale, then the mean time and error per scale"""
+    totals = {scale:[] for scale in SCALES}
+    print(f"{'image':28} {'scale':>5} {'ms':>8} {'brightness':>10} {'vs full':>8} {'vs table':>8}")
+    for filepath, recorded in samples:
+        try:
+            results = [(scale,) + time_brightness(filepath, scale) for scale in SCALES]
+        except ValueError as e:
+            # such as a photo from another camera, smaller than the test point
+            print(f"{filepath.name}: {e}, skipping")
+            continue
+        full = results[0][2]
+        for scale, seconds, b in results:
+            table = "" if recorded is None else f"{b - recorded:+8.3f}"
+            print(f"{filepath.name:28} {scale:5} {seconds*1000:8.1f} {b:10.4f} {b - full:+8.4f} {table:>8}")
+            totals[scale].append((seconds, abs(b - full)))
+    if not any(totals.values()):
+        print("No images found")
+        return
+    print()
+    print(f"{'scale':>5} {'mean ms':>8} {'speedup':>8} {'max error':>10}")
+    fulltime = statistics.mean(t for t, e in totals[1])
+    for scale in SCALES:
+        meantime = statistics.mean(t for t, e in totals[scale])
+        maxerror = max(e for t, e in totals[scale])
+        print(f"{scale:5} {meantime*1000:8.1f} {fulltime/meantime:8.2f} {maxerror:10.4f}")
+
+
+if __name__ == "__main__":
+
+    imagedir = pathlib.Path(sys.argv[1]) if len(sys.argv) > 1 else pathlib.Path("images")
+
+    samples = []
+    for name, recorded in read_comparison():
+        filepath = imagedir / name
+        if filepath.exists():
+            samples.append((filepath, recorded))
+        else:
+            print(f"{filepath} not found, skipping")
+
+    for name in sys.argv[2:]:
+        samples.append((pathlib.Path(name), None))
+
+    bench(samples)
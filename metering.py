@@ -0,0 +1,192 @@
+"""Shared brightness metering, used by altpower.py, brightness.py and makevid/adjust.py
+
+   The image is cropped once around each test patch, each crop is reduced to a
+   single luma band and its 256 bin histogram is read. All statistics (mean,
+   percentiles, clipped pixel fraction) are then calculated from the histogram,
+   so the pixel work is done inside Pillow rather than by calling getpixel
+   1600 times per patch.
+
+   meter_file and file_brightness open a JPEG with reduced scale decoding, where
+   libjpeg only performs part of the inverse DCT, giving an image of 1/2, 1/4 or
+   1/8 size for a fraction of the cpu time and memory of a full decode. Patch
+   coordinates are given in full size pixels and are mapped to the reduced image.
+
+   Requires pillow
+"""
+
+from PIL import Image, ImageStat
+
+
+# Weights applied to R, G, B when reducing a patch to a single brightness band.
+
+# EQUAL gives the plain (R+G+B)/3 used when the exposure thresholds in altpower.py
+# were chosen, (see measurements/comparison.txt) so get_brightness keeps using it.
+EQUAL = (1/3, 1/3, 1/3)
+
+# LUMA is the ITU-R 601 weighting, in which green is emphasised, as a standard
+# brightness measurement would be.
+LUMA = (0.299, 0.587, 0.114)
+
+# Default size in pixels of the square test patch
+PATCH = 40
+
+# Image brightness is tested by inspecting a patch at position TESTX, TESTY of the full size photo
+# So these values should be chosen at a static representative point of the image. In my case this
+# is a patch of grass. Shared by altpower.py, frameindex.py and the scripts in makevid
+TESTX = 3500
+TESTY = 2500
+
+# A pixel with a brightness level at or above this value (0 to 255) is counted as clipped
+CLIP = 250
+
+# Default percentiles returned by get_stats
+PERCENTILES = (5, 50, 95)
+
+# The brightness (equal weights) aimed for by exposure_score, chosen from measurements/comparison.txt
+# where a photo at exposure 10 with brightness 0.246 was best retaken at 15, and one of 0.187 at 20
+TARGET = 0.33
+
+# Default reduced decoding scale used by meter_file and file_brightness, one of 1, 2, 4, 8
+# see measurements/meterbench.py for the time and accuracy of each
+SCALE = 8
+
+
+def patch_box(x, y, size=PATCH, imgsize=None, scale=1):
+    """Returns the (left, upper, right, lower) box of a square patch centred on x, y
+       If scale is given, x, y and size are full size pixels, and the box is mapped
+       to an image reduced by that factor.
+       If imgsize (width, height) is given the box is clipped to lie within the image"""
+    half = size // 2
+    left, upper = x - half, y - half
+    right, lower = left + size, upper + size
+    if scale != 1:
+        # keep at least one pixel, however small the patch
+        left, upper = round(left / scale), round(upper / scale)
+        right, lower = max(round(right / scale), left + 1), max(round(lower / scale), upper + 1)
+    if imgsize is not None:
+        width, height = imgsize
+        left, upper = max(left, 0), max(upper, 0)
+        right, lower = min(right, width), min(lower, height)
+        if right <= left or lower <= upper:
+            raise ValueError(f"Test patch at {x}, {y} lies outside the image")
+    return (left, upper, right, lower)
+
+
+def patch_histogram(img, x, y, size=PATCH, weights=EQUAL, scale=1):
+    """Returns a 256 bin histogram of the weighted brightness of the patch
+       centred on x, y"""
+    crop = img.crop(patch_box(x, y, size, img.size, scale))
+    if crop.mode != "RGB":
+        crop = crop.convert("RGB")
+    # a single matrix conversion does the weighted sum of R, G, B for every pixel
+    band = crop.convert("L", matrix=tuple(weights) + (0,))
+    return band.histogram()
+
+
+def histogram_stats(hist, percentiles=PERCENTILES, clip=CLIP):
+    """Given a 256 bin histogram, returns a dictionary of statistics, with
+       values scaled between 0.0 and 1.0
+
+       mean        - the mean brightness
+       percentiles - a dictionary of percentile:brightness
+       clipped     - the fraction of pixels at or above the clip level
+       pixels      - the number of pixels counted
+    """
+    pixels = sum(hist)
+    if not pixels:
+        raise ValueError("No pixels in the metered region")
+
+    total = sum(level * count for level, count in enumerate(hist))
+
+    # walk the cumulative histogram once, picking off each percentile as it is passed
+    wanted = sorted(percentiles)
+    found = {}
+    cumulative = 0
+    index = 0
+    for level, count in enumerate(hist):
+        cumulative += count
+        while index < len(wanted) and cumulative * 100 >= wanted[index] * pixels:
+            found[wanted[index]] = level / 255
+            index += 1
+        if index == len(wanted):
+            break
+
+    return {"mean": total / (pixels * 255),
+            "percentiles": found,
+            "clipped": sum(hist[clip:]) / pixels,
+            "pixels": pixels}
+
+
+def get_stats(img, patches, size=PATCH, weights=LUMA, percentiles=PERCENTILES, clip=CLIP, scale=1):
+    """Meters the image over one or more test patches
+
+       patches is a list of (x, y) points, each the centre of a square patch of the given size.
+       scale is the factor by which img is reduced from the size the points are given in.
+       Returns the dictionary given by histogram_stats for all the patches taken together,
+       with an extra key 'patches' holding the mean brightness of each patch in turn."""
+    combined = [0] * 256
+    means = []
+    for x, y in patches:
+        hist = patch_histogram(img, x, y, size, weights, scale)
+        combined = [a + b for a, b in zip(combined, hist)]
+        means.append(histogram_stats(hist, (), clip)["mean"])
+    stats = histogram_stats(combined, percentiles, clip)
+    stats["patches"] = means
+    return stats
+
+
+def exposure_score(stats, target=TARGET, clipweight=1.0):
+    """Given statistics from get_stats, returns a score of how well exposed the patch is,
+       higher is better, 0.0 being a mean brightness exactly on target with nothing clipped"""
+    return -abs(stats["mean"] - target) - clipweight * stats["clipped"]
+
+
+def get_brightness(img, x, y, scale=1):
+    """Returns a value between 0.0 and 1.0, where 1.0 is max brightness
+       This is tested around the given x, y point of the image, with R, G and B
+       weighted equally, as the exposure thresholds were chosen this way"""
+    # the band means are exact, whereas the histogram of a weighted band is of
+    # rounded values, so this matches the original per-pixel sum precisely
+    crop = img.crop(patch_box(x, y, PATCH, img.size, scale))
+    if crop.mode != "RGB":
+        crop = crop.convert("RGB")
+    return sum(ImageStat.Stat(crop).mean) / (3 * 255)
+
+
+def open_reduced(filename, scale=SCALE):
+    """Opens an image, if it is a JPEG, sets it to be decoded at 1/scale size.
+       Returns the image, and the actual factor by which it is reduced, which
+       is 1 for other formats"""
+    img = Image.open(filename)
+    width = img.width
+    if scale > 1 and img.format == "JPEG":
+        # draft only takes effect before the image data is loaded, and
+        # picks the largest DCT scale giving at least the requested size
+        img.draft("RGB", (width // scale, img.height // scale))
+    return img, width / img.width
+
+
+def file_brightness(filename, x, y, scale=SCALE):
+    "As get_brightness, but opens the file with reduced scale decoding"
+    img, factor = open_reduced(filename, scale)
+    with img:
+        return get_brightness(img, x, y, factor)
+
+
+def meter_file(filename, patches, scale=SCALE, **kwargs):
+    """As get_stats, but opens the file with reduced scale decoding,
+       patches are given in full size pixel coordinates"""
+    img, factor = open_reduced(filename, scale)
+    with img:
+        return get_stats(img, patches, scale=factor, **kwargs)
+
+
+def file_stats(filename, x, y, scale=SCALE):
+    """Opens the file once, with reduced scale decoding, and returns the get_stats
+       dictionary for the patch at x, y, with an extra key 'brightness' holding
+       the get_brightness value"""
+    img, factor = open_reduced(filename, scale)
+    with img:
+        stats = get_stats(img, [(x, y)], scale=factor)
+        stats["brightness"] = get_brightness(img, x, y, factor)
+    return stats
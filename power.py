@@ -19,21 +19,28 @@
 
    This script starts as a service on boot (run as root).
 
-   Loop:
+   The on and off times are set by SCHEDULE, a list of windows, see schedule.py
+   which with the default schedule does:
 
-        If the hour is 10, 11, 12, 13 or 14 and no photo taken yet, then take it.
+        Wake at 9:55, and at 10:00, 11:00, 12:00, 13:00 and 14:00 take a photo,
+        then set RTC to turn Pi on for the next photo and shut down.
 
-        If the hour is one of 10, 11, 12, 13 set RTC to turn Pi on at hour plus one 
+        After the 14:00 photo, set RTC to turn Pi on at 18:00 and shut down.
 
-        If current time is between 14:00 and 17:55:
-              Set RTC to turn Pi on at 18:00
-              Shut down Pi
+        Between 18:00 and 18:10 stay on, then set RTC to turn Pi on at 9:55
+        next day and shut down.
 
-        If current time is between 18:10 and 9:50 next day:
-               Set RTC to turn Pi on at 9:55
-               Shut down Pi
+   Each photo is taken as soon as the Pi boots, and the Pi halts straight after,
+   unless held on by an ssh session or the hold file HOLDFILE, see poweroff.py.
+   The evening window is the time to connect. The seconds from boot to halt, with
+   the other timings of the cycle, are written to CYCLELOG, see cyclelog.py, as
+   power.service sends standard output to /dev/null.
 
-        Otherwise, Wait 5 seconds, continue loop
+   fswebcam is stopped if it takes longer than TIMEOUT seconds, and the watchdog
+   process, see watchdog.py, writes the wakealarm and halts the Pi should the cycle
+   overrun BUDGET seconds, not counting deliberate waits.
+
+   To replay a year of schedules offline, and compare their on-time, see simulate.py
 
    Note, all times are obtained with timezone.utc, if using this in other
    timezones, this must be altered accordingly.
@@ -46,10 +53,43 @@ import sys, time, subprocess, pathlib
 
 from datetime import datetime, timezone, timedelta
 
+from schedule import run_cycle, next_wake, DEFAULT, MINSLEEP
+
+from poweroff import uptime, held, set_wakealarm, halt, HOLDPOLL
+
+from cyclelog import CycleLog
+
+from watchdog import Watchdog, RETRYWAKE
+
 TIMEZONE = timezone.utc
 
 IMAGES = pathlib.Path("/home/bernard/git/timelapse/images")
 
+# A JSON line for each wake cycle, with boot to halt timings, captures, temperature and
+# voltages, is appended to CYCLELOG, see cyclelog.py, as standard output goes nowhere
+CYCLELOG = IMAGES / "cycles.jsonl"
+CYCLE = CycleLog(CYCLELOG)
+
+# Seconds to wait on boot before running the schedule, the evening maintenance window
+# is the time to connect, this was 240 on every boot
+GRACE = 0
+
+# While this file exists, or an ssh session is open, the Pi is not halted, see poweroff.py
+HOLDFILE = IMAGES.parent / "hold"
+
+# The capture and maintenance windows, see schedule.py
+SCHEDULE = DEFAULT
+
+# Seconds fswebcam is allowed for a photo
+TIMEOUT = 60
+
+# Seconds of work a wake cycle may take before the watchdog halts the Pi, see watchdog.py
+BUDGET = 600
+
+# The state shared with the watchdog process, on tmpfs so that it can be written even
+# when the disk is full
+WATCHDOGFILE = pathlib.Path("/run/timelapse-watchdog.json")
+
 
 def takephoto(timestamp):
     """Takes a photo, and places it into the folder given by global variable IMAGES
@@ -76,77 +116,46 @@ def takephoto(timestamp):
     #
     ##
 
-    subprocess.run(["fswebcam", "-r", "4000x3000",
-                    "--set", "Auto Exposure=Manual Mode",
-                    "--set", "Exposure Time, Absolute=10",
-                    "--no-banner",
-                    "-D", "4", "-S", "12", "--jpeg", "95", str(filepath)])
-
-
-
+    start = time.monotonic()
+    try:
+        subprocess.run(["fswebcam", "-r", "4000x3000",
+                        "--set", "Auto Exposure=Manual Mode",
+                        "--set", "Exposure Time, Absolute=10",
+                        "--no-banner",
+                        "-D", "4", "-S", "12", "--jpeg", "95", str(filepath)], timeout=TIMEOUT)
+    except subprocess.TimeoutExpired:
+        print(f"fswebcam did not finish in {TIMEOUT} seconds")
+        CYCLE.fault(f"{timestampstring}: fswebcam timed out")
+        return
+    CYCLE.capture(filename, 10, time.monotonic() - start)
 
-def get_epoch():
-    """Returns epoch in seconds when the pi should next be powered up, this is
-       either at 9:55, 10:00, 11:00, 12:00, 13:00, 14:00 or 18:00 depending on which is next.
 
-       If the current hour is 10, 11, 12, 13 or 14, takes photo.
- 
-       If the hour is one of 10, 11, 12, 13 set RTC to turn Pi on at hour plus one 
 
-       If current time is between 14:00 and 17:55:
-              Set RTC to turn Pi on at 18:00
-              Shut down Pi
 
-       If current time is between 18:10 and 9:50 next day:
-              Set RTC to turn Pi on at 9:55
-              Shut down Pi
+def capture(timestamp):
+    "Called by the schedule when a capture window opens"
+    # Take the photo
+    takephoto(timestamp)
 
-       Otherwise, Wait 5 seconds, continue loop
-    """
 
+def fallback_wake(deadline):
+    "Returns the epoch of the next scheduled wake after the epoch deadline, for the watchdog"
+    after = datetime.fromtimestamp(deadline + MINSLEEP, tz=TIMEZONE)
+    try:
+        return int(next_wake(after, SCHEDULE).timestamp())
+    except ValueError:
+        return int(deadline) + RETRYWAKE
 
-    while True:
 
-        timestamp = datetime.now(tz=TIMEZONE)
-
-        if timestamp.hour in (10, 11, 12, 13, 14):
-            # Take the photo
-            takephoto(timestamp)
-
-        # test for current time, and return next on-time
-
-        for hr in range(10, 14):    # hr is 10, 11, 12, 13
-            if (timestamp.hour == hr and timestamp.minute < 55):
-                # Set RTC to turn Pi on at hr plus 1
-                nexttime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=hr+1, tzinfo=TIMEZONE)
-                # next hour in epoch seconds
-                epoch = int(nexttime.timestamp())
-                return epoch
-
-        if ((timestamp.hour >= 14 and timestamp.hour < 17) or
-            (timestamp.hour == 17 and timestamp.minute < 55)):
-            # Set RTC to turn Pi on at 18:00
-            evetime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=18, tzinfo=TIMEZONE)
-            # evetime in epoch seconds
-            epoch = int(evetime.timestamp())
-            return epoch
-
-        # test if current time > 18:10 or < 9:50
-        # If so, set on-time to the following 9:55
-
-        if (timestamp.hour >= 19 or timestamp.hour < 9 or
-            (timestamp.hour == 9 and timestamp.minute < 50) or
-            (timestamp.hour == 18 and timestamp.minute > 10)):
-            # Set RTC to turn Pi on at 9:55
-            nexttime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=9, minute=55, tzinfo=TIMEZONE)
-            if timestamp.hour >= 18:
-                # get next day
-                nexttime = nexttime + timedelta(days=1)
-            epoch = int(nexttime.timestamp())
-            return epoch
+def get_epoch(sleep=time.sleep):
+    """Runs the wake cycle given by SCHEDULE, see schedule.py, calling capture
+       when a capture window opens, and holding the Pi on through a maintenance window.
+       Sleeps until the exact time a window opens or closes, rather than polling.
 
-        # still on-time, wait 5 seconds and continue
-        time.sleep(5)
+       Returns epoch in seconds when the pi should next be powered up, with the default
+       schedule this is either at 9:55, 11:00, 12:00, 13:00, 14:00 or 18:00 depending on which is next.
+    """
+    return run_cycle(SCHEDULE, capture, lambda: datetime.now(tz=TIMEZONE), sleep)
 
 
 
@@ -154,19 +163,34 @@ if __name__ == "__main__":
 
     print("Starting")
 
-    # wait four minutes on boot to allow a user to boot the pi, remote connect,
-    # and if required stop the shutdown.
-    time.sleep(240)
+    # the watchdog halts the Pi if this overruns, deliberate waits go through watchdog.sleep
+    watchdog = Watchdog(WATCHDOGFILE, fallback_wake, BUDGET, HOLDFILE, None, CYCLELOG)
+    watchdog.start()
 
-    # After the four minutes, if time is right (10:00, 11:00, 12:00, 13:00, 14:00) this takes photo.
-    # Returns the epoch of the next wake up time.
-    try:
-        epoch = get_epoch()
-    except:
-        # on any failure, set epoch to 9:55 next day
-        timestamp = datetime.now(tz=TIMEZONE) + timedelta(days=1)
-        nexttime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=9, minute=55, tzinfo=TIMEZONE)
-        epoch = int(nexttime.timestamp())
+    # wait GRACE seconds on boot, by default none
+    watchdog.sleep(GRACE)
+
+    holding = None
+    while True:
+        # if time is right (10:00, 11:00, 12:00, 13:00, 14:00) this takes photo.
+        # Returns the epoch of the next wake up time.
+        try:
+            epoch = get_epoch(watchdog.sleep)
+        except:
+            # on any failure, set epoch to 9:55 next day
+            timestamp = datetime.now(tz=TIMEZONE) + timedelta(days=1)
+            nexttime = datetime(timestamp.year, timestamp.month, timestamp.day, hour=9, minute=55, tzinfo=TIMEZONE)
+            epoch = int(nexttime.timestamp())
+
+        # stay on while held, carrying on with the schedule
+        reason = held(HOLDFILE)
+        if reason != holding:
+            print(f"Held on by {reason}" if reason else "Hold released")
+            holding = reason
+        if reason is None:
+            break
+        CYCLE.held()
+        watchdog.sleep(HOLDPOLL)
 
     # print a message with the epoch of the next on-time
     print(f"Setting wakealarm at epoch {epoch}")
@@ -174,15 +198,12 @@ if __name__ == "__main__":
     print(f"Which is at {ontime} local time")
 
     # set the wakeup time into the RTC
-    path = pathlib.Path("/sys/class/rtc/rtc0/wakealarm")
-    # clear current wakealarm
-    path.write_bytes("0".encode("UTF-8"))
-    # and write new time
-    path.write_bytes(str(epoch).encode("UTF-8"))
-
-    # shutdown after one minute. This is broadcast to any connected user
-    # and gives a user the chance to stop it with
-    # sudo shutdown -c
-    print("Requesting shutdown")
-    subprocess.run(["shutdown", "+1"])
+    watchdog.finish(epoch)
+    set_wakealarm(epoch)
+    watchdog.written()
+
+    CYCLE.write(epoch)
+    up = uptime()
+    print(f"Halting, boot to halt {'unknown' if up is None else f'{up:.1f}'} seconds")
+    halt()
     sys.exit(0)
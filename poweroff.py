@@ -0,0 +1,82 @@
+"""Ending a wake cycle, used by power.py and altpower.py
+
+   Rather than waiting four minutes on every boot and then calling shutdown +1,
+   the scripts take their photo straight away, set the wakealarm and halt. The
+   evening maintenance window of the schedule is the time to connect.
+
+   To keep the Pi on at any other time, either be logged in over ssh, or create
+   the hold file, for example in the evening window
+
+   touch /home/bernard/git/timelapse/hold
+
+   While either is present the script keeps running its schedule, taking photos
+   as they fall due, and halts once the hold file is removed and the last ssh
+   session has ended.
+
+   With POWER_OFF_ON_HALT=1 set in the eeprom, halt powers the Pi off until the
+   wakealarm, see power.py
+"""
+
+import os, subprocess, pathlib
+
+
+# Seconds between checks of the hold file and ssh sessions, while held on
+HOLDPOLL = 60
+
+WAKEALARM = pathlib.Path("/sys/class/rtc/rtc0/wakealarm")
+
+# The command which halts the Pi
+HALT = ["halt"]
+
+
+def uptime():
+    "Returns seconds since boot, read from /proc/uptime, or None if unavailable"
+    try:
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def ssh_sessions():
+    """Returns the number of ssh sessions, found as the sshd processes named for a
+       logged in user, 'sshd: user@pts/0', or 'sshd-session: user@notty' for scp and rsync"""
+    sessions = 0
+    try:
+        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode("utf-8", "replace")
+        except OSError:
+            # the process has ended
+            continue
+        if cmdline.startswith("sshd") and "@" in cmdline:
+            sessions += 1
+    return sessions
+
+
+def held(holdfile):
+    "Returns a reason the Pi should be held on, or None if it may be halted"
+    if pathlib.Path(holdfile).exists():
+        return f"hold file {holdfile}"
+    sessions = ssh_sessions()
+    if sessions:
+        return f"{sessions} ssh session(s)"
+    return None
+
+
+def set_wakealarm(epoch, wakealarm=None):
+    "Writes the epoch at which the Pi should be powered up into the RTC, or the file wakealarm if given"
+    wakealarm = pathlib.Path(wakealarm or WAKEALARM)
+    # clear current wakealarm, a new one cannot be written over it
+    wakealarm.write_bytes("0".encode("UTF-8"))
+    # and write new time
+    wakealarm.write_bytes(str(epoch).encode("UTF-8"))
+
+
+def halt(command=None):
+    "Halts the Pi, which powers off until the wakealarm, command if given replaces HALT"
+    subprocess.run(command or HALT)
@@ -0,0 +1,177 @@
+"""Wake schedule for the timelapse Pi, used by power.py and altpower.py
+
+   The schedule is a list of windows, each a dictionary with keys
+
+   name     - a label, used by the simulator
+   start    - "HH:MM" the window opens
+   end      - "HH:MM" the window closes
+   kind     - "capture", a photo is taken as soon as the window opens,
+              "maintenance", the Pi is held on until the window closes, so a user
+              can connect, after any maintain(timestamp) function given has run
+   lead     - optional, seconds before start at which the Pi is woken, default 0,
+              if a latency is given, see wakelatency.py, that is used instead for
+              capture windows, a maintenance window has no need to open on time
+
+   and, if a site (a dictionary of latitude and longitude in degrees) is given,
+   these optional keys, calculated locally with solar.py
+
+   solar        - minutes from solar noon at which the window opens, kept within
+                  its start and five minutes before its end, so the photo keeps
+                  the hour in its filename
+   minelevation - the window is dropped if the sun is lower than this, in degrees,
+                  when it opens
+   optional     - if true, the window is dropped if the previous photo of the day
+                  already met its brightness target, as reported by a satisfied(day)
+                  function
+
+   DEFAULT gives the original timings of power.py, a wake at 9:55, photos at
+   10:00, 11:00, 12:00, 13:00 and 14:00, and an evening on-time from 18:00 to 18:10.
+
+   SOLAR takes the mid-day photo as close to solar noon as the hour allows, and
+   only wakes for the 10, 11, 13 and 14 photos when the sun is high enough and the
+   photo before was not already good, so in winter the Pi usually wakes twice a day.
+
+   run_cycle does the work of one wake, sleeping until the exact time a window opens
+   or closes rather than polling, and returns the epoch of the next wake up. Since it
+   takes its clock, sleep and capture functions as arguments, simulate.py can replay
+   a year of wake cycles in a few seconds.
+
+   All times are in the timezone of the datetimes given, the scripts use UTC.
+"""
+
+import json
+
+from datetime import datetime, timedelta
+
+from solar import solar_noon, sun_elevation
+
+
+DEFAULT = [
+    {"name":"10", "start":"10:00", "end":"11:00", "kind":"capture", "lead":300},
+    {"name":"11", "start":"11:00", "end":"12:00", "kind":"capture"},
+    {"name":"12", "start":"12:00", "end":"13:00", "kind":"capture"},
+    {"name":"13", "start":"13:00", "end":"14:00", "kind":"capture"},
+    {"name":"14", "start":"14:00", "end":"15:00", "kind":"capture"},
+    {"name":"evening", "start":"18:00", "end":"18:10", "kind":"maintenance"},
+]
+
+SOLAR = [
+    {"name":"10", "start":"10:00", "end":"11:00", "kind":"capture", "solar":-120, "minelevation":30},
+    {"name":"11", "start":"11:00", "end":"12:00", "kind":"capture", "solar":-60, "minelevation":25, "optional":True},
+    {"name":"12", "start":"12:00", "end":"13:00", "kind":"capture", "solar":0},
+    {"name":"13", "start":"13:00", "end":"14:00", "kind":"capture", "solar":60, "minelevation":25, "optional":True},
+    {"name":"14", "start":"14:00", "end":"15:00", "kind":"capture", "solar":120, "minelevation":30, "optional":True},
+    {"name":"evening", "start":"18:00", "end":"18:10", "kind":"maintenance"},
+]
+
+# The wakealarm is not set less than this number of seconds ahead, since shutdown
+# itself takes time, and an alarm which passes before the Pi is off never wakes it.
+# If the next wake is closer than this, the Pi stays on and waits for it instead.
+MINSLEEP = 180
+
+
+def load_schedule(filename):
+    "Reads a schedule, a JSON list of windows, from a file"
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _at(day, hhmm, tzinfo):
+    "Returns a datetime on the given date at the time 'HH:MM'"
+    hour, minute = (int(n) for n in hhmm.split(":"))
+    return datetime(day.year, day.month, day.day, hour, minute, tzinfo=tzinfo)
+
+
+def window_times(window, day, tzinfo, site=None, latency=None):
+    """Returns (wake, start, end) datetimes of the window on the given date, latency if given
+       is the seconds from wake to start, replacing the lead of a capture window"""
+    start = _at(day, window["start"], tzinfo)
+    end = _at(day, window["end"], tzinfo)
+    if site is not None and "solar" in window:
+        solarstart = solar_noon(day, site["longitude"], tzinfo) + timedelta(minutes=window["solar"])
+        solarstart = solarstart.replace(second=0, microsecond=0)
+        start = min(max(solarstart, start), end - timedelta(minutes=5))
+    if latency is None or window["kind"] != "capture":
+        wake = start - timedelta(seconds=window.get("lead", 0))
+    else:
+        wake = start - timedelta(seconds=latency)
+    return wake, start, end
+
+
+def active(window, day, start, site=None, satisfied=None):
+    "Returns False if the window, opening at start on the given date, is dropped"
+    if site is not None and "minelevation" in window:
+        if sun_elevation(start, site["latitude"], site["longitude"]) < window["minelevation"]:
+            return False
+    if satisfied is not None and window.get("optional") and satisfied(day):
+        return False
+    return True
+
+
+def day_windows(schedule, day, tzinfo, site=None, satisfied=None, latency=None):
+    "Returns a list of (window, wake, start, end) for the active windows on the given date"
+    windows = []
+    for window in schedule:
+        wake, start, end = window_times(window, day, tzinfo, site, latency)
+        if active(window, day, start, site, satisfied):
+            windows.append((window, wake, start, end))
+    return windows
+
+
+def find_window(now, schedule, site=None, satisfied=None, latency=None):
+    """Returns (window, start, end) for the active window which now falls in, from its
+       wake time to its end, or None if now is not in any window. Where a window is woken
+       for before the one before it has closed, the later window is returned"""
+    current = None
+    for day in (now.date(), now.date() + timedelta(days=1)):
+        for window, wake, start, end in day_windows(schedule, day, now.tzinfo, site, satisfied, latency):
+            if wake <= now < end and (current is None or wake > current[0]):
+                current = (wake, window, start, end)
+    return None if current is None else current[1:]
+
+
+def next_wake(now, schedule, site=None, satisfied=None, latency=None):
+    "Returns the datetime of the first active window wake time after now"
+    # look a few days ahead, in case a day has no active windows
+    for days in range(8):
+        day = now.date() + timedelta(days=days)
+        wakes = [wake for window, wake, start, end in day_windows(schedule, day, now.tzinfo, site, satisfied, latency) if wake > now]
+        if wakes:
+            return min(wakes)
+    raise ValueError("The schedule has no active windows")
+
+
+def run_cycle(schedule, capture, clock, sleep, minsleep=MINSLEEP, site=None, satisfied=None, maintain=None, latency=None):
+    """Carries out one wake cycle, returns the epoch of the next wake up
+
+       capture(timestamp) is called to take a photo, clock() returns the current
+       timezone aware datetime, and sleep(seconds) waits.
+       site, satisfied and maintain are as described at the top of this module, and may be None.
+       latency, if given, is the seconds the Pi takes from its wakealarm to being ready to
+       capture, and the wakealarm is set that far ahead of each window."""
+
+    while True:
+        now = clock()
+        current = find_window(now, schedule, site, satisfied, latency)
+        if current is not None:
+            window, start, end = current
+            if now < start:
+                # woken early, wait for the window to open
+                sleep((start - now).total_seconds())
+            if window["kind"] == "capture":
+                capture(clock())
+            else:
+                if maintain is not None:
+                    maintain(clock())
+                # hold the Pi on until the window closes
+                remaining = (end - clock()).total_seconds()
+                if remaining > 0:
+                    sleep(remaining)
+
+        now = clock()
+        wake = next_wake(now, schedule, site, satisfied, latency)
+        seconds = (wake - now).total_seconds()
+        if seconds >= minsleep:
+            return int(wake.timestamp())
+        # too close to shut down, stay on until the next window
+        sleep(seconds)
@@ -0,0 +1,186 @@
+"""Replays a year of wake cycles offline, to compare the power use of schedules
+
+   Each wake cycle is run through schedule.run_cycle with a simulated clock, so
+   sleeping costs no real time. A cycle is timed as
+
+   RTC wake -> boot -> grace period -> run_cycle (sleeps and captures) -> shutdown -> off
+
+   and the report gives, for each schedule, the number of wakes, the total and mean
+   on-time, the photos taken, how late they were after their window opened, and any
+   capture windows missed.
+
+   Usage:
+
+   python3 simulate.py [--year 2027] [--boot S] [--jitter S] [--grace S] [--capture S] [--shutdown S]
+                       [--latitude D] [--longitude D] [--met P] [schedule.json ...]
+
+   With no schedule files, the DEFAULT and SOLAR schedules of schedule.py are simulated.
+
+   Solar timings and elevations are calculated for the given latitude and longitude,
+   and each photo is taken to meet its brightness target with probability P, so that
+   windows marked optional are dropped after it.
+
+   The boot time of each wake varies with a standard deviation of --jitter seconds,
+   and each schedule is simulated both with the fixed leads of its windows, and with
+   the wakealarm set ahead by the learnt latency, see wakelatency.py.
+"""
+
+import random, argparse
+
+from datetime import datetime, timezone, timedelta
+
+import schedule as wakeschedule
+
+from wakelatency import LatencyModel
+
+
+# Default seconds for each stage of a cycle
+BOOT = 30          # RTC wake until the script starts
+JITTER = 5         # standard deviation of the boot time
+GRACE = 0          # the sleep at the start of the script, 240 before poweroff.py
+CAPTURE = 20       # taking and metering a photo, including any retake
+SHUTDOWN = 15      # halting, 75 for the shutdown +1 used before poweroff.py
+
+# Default site, as altpower.py
+LATITUDE = 51.5
+LONGITUDE = -0.1
+
+# Default probability that a photo meets its brightness target
+MET = 0.6
+
+
+class SimulatedClock:
+    "A clock which advances only when slept on, or when told to"
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += timedelta(seconds=max(seconds, 0))
+
+
+def simulate(schedule, start, days, boot=BOOT, grace=GRACE, capture=CAPTURE, shutdown=SHUTDOWN,
+             site=None, met=MET, seed=0, hook=None, jitter=0, compensate=False):
+    """Simulates days of wake cycles from the datetime start, the first wake being the
+       first in the schedule after start. site is a dictionary of latitude and longitude,
+       and met the probability a photo meets its brightness target. hook, if given, is
+       called as hook(clock, photos) at the start of each cycle, for extensions to adjust
+       behaviour. The boot time varies with standard deviation jitter, and if compensate is
+       True the wakealarm is set ahead by the latency learnt as altpower.py does.
+       Returns a dictionary of results"""
+
+    end = start + timedelta(days=days)
+    clock = SimulatedClock(start)
+    rng = random.Random(seed)
+    # a separate generator, so the photos meeting their target do not change with jitter
+    bootrng = random.Random(seed + 1)
+    model = LatencyModel() if compensate else None
+    photos = []
+    photomet = {}     # day:True if the last photo of the day met its target
+    wakes = 0
+    awake = 0.0
+
+    def takephoto(timestamp):
+        # as in power.py, a photo is only taken once in each hour
+        if not photos or photos[-1].strftime("%Y%m%d%H") != timestamp.strftime("%Y%m%d%H"):
+            photos.append(timestamp)
+            photomet[timestamp.date()] = rng.random() < met
+            clock.sleep(capture)
+
+    def satisfied(day):
+        return photomet.get(day, False)
+
+    wake = wakeschedule.next_wake(start, schedule, site, satisfied)
+    while wake < end:
+        clock.now = wake
+        wakes += 1
+        if hook is not None:
+            hook(clock, photos)
+        clock.sleep(max(1.0, bootrng.gauss(boot, jitter)) if jitter else boot)
+        clock.sleep(grace)
+        latency = None
+        if model is not None:
+            model.ready(clock.now.timestamp())
+            latency = model.lead()
+        epoch = wakeschedule.run_cycle(schedule, takephoto, clock, clock.sleep, site=site, satisfied=satisfied,
+                                       latency=latency)
+        if model is not None:
+            model.armed(epoch)
+        clock.sleep(shutdown)
+        awake += (clock.now - wake).total_seconds()
+        nextwake = datetime.fromtimestamp(epoch, tz=start.tzinfo)
+        if nextwake <= clock.now:
+            # the alarm passed before the Pi was off, it would never wake again
+            raise RuntimeError(f"Wakealarm {nextwake} passed before shutdown completed at {clock.now}")
+        wake = nextwake
+
+    # a capture window is missed if no photo was taken while it was open, windows which
+    # the schedule chose to drop are not counted, though a day with no photo at all is
+    missed = []
+    late = []
+    day = start.date()
+    while day < end.date():
+        for window in schedule:
+            if window["kind"] != "capture":
+                continue
+            wwake, wstart, wend = wakeschedule.window_times(window, day, start.tzinfo, site)
+            if not wakeschedule.active(window, day, wstart, site):
+                continue
+            if window.get("optional") and any(p.date() == day for p in photos):
+                continue
+            if wstart < start or wend > end:
+                continue
+            taken = [p for p in photos if wstart <= p < wend]
+            if taken:
+                late.append((taken[0] - wstart).total_seconds())
+            else:
+                missed.append(wstart)
+        day += timedelta(days=1)
+
+    return {"wakes":wakes, "awake":awake, "photos":len(photos), "missed":missed, "late":late}
+
+
+def report(name, result, days):
+    "Prints a summary of a simulate result"
+    hours = result["awake"] / 3600
+    print(f"{name}")
+    print(f"    wakes {result['wakes']}, {result['wakes']/days:.1f} per day")
+    print(f"    awake {hours:.1f} hours, {result['awake']/max(result['wakes'], 1)/60:.1f} minutes per wake, {hours*60/days:.1f} minutes per day")
+    print(f"    photos {result['photos']}, missed captures {len(result['missed'])}")
+    late = result["late"]
+    if late:
+        print(f"    photos late by {sum(late)/len(late):.1f} seconds mean, {max(late):.1f} max")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simulate a year of timelapse wake cycles")
+    parser.add_argument("schedules", nargs="*", help="JSON schedule files, default the built in schedule")
+    parser.add_argument("--year", type=int, default=datetime.now(tz=timezone.utc).year)
+    parser.add_argument("--boot", type=float, default=BOOT)
+    parser.add_argument("--jitter", type=float, default=JITTER, help="standard deviation of the boot time")
+    parser.add_argument("--grace", type=float, default=GRACE)
+    parser.add_argument("--capture", type=float, default=CAPTURE)
+    parser.add_argument("--shutdown", type=float, default=SHUTDOWN)
+    parser.add_argument("--latitude", type=float, default=LATITUDE)
+    parser.add_argument("--longitude", type=float, default=LONGITUDE)
+    parser.add_argument("--met", type=float, default=MET, help="probability a photo meets its brightness target")
+    args = parser.parse_args()
+
+    site = {"latitude":args.latitude, "longitude":args.longitude}
+
+    start = datetime(args.year, 1, 1, tzinfo=timezone.utc)
+    days = (datetime(args.year + 1, 1, 1, tzinfo=timezone.utc) - start).days
+
+    schedules = [(filename, wakeschedule.load_schedule(filename)) for filename in args.schedules]
+    if not schedules:
+        schedules = [("default", wakeschedule.DEFAULT), ("solar", wakeschedule.SOLAR)]
+
+    for name, schedule in schedules:
+        for compensate in (False, True):
+            result = simulate(schedule, start, days, args.boot, args.grace, args.capture, args.shutdown, site, args.met,
+                              jitter=args.jitter, compensate=compensate)
+            report(f"{name}, {'learnt latency' if compensate else 'fixed leads'}", result, days)
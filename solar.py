@@ -0,0 +1,55 @@
+"""Position of the sun, calculated locally with no network access
+
+   Uses the NOAA 'General Solar Position Calculations' approximations, which are
+   accurate to a fraction of a degree, plenty for judging daylight.
+
+   Times passed in must be timezone aware datetimes, they are converted to UTC.
+"""
+
+import math
+
+from datetime import datetime, timezone, timedelta
+
+
+def _fractional_year(when):
+    "Returns the fractional year in radians for the given UTC datetime"
+    daysinyear = 366 if (when.year % 4 == 0 and (when.year % 100 != 0 or when.year % 400 == 0)) else 365
+    dayofyear = when.timetuple().tm_yday
+    return 2 * math.pi / daysinyear * (dayofyear - 1 + (when.hour - 12) / 24)
+
+
+def _equation_of_time(gamma):
+    "Returns the equation of time in minutes"
+    return 229.18 * (0.000075 + 0.001868 * math.cos(gamma) - 0.032077 * math.sin(gamma)
+                     - 0.014615 * math.cos(2 * gamma) - 0.040849 * math.sin(2 * gamma))
+
+
+def _declination(gamma):
+    "Returns the solar declination in radians"
+    return (0.006918 - 0.399912 * math.cos(gamma) + 0.070257 * math.sin(gamma)
+            - 0.006758 * math.cos(2 * gamma) + 0.000907 * math.sin(2 * gamma)
+            - 0.002697 * math.cos(3 * gamma) + 0.00148 * math.sin(3 * gamma))
+
+
+def sun_elevation(when, latitude, longitude):
+    """Returns the elevation of the sun in degrees above the horizon at the given
+       time and place, latitude and longitude in degrees, east positive"""
+    when = when.astimezone(timezone.utc)
+    gamma = _fractional_year(when)
+    # true solar time in minutes
+    tst = when.hour * 60 + when.minute + when.second / 60 + _equation_of_time(gamma) + 4 * longitude
+    hourangle = math.radians(tst / 4 - 180)
+    lat = math.radians(latitude)
+    decl = _declination(gamma)
+    coszenith = math.sin(lat) * math.sin(decl) + math.cos(lat) * math.cos(decl) * math.cos(hourangle)
+    coszenith = max(-1.0, min(1.0, coszenith))
+    return 90 - math.degrees(math.acos(coszenith))
+
+
+def solar_noon(day, longitude, tzinfo=timezone.utc):
+    """Returns the datetime of solar noon, when the sun is highest, on the given date
+       at the given longitude in degrees, east positive"""
+    midday = datetime(day.year, day.month, day.day, 12, tzinfo=timezone.utc)
+    minutes = 720 - 4 * longitude - _equation_of_time(_fractional_year(midday))
+    noon = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(minutes=minutes)
+    return noon.astimezone(tzinfo)
@@ -0,0 +1,191 @@
+"""Storage policy for the photos on the Pi, used by altpower.py
+
+   Every photo of a day has to be copied over Wi-Fi in the short evening window,
+   but the film only uses one frame a day. So once a day, at the start of the
+   evening maintenance window, apply_policy
+
+   - deletes each image_YYYYMMDDHH_orig.jpeg whose retake metered closer to the
+     brightness target, as the retake is the better photo, unless keeporig is True,
+     as makevid/fuse.py needs both photos of a retake to fuse them
+   - replaces each frame not taken at one of KEEPHOURS with a reduced preview,
+     image_YYYYMMDDHH_preview.jpeg, 1/PREVIEWSCALE of the size at PREVIEWQUALITY,
+     made from whichever of the retake and its _orig photo metered nearer the
+     target. The _orig photo of a previewed frame is deleted, even if keeporig is True.
+     If the day has no frame at any of KEEPHOURS, as when the Pi did not wake then,
+     the frame metered nearest the brightness target is kept at full size instead,
+     so every day keeps a frame for the film. If keephours is None every frame is
+     kept at full size, as makevid/bestframe.py needs to choose among them
+   - re-encodes the kept frames, and the _orig photos kept with them, which are
+     larger than FRAMEBYTES, at the highest quality from FRAMEQUALITY down to
+     MINQUALITY which fits
+
+   The frame index is updated as files change, keeping the exposure and the
+   statistics metered from the full photo, and if a transfer manifest is given
+   each change is appended to it, see transfer.py. Files are replaced atomically, so an
+   rsync running at the same time sees either the old or the new file.
+
+   Requires pillow
+"""
+
+import io, os, pathlib
+
+from PIL import Image
+
+from metering import TARGET
+from frameindex import row_stats, file_sha1
+from transfer import record_add, record_delete
+
+
+# Frames taken at these hours are kept at full size, as used by the film, see makevid/adjust.py
+# None keeps every frame at full size, for makevid/bestframe.py
+KEEPHOURS = (12,)
+
+# Previews are reduced by this factor, 4000x3000 to 1000x750, and saved with this quality
+PREVIEWSCALE = 4
+PREVIEWQUALITY = 80
+
+# Kept frames larger than FRAMEBYTES are re-encoded, at the highest quality between
+# MINQUALITY and FRAMEQUALITY which fits, or at MINQUALITY if none do.
+# If FRAMEBYTES is None, kept frames are left as taken
+FRAMEBYTES = 2500000
+FRAMEQUALITY = 92
+MINQUALITY = 80
+
+
+def write_atomic(filepath, data):
+    "Writes the bytes data to filepath, replacing any previous file atomically"
+    tmppath = filepath.with_name(filepath.name + ".tmp")
+    with open(tmppath, "wb") as f:
+        f.write(data)
+    os.replace(tmppath, filepath)
+
+
+def encode_budget(img, maxbytes, quality=FRAMEQUALITY, minquality=MINQUALITY):
+    """Returns (jpeg bytes, quality) of img encoded at the highest quality from minquality
+       to quality whose size is within maxbytes, found by bisection, or at minquality if none are"""
+    def encode(q):
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=q)
+        return buffer.getvalue()
+
+    best = None
+    low, high = minquality, quality
+    while low <= high:
+        q = (low + high) // 2
+        data = encode(q)
+        if len(data) <= maxbytes:
+            best = (data, q)
+            low = q + 1
+        else:
+            high = q - 1
+    if best is None:
+        best = (encode(minquality), minquality)
+    return best
+
+
+def preview_bytes(filepath, scale=PREVIEWSCALE, quality=PREVIEWQUALITY):
+    "Returns the jpeg bytes of a preview of the photo at filepath, reduced in size by scale"
+    with Image.open(filepath) as img:
+        size = (img.width // scale, img.height // scale)
+        # decode at reduced scale, then reduce exactly
+        img.draft("RGB", size)
+        img = img.convert("RGB")
+        if img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, "JPEG", quality=quality)
+        return buffer.getvalue()
+
+
+def apply_policy(imagedir, index, day, keephours=KEEPHOURS, framebytes=FRAMEBYTES, keeporig=False, manifest=None):
+    """Applies the storage policy to the photos of the given date in imagedir, recorded in the
+       open FrameIndex index, and in the transfer manifest if given. If keeporig is True the
+       _orig photos of the frames kept at full size are not deleted. Returns a dictionary of the number of files pruned,
+       previewed and re-encoded, and the bytes saved"""
+    imagedir = pathlib.Path(imagedir)
+    result = {"pruned":0, "previews":0, "reencoded":0, "saved":0}
+    rows = {row["name"]:row for row in index.query("SELECT * FROM frames WHERE day = ?", (day.strftime("%Y%m%d"),))}
+
+    def remove(name):
+        os.remove(imagedir / name)
+        with index.conn:
+            index.conn.execute("DELETE FROM frames WHERE name = ?", (name,))
+        if manifest is not None:
+            record_delete(manifest, name)
+
+    def replaced(newpath, row):
+        sha1 = file_sha1(newpath)
+        index.record(newpath, row["exposure"], row_stats(row), bool(row["retake"]), sha1)
+        if manifest is not None:
+            record_add(manifest, newpath, sha1)
+
+    def nearer(row, other):
+        "Returns True if row metered at least as near the target as other"
+        return (row["brightness"] is not None and other["brightness"] is not None
+                and abs(row["brightness"] - TARGET) <= abs(other["brightness"] - TARGET))
+
+    def reencode(filepath, row):
+        "Re-encodes a photo kept at full size if it is larger than framebytes"
+        size = filepath.stat().st_size
+        if framebytes is None or size <= framebytes:
+            return
+        with Image.open(filepath) as img:
+            data, quality = encode_budget(img.convert("RGB"), framebytes)
+        # a photo which could not be brought within budget is not re-encoded again each
+        # evening, losing quality each time, as the saving is then small
+        if len(data) < 0.9 * size:
+            write_atomic(filepath, data)
+            replaced(filepath, row)
+            result["saved"] += size - len(data)
+            result["reencoded"] += 1
+
+    # the frames kept at full size, those at keephours, or failing any, the one metered nearest the target
+    frames = [row for name, row in rows.items() if row["kind"] == "frame" and (imagedir / name).exists()]
+    keep = {row["name"] for row in frames if keephours is None or row["hour"] in keephours}
+    if frames and not keep:
+        best = min(frames, key=lambda row: (row["brightness"] is None, abs((row["brightness"] or 0.0) - TARGET)))
+        keep.add(best["name"])
+
+    for name, row in sorted(rows.items()):
+        if row["kind"] != "frame":
+            continue
+        filepath = imagedir / name
+        if not filepath.exists():
+            continue
+        size = filepath.stat().st_size
+
+        origname = name.replace(".jpeg", "_orig.jpeg")
+        orig = rows.get(origname) if (imagedir / origname).exists() else None
+
+        if name not in keep:
+            # the preview is of the better photo, the _orig photo is deleted below
+            source, sourcerow = (imagedir / origname, orig) if orig is not None and not nearer(row, orig) else (filepath, row)
+            previewpath = imagedir / name.replace(".jpeg", "_preview.jpeg")
+            data = preview_bytes(source)
+            write_atomic(previewpath, data)
+            replaced(previewpath, sourcerow)
+            remove(name)
+            result["saved"] += size - len(data)
+            result["previews"] += 1
+            continue
+
+        # prune the first photo if the retake was metered better
+        if not keeporig and row["retake"] and orig is not None and nearer(row, orig):
+            result["saved"] += (imagedir / origname).stat().st_size
+            remove(origname)
+            result["pruned"] += 1
+        reencode(filepath, row)
+
+    # the _orig photos left, of kept frames, are held to the same budget, and those of
+    # previewed frames are deleted, as the preview replaces both
+    for name, row in sorted(rows.items()):
+        if row["kind"] != "orig" or not (imagedir / name).exists():
+            continue
+        framename = name.replace("_orig.jpeg", ".jpeg")
+        if (imagedir / framename).exists():
+            reencode(imagedir / name, row)
+        elif (imagedir / framename.replace(".jpeg", "_preview.jpeg")).exists():
+            result["saved"] += (imagedir / name).stat().st_size
+            remove(name)
+            result["pruned"] += 1
+    return result
@@ -0,0 +1,92 @@
+"""An append-only manifest of the photos written on the Pi, used by altpower.py
+
+   Each photo written, changed or deleted in the images directory is recorded as a
+   line of JSON in the manifest MANIFESTNAME, with keys
+
+   seq      - a sequence number, increasing by one each line
+   name     - the filename
+   action   - "add" for a new or changed file, "delete" for a removed one
+   size     - bytes, for "add"
+   sha1     - hex digest of the contents, for "add"
+   mtime_ns - modification time in nanoseconds, for "add", which the copy is given, so
+              that the frame index on the desktop sees the file as unchanged
+
+   makevid/pull.py on the desktop reads the manifest from where it last stopped,
+   and copies only the files added since, so the time taken by a sync does not
+   grow with the number of photos held.
+
+   Appending a line only reads the end of the manifest, for the last sequence number.
+"""
+
+import os, json
+
+from frameindex import file_sha1
+
+
+MANIFESTNAME = "transfer.jsonl"
+
+
+def parse_line(line):
+    "Returns the entry dictionary of a manifest line, or None if the line is incomplete or invalid"
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(entry, dict) or "seq" not in entry or "name" not in entry:
+        return None
+    return entry
+
+
+def last_seq(manifest):
+    "Returns the sequence number of the last entry of the manifest, 0 if it has none"
+    try:
+        with open(manifest, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            # read back from the end until a whole line is found
+            blocksize = 4096
+            while True:
+                start = max(0, end - blocksize)
+                f.seek(start)
+                lines = f.read(end - start).splitlines()
+                for line in reversed(lines[1:] if start else lines):
+                    entry = parse_line(line)
+                    if entry is not None:
+                        return entry["seq"]
+                if start == 0:
+                    return 0
+                blocksize *= 2
+    except OSError:
+        return 0
+
+
+def _append(manifest, entry):
+    entry = dict(seq=last_seq(manifest) + 1, **entry)
+    with open(manifest, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    return entry
+
+
+def record_add(manifest, filepath, sha1=None):
+    "Appends an entry for the new or changed file at filepath, returns the entry"
+    stat = filepath.stat()
+    return _append(manifest, {"name":filepath.name, "action":"add", "size":stat.st_size,
+                              "sha1":sha1 or file_sha1(filepath), "mtime_ns":stat.st_mtime_ns})
+
+
+def record_delete(manifest, name):
+    "Appends an entry for the file name, which has been deleted, returns the entry"
+    return _append(manifest, {"name":name, "action":"delete"})
+
+
+def read_entries(f, offset=0):
+    """Yields (entry, offset) for each complete entry read from the open binary file f,
+       which is at position offset, offset being the position in the file after the entry's line"""
+    for line in f:
+        if not line.endswith(b"\n"):
+            # a line still being written
+            break
+        offset += len(line)
+        entry = parse_line(line)
+        if entry is not None:
+            yield entry, offset
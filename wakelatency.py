@@ -0,0 +1,97 @@
+"""Learns how long the Pi takes from its wakealarm to being ready to take a photo
+
+   The wakealarm used to be set for the photo time itself, or a fixed five minutes
+   before it, so the photo was taken late by the boot time, or the Pi sat idle
+   waiting. Instead, at halt the script records the wakealarm it set, and on the
+   next boot, once it is ready to capture, records the seconds since that alarm as
+   a sample. The lead given to the schedule, see schedule.py, is the QUANTILE of
+   the last MAXSAMPLES samples plus MARGIN seconds, so the Pi wakes early by just
+   enough for the photo to be taken on the minute.
+
+   A sample outside MINLATENCY to MAXLATENCY is discarded, as then the Pi was not
+   woken by the alarm, for example it was started by hand, or halted by the watchdog
+   with a different wakealarm, see watchdog.py.
+
+   Until there are MINSAMPLES samples, lead() returns None, and each window keeps
+   its own lead.
+
+   Samples are kept in a small JSON state file, as exposuremodel.py.
+"""
+
+import os, json, math, pathlib
+
+
+# Samples kept, the most recent
+MAXSAMPLES = 30
+
+# Samples needed before the lead is used
+MINSAMPLES = 3
+
+# Fraction of samples the lead should cover
+QUANTILE = 0.8
+
+# Seconds added to the quantile
+MARGIN = 2
+
+# Samples outside this range, in seconds, are not a wake by the alarm
+MINLATENCY = 1
+MAXLATENCY = 900
+
+# The lead is kept within this range, in seconds
+MINLEAD = 10
+MAXLEAD = 600
+
+
+class LatencyModel:
+
+    def __init__(self, statefile=None):
+        "statefile may be None, as for the simulator, when nothing is saved"
+        self.statefile = statefile and pathlib.Path(statefile)
+        self.samples = []
+        self.pending = None
+        self.load()
+
+    def load(self):
+        "Reads samples from the state file, a missing or corrupt file gives no samples"
+        if self.statefile is None:
+            return
+        try:
+            state = json.loads(self.statefile.read_text())
+            self.samples = [float(s) for s in state["samples"]]
+            self.pending = state.get("pending")
+        except (OSError, ValueError, KeyError, TypeError):
+            self.samples = []
+            self.pending = None
+
+    def save(self):
+        "Writes the samples to the state file, replacing it atomically"
+        if self.statefile is None:
+            return
+        tmpfile = self.statefile.with_suffix(".tmp")
+        tmpfile.write_text(json.dumps({"samples":self.samples, "pending":self.pending}, separators=(",", ":")))
+        os.replace(tmpfile, self.statefile)
+
+    def armed(self, epoch):
+        "Records the wakealarm set at halt"
+        self.pending = epoch
+
+    def ready(self, epoch):
+        """Records that the script is ready to capture at epoch, giving a sample of the latency
+           from the wakealarm recorded by armed(), returns the sample, or None if there is none"""
+        if self.pending is None:
+            return None
+        latency = epoch - self.pending
+        self.pending = None
+        if not MINLATENCY <= latency <= MAXLATENCY:
+            return None
+        self.samples.append(round(latency, 1))
+        self.samples = self.samples[-MAXSAMPLES:]
+        return latency
+
+    def lead(self):
+        "Returns the seconds before a photo at which the Pi should be woken, or None if not yet known"
+        if len(self.samples) < MINSAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        quantile = ordered[math.ceil(QUANTILE * len(ordered)) - 1]
+        return max(MINLEAD, min(MAXLEAD, round(quantile + MARGIN)))
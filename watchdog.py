@@ -0,0 +1,239 @@
+"""A watchdog which halts the Pi if a wake cycle overruns, used by power.py and altpower.py
+
+   A webcam which hangs, or a script stuck for any other reason, would otherwise
+   keep the Pi on until the battery is flat. So at the start of each wake cycle
+   the script starts this module as a separate process, with a budget of BUDGET
+   seconds. If the script has not halted the Pi within the budget, less MARGIN
+   seconds, or if it stops without halting, the watchdog writes the wakealarm and
+   halts the Pi itself.
+
+   The budget covers the work of the cycle, the time the script deliberately
+   waits, for a window to open, through the maintenance window, or while held on,
+   is added to it with extend(). The watchdog also does not halt the Pi while it
+   is held on by an ssh session or the hold file, see poweroff.py.
+
+   The wakealarm it sets is the fallback given by the script, normally the next
+   scheduled wake after the deadline, or if that has passed, RETRYWAKE seconds on.
+   When the script has its own wakealarm, it passes it with finish(), and the
+   watchdog then only halts, if halt has not happened MARGIN seconds later.
+
+   The state shared with the watchdog process is a small JSON file, the watchdog
+   ends as soon as it is removed. Being a separate process, it still acts if the
+   script is stuck in a driver call which holds the Python interpreter.
+
+   Should the state file not be written at the start, as with a full disk, the
+   watchdog cannot run, so start() writes the fallback wakealarm and halts the Pi
+   there and then, rather than the script failing and being restarted until the
+   battery is flat. A later write which fails is logged, and the watchdog carries on
+   with the state it has.
+
+   Run directly as
+
+   python3 watchdog.py statefile
+
+   which is how Watchdog.start() runs it.
+"""
+
+import os, sys, json, time, signal, pathlib, subprocess
+
+import poweroff
+
+from poweroff import held, set_wakealarm, halt
+
+from cyclelog import CycleLog
+
+# A wakealarm closer than MINSLEEP is not set, as it could pass before the Pi is off
+from schedule import MINSLEEP
+
+
+# Seconds a wake cycle may take, not counting deliberate waits
+BUDGET = 600
+
+# Seconds before the end of the budget at which the watchdog acts, to leave time to
+# write the wakealarm and halt
+MARGIN = 30
+
+# Seconds between checks of the state file
+POLL = 5
+
+# If the fallback wakealarm has passed, or is too close, the Pi wakes this many seconds after halting
+RETRYWAKE = 3600
+
+
+def read_state(statefile):
+    "Returns the state dictionary, or None if the file has been removed"
+    try:
+        with open(statefile) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # caught while being replaced, try again
+        time.sleep(0.1)
+        return read_state(statefile)
+
+
+def write_state(statefile, state):
+    "Writes the state, replacing any previous one atomically"
+    statefile = pathlib.Path(statefile)
+    tmpfile = statefile.with_name(statefile.name + ".tmp")
+    tmpfile.write_text(json.dumps(state))
+    os.replace(tmpfile, statefile)
+
+
+def alive(pid):
+    "Returns True if the process pid is running"
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # a zombie has stopped, but is not yet reaped
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+class Watchdog:
+    """Starts and feeds the watchdog process
+
+       fallback(deadline) returns the epoch of the wakealarm to set should the watchdog
+       halt the Pi at the epoch deadline. holdfile, logfile, a line per action is appended
+       to this, and cyclelog, a record is appended to this if the watchdog halts the Pi,
+       may be None"""
+
+    def __init__(self, statefile, fallback, budget=BUDGET, holdfile=None, logfile=None, cyclelog=None):
+        self.statefile = pathlib.Path(statefile)
+        self.fallback = fallback
+        self.budget = budget
+        self.state = {"pid":os.getpid(), "holdfile":holdfile and str(holdfile),
+                      "logfile":logfile and str(logfile), "cyclelog":cyclelog and str(cyclelog),
+                      "wakealarmfile":str(poweroff.WAKEALARM), "halt":poweroff.HALT, "written":False}
+        self.process = None
+
+    def _write(self):
+        "Writes the state, returns False, logging why, if it could not be written"
+        try:
+            write_state(self.statefile, self.state)
+        except OSError as e:
+            log(self.state, f"unable to write {self.statefile}: {e}")
+            return False
+        return True
+
+    def _deadline(self, deadline):
+        self.state["deadline"] = deadline
+        self.state["wakealarm"] = self.fallback(deadline)
+        return self._write()
+
+    def start(self):
+        """Starts the watchdog process, with the whole budget from now. If the state
+           cannot be written, writes the fallback wakealarm and halts the Pi instead,
+           and exits the script"""
+        if not self._deadline(time.time() + self.budget - MARGIN):
+            act(self.state, "unable to start", kill=False)
+            sys.exit(0)
+        # in a session of its own, so it is not stopped along with the script
+        self.process = subprocess.Popen([sys.executable, str(pathlib.Path(__file__).resolve()), str(self.statefile)],
+                                        stdin=subprocess.DEVNULL, start_new_session=True)
+
+    def extend(self, seconds):
+        "Adds seconds, the length of a deliberate wait, to the budget"
+        self._deadline(self.state["deadline"] + seconds)
+
+    def sleep(self, seconds):
+        "Waits, extending the budget by the time waited, this replaces time.sleep"
+        self.extend(seconds)
+        time.sleep(seconds)
+
+    def finish(self, epoch):
+        """Gives the wakealarm the script is about to set, and allows MARGIN seconds for
+           it to be written and halt to happen"""
+        self.state["deadline"] = time.time() + MARGIN
+        self.state["wakealarm"] = epoch
+        self._write()
+
+    def written(self):
+        "Records that the wakealarm has been written, so the watchdog will not write it again"
+        self.state["written"] = True
+        self._write()
+
+    def stop(self):
+        "Ends the watchdog process without it acting"
+        try:
+            os.remove(self.statefile)
+        except FileNotFoundError:
+            pass
+        if self.process is not None:
+            self.process.wait()
+            self.process = None
+
+
+def log(state, message):
+    "Appends a line to the log file of the state, in the format of altpower.log_timing"
+    if not state.get("logfile"):
+        return
+    try:
+        with open(state["logfile"], "a") as f:
+            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())} watchdog {message}\n")
+    except OSError:
+        pass
+
+
+def act(state, reason, kill=True):
+    """Writes the wakealarm, unless the script has already, stops the script and halts the Pi,
+       kill is False when called from the script itself"""
+    epoch = state["wakealarm"]
+    if not state["written"]:
+        if epoch < time.time() + MINSLEEP:
+            epoch = int(time.time()) + RETRYWAKE
+        try:
+            set_wakealarm(epoch, state["wakealarmfile"])
+        except OSError as e:
+            log(state, f"unable to write wakealarm: {e}")
+    log(state, f"{reason}, halting, wakealarm {epoch}")
+    if state.get("cyclelog") and not state["written"]:
+        cycle = CycleLog(state["cyclelog"])
+        cycle.fault(f"watchdog: {reason}")
+        cycle.write(epoch)
+    # so that it cannot write a different wakealarm as the Pi halts
+    if kill and alive(state["pid"]):
+        try:
+            os.kill(state["pid"], signal.SIGKILL)
+        except OSError:
+            pass
+    halt(state["halt"])
+
+
+def watch(statefile):
+    """Watches the state file until it is removed, or the deadline passes, or the script
+       stops, when it acts. Returns the reason it acted, or None"""
+    holding = None
+    while True:
+        state = read_state(statefile)
+        if state is None:
+            return
+        now = time.time()
+        if now >= state["deadline"]:
+            reason = "budget used up" if not state["written"] else "halt did not happen"
+        elif not state["written"] and not alive(state["pid"]):
+            reason = "script stopped without halting"
+        else:
+            time.sleep(max(0.1, min(POLL, state["deadline"] - now)))
+            continue
+        reason_held = state["holdfile"] and held(state["holdfile"])
+        if reason_held:
+            if reason_held != holding:
+                log(state, f"{reason}, but held on by {reason_held}")
+                holding = reason_held
+            time.sleep(POLL)
+            continue
+        act(state, reason)
+        return reason
+
+
+if __name__ == "__main__":
+
+    watch(sys.argv[1])